@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+
+# Same as the tests, the application modules import each other relative to `src`
+SRC_PATH = Path(__file__).resolve().parent.parent / "src"
+if str(SRC_PATH) not in sys.path:
+    sys.path.insert(0, str(SRC_PATH))
@@ -0,0 +1,61 @@
+"""Compares two benchmark runs, exits with 1 if a benchmark regressed more than the threshold.
+
+    python -m benchmarks.compare benchmarks/results/old.json benchmarks/results/new.json --threshold 0.2"""
+import argparse
+import sys
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from benchmarks.run import BenchmarkRun
+
+
+class Comparison(BaseModel):
+    benchmark: str
+    size: int
+    baseline_seconds: float
+    current_seconds: float
+
+    @property
+    def ratio(self) -> float:
+        return self.current_seconds / self.baseline_seconds if self.baseline_seconds > 0 else 1.0
+
+
+def compare_runs(baseline: BenchmarkRun, current: BenchmarkRun) -> list[Comparison]:
+    """The best times of the benchmarks in both runs."""
+    comparisons = []
+    for result in current.results:
+        baseline_result = baseline.result(result.benchmark, result.size)
+        if baseline_result is not None:
+            comparisons.append(Comparison(benchmark=result.benchmark, size=result.size,
+                                          baseline_seconds=baseline_result.best_seconds,
+                                          current_seconds=result.best_seconds))
+    return comparisons
+
+
+def regressions(comparisons: list[Comparison], threshold: float = 0.2) -> list[Comparison]:
+    return [c for c in comparisons if c.ratio > 1 + threshold]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares two benchmark runs.")
+    parser.add_argument("baseline", type=Path)
+    parser.add_argument("current", type=Path)
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown that fails, 0.2 is 20%% slower")
+    args = parser.parse_args()
+
+    baseline = BenchmarkRun.model_validate_json(args.baseline.read_text(encoding="utf8"))
+    current = BenchmarkRun.model_validate_json(args.current.read_text(encoding="utf8"))
+    print(f"Baseline {baseline.commit or args.baseline.name}, current {current.commit or args.current.name}")
+    comparisons = compare_runs(baseline, current)
+    for c in comparisons:
+        print(f"{c.benchmark} [{c.size}]: {c.baseline_seconds:.3f} s -> {c.current_seconds:.3f} s ({c.ratio:.2f}x)")
+
+    regressed = regressions(comparisons, args.threshold)
+    for c in regressed:
+        print(f"Regression: {c.benchmark} [{c.size}] is {c.ratio:.2f}x slower")
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
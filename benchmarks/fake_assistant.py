@@ -0,0 +1,274 @@
+import asyncio
+import json
+import re
+import threading
+import time
+from itertools import count
+from typing import Any, Callable, Literal
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+from pydantic import BaseModel
+
+from model.answers_generation import FileAnnotation
+
+
+FAKE_BASE_URL = "http://fake-openai.local/v1"
+
+
+class FakeAnswer(BaseModel):
+    text: str
+    references: list[FileAnnotation] = []
+
+
+def echo_answer(question: str) -> FakeAnswer:
+    return FakeAnswer(
+        text=f"Respuesta a: {question}【4:0†source】",
+        references=[FileAnnotation(text="【4:0†source】", file_id="file_1")])
+
+
+class FakeAssistantServer:
+    """In-process stand-in for the OpenAI Assistants API, to use the real clients offline.
+
+    Requests are served through an httpx MockTransport. Runs stay 'queued' for
+    `queued_polls` retrieves, then are 'in_progress' until they complete after
+    `polls_to_complete` more retrieves and the answer is added to the thread.
+    Uploaded files, vector store files and file batches are kept too, batches are
+    completed at once. `latency` seconds are added to every request, `poll_after_ms`
+    is sent as the suggested poll interval. Streamed runs end with `stream_end`: the
+    run completed, an error event, the run requiring an action or nothing (cut)."""
+
+    def __init__(self, answer: Callable[[str], FakeAnswer] = echo_answer,
+                 polls_to_complete: int = 2, latency: float = 0.0, poll_after_ms: int = 10,
+                 queued_polls: int = 0,
+                 stream_end: Literal["completed", "error", "requires_action", "cut"] = "completed"):
+        self.answer = answer
+        self.stream_end = stream_end
+        self.polls_to_complete = polls_to_complete
+        self.queued_polls = queued_polls
+        self.latency = latency
+        self.poll_after_ms = poll_after_ms
+        self.threads: dict[str, list[dict[str, Any]]] = {}
+        self.runs: dict[str, dict[str, Any]] = {}
+        self.files: dict[str, dict[str, Any]] = {}
+        self.vector_stores: dict[str, set[str]] = {}
+        self.file_batches: dict[str, dict[str, Any]] = {}
+        self.requests: list[tuple[str, str]] = []
+        self._lock = threading.Lock()
+        self._ids = count(1)
+
+    def client(self) -> OpenAI:
+        return OpenAI(api_key="fake", base_url=FAKE_BASE_URL, max_retries=0,
+                      http_client=httpx.Client(transport=httpx.MockTransport(self.handle)))
+
+    def async_client(self) -> AsyncOpenAI:
+        return AsyncOpenAI(api_key="fake", base_url=FAKE_BASE_URL, max_retries=0,
+                           http_client=httpx.AsyncClient(transport=httpx.MockTransport(self.handle_async)))
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        time.sleep(self.latency)
+        return self._route(request)
+
+    async def handle_async(self, request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(self.latency)
+        return self._route(request)
+
+    def _route(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.removeprefix("/v1")
+        is_json = request.headers.get("content-type", "").startswith("application/json")
+        body = json.loads(request.content) if request.content and is_json else dict(request.url.params)
+
+        with self._lock:
+            self.requests.append((request.method, path))
+            result = self._dispatch(request.method, path, body)
+        if isinstance(result, httpx.Response):
+            return result
+        return httpx.Response(200, json=result, headers={"openai-poll-after-ms": str(self.poll_after_ms)})
+
+    def _dispatch(self, request_method: str, path: str, body: dict) -> dict[str, Any] | httpx.Response:
+        for method, pattern, handler in self._routes():
+            match = re.fullmatch(pattern, path)
+            if match and method == request_method:
+                return handler(body, *match.groups())
+        return httpx.Response(404, json={"error": {"message": f"Unknown route {request_method} {path}"}})
+
+    def _routes(self) -> list[tuple[str, str, Callable[..., dict[str, Any] | httpx.Response]]]:
+        return [
+            ("GET", r"/assistants/([^/]+)", self._get_assistant),
+            ("POST", r"/threads", self._create_thread),
+            ("DELETE", r"/threads/([^/]+)", self._delete_thread),
+            ("POST", r"/threads/([^/]+)/messages", self._create_message),
+            ("GET", r"/threads/([^/]+)/messages", self._list_messages),
+            ("POST", r"/threads/([^/]+)/runs", self._create_run),
+            ("GET", r"/threads/([^/]+)/runs/([^/]+)", self._get_run),
+            ("POST", r"/threads/([^/]+)/runs/([^/]+)/cancel", self._cancel_run),
+            ("POST", r"/files", self._create_file),
+            ("DELETE", r"/files/([^/]+)", self._delete_file),
+            ("POST", r"/vector_stores/([^/]+)/files", self._create_vector_store_file),
+            ("DELETE", r"/vector_stores/([^/]+)/files/([^/]+)", self._delete_vector_store_file),
+            ("POST", r"/vector_stores/([^/]+)/file_batches", self._create_file_batch),
+            ("GET", r"/vector_stores/([^/]+)/file_batches/([^/]+)", self._get_file_batch),
+            ("GET", r"/vector_stores/([^/]+)/file_batches/([^/]+)/files", self._list_file_batch_files),
+        ]
+
+    def _new_id(self, prefix: str) -> str:
+        return f"{prefix}_{next(self._ids)}"
+
+    def _get_assistant(self, _: dict, assistant_id: str) -> dict[str, Any]:
+        return {"id": assistant_id, "object": "assistant", "created_at": 0, "model": "fake",
+                "tools": [{"type": "file_search"}]}
+
+    def _create_thread(self, body: dict) -> dict[str, Any]:
+        thread_id = self._new_id("thread")
+        self.threads[thread_id] = [self._message(thread_id, m["role"], m["content"], [])
+                                   for m in body.get("messages", [])]
+        return {"id": thread_id, "object": "thread", "created_at": int(time.time()),
+                "tool_resources": body.get("tool_resources", None)}
+
+    def _delete_thread(self, _: dict, thread_id: str) -> dict[str, Any]:
+        self.threads.pop(thread_id, None)
+        return {"id": thread_id, "object": "thread.deleted", "deleted": True}
+
+    def _message(self, thread_id: str, role: str, text: str,
+                 references: list[FileAnnotation]) -> dict[str, Any]:
+        annotations = [{
+            "type": "file_citation",
+            "text": r.text,
+            "file_citation": {"file_id": r.file_id},
+            "start_index": max(0, text.find(r.text)),
+            "end_index": max(0, text.find(r.text)) + len(r.text)} for r in references]
+        return {"id": self._new_id("msg"), "object": "thread.message", "created_at": int(time.time()),
+                "thread_id": thread_id, "role": role, "status": "completed",
+                "content": [{"type": "text", "text": {"value": text, "annotations": annotations}}]}
+
+    def _create_message(self, body: dict, thread_id: str) -> dict[str, Any]:
+        message = self._message(thread_id, body["role"], body["content"], [])
+        self.threads[thread_id].append(message)
+        return message
+
+    def _list_messages(self, _: dict, thread_id: str) -> dict[str, Any]:
+        messages = list(reversed(self.threads[thread_id]))
+        return {"object": "list", "data": messages, "has_more": False,
+                "first_id": messages[0]["id"] if messages else None,
+                "last_id": messages[-1]["id"] if messages else None}
+
+    def _create_run(self, body: dict, thread_id: str) -> dict[str, Any] | httpx.Response:
+        run = {"id": self._new_id("run"), "object": "thread.run", "created_at": int(time.time()),
+               "thread_id": thread_id, "assistant_id": body["assistant_id"], "status": "queued",
+               "polls": 0}
+        self.runs[run["id"]] = run
+        if body.get("stream", False):
+            return self._stream_run(run)
+        return run
+
+    def _stream_run(self, run: dict[str, Any]) -> httpx.Response:
+        """Runs to completion, answering with the server sent events of a streamed run.
+        The text is sent a word at a time and each citation in its own delta."""
+        events = [("thread.run.created", dict(run))]
+        run["status"] = "in_progress"
+        events.append(("thread.run.in_progress", dict(run)))
+
+        self._complete_run(run)
+        message = self.threads[run["thread_id"]][-1]
+        text = message["content"][0]["text"]
+        events.append(("thread.message.created", {**message, "status": "in_progress", "content": []}))
+
+        markers = [a["text"] for a in text["annotations"]]
+        pieces = re.split("(" + "|".join(map(re.escape, markers)) + ")", text["value"]) if markers else [text["value"]]
+        annotation_index = 0
+        for piece in pieces:
+            if piece in markers:
+                annotation = {**text["annotations"][markers.index(piece)], "index": annotation_index}
+                annotation_index += 1
+                chunks = [(piece, [annotation])]
+            else:
+                chunks = [(word, []) for word in re.findall(r"\S*\s*", piece) if word]
+            for chunk, annotations in chunks:
+                delta = {"index": 0, "type": "text", "text": {"value": chunk, "annotations": annotations}}
+                events.append(("thread.message.delta", {
+                    "id": message["id"], "object": "thread.message.delta", "delta": {"content": [delta]}}))
+
+        events.append(("thread.message.completed", message))
+        if self.stream_end == "completed":
+            events.append(("thread.run.completed", dict(run)))
+        elif self.stream_end == "error":
+            events.append(("error", {"code": "server_error", "message": "The server had an error", "type": "error"}))
+        elif self.stream_end == "requires_action":
+            run["status"] = "requires_action"
+            events.append(("thread.run.requires_action", dict(run)))
+
+        content = "".join(f"event: {event}\ndata: {json.dumps(data)}\n\n" for event, data in events)
+        content += "event: done\ndata: [DONE]\n\n"
+        return httpx.Response(200, content=content.encode(), headers={"content-type": "text/event-stream"})
+
+    def _get_run(self, _: dict, thread_id: str, run_id: str) -> dict[str, Any]:
+        run = self.runs[run_id]
+        if run["status"] in ("queued", "in_progress"):
+            run["polls"] += 1
+            if run["polls"] <= self.queued_polls:
+                pass
+            elif run["polls"] >= self.queued_polls + self.polls_to_complete:
+                self._complete_run(run)
+            else:
+                run["status"] = "in_progress"
+        return run
+
+    def _complete_run(self, run: dict[str, Any]):
+        question = next(m for m in reversed(self.threads[run["thread_id"]]) if m["role"] == "user")
+        answer = self.answer(question["content"][0]["text"]["value"])
+        self.threads[run["thread_id"]].append(
+            self._message(run["thread_id"], "assistant", answer.text, answer.references))
+        run["status"] = "completed"
+
+    def _cancel_run(self, _: dict, thread_id: str, run_id: str) -> dict[str, Any]:
+        run = self.runs[run_id]
+        run["status"] = "cancelled"
+        return run
+
+    def _create_file(self, _: dict) -> dict[str, Any]:
+        file = {"id": self._new_id("file"), "object": "file", "bytes": 0, "created_at": int(time.time()),
+                "filename": "file", "purpose": "assistants", "status": "processed"}
+        self.files[file["id"]] = file
+        return file
+
+    def _delete_file(self, _: dict, file_id: str) -> dict[str, Any]:
+        self.files.pop(file_id, None)
+        return {"id": file_id, "object": "file", "deleted": True}
+
+    def _vector_store_file(self, vector_store_id: str, file_id: str) -> dict[str, Any]:
+        return {"id": file_id, "object": "vector_store.file", "created_at": int(time.time()),
+                "vector_store_id": vector_store_id, "status": "completed", "usage_bytes": 0, "last_error": None}
+
+    def _create_vector_store_file(self, body: dict, vector_store_id: str) -> dict[str, Any]:
+        self.vector_stores.setdefault(vector_store_id, set()).add(body["file_id"])
+        return self._vector_store_file(vector_store_id, body["file_id"])
+
+    def _delete_vector_store_file(self, _: dict, vector_store_id: str, file_id: str) -> dict[str, Any]:
+        self.vector_stores.get(vector_store_id, set()).discard(file_id)
+        return {"id": file_id, "object": "vector_store.file.deleted", "deleted": True}
+
+    def _file_batch(self, batch_id: str) -> dict[str, Any]:
+        batch = self.file_batches[batch_id]
+        total = len(batch["file_ids"])
+        return {"id": batch_id, "object": "vector_store.files_batch", "created_at": batch["created_at"],
+                "vector_store_id": batch["vector_store_id"], "status": "completed",
+                "file_counts": {"in_progress": 0, "completed": total, "failed": 0, "cancelled": 0, "total": total}}
+
+    def _create_file_batch(self, body: dict, vector_store_id: str) -> dict[str, Any]:
+        self.vector_stores.setdefault(vector_store_id, set()).update(body["file_ids"])
+        batch_id = self._new_id("vsfb")
+        self.file_batches[batch_id] = {"vector_store_id": vector_store_id, "file_ids": body["file_ids"],
+                                       "created_at": int(time.time())}
+        return self._file_batch(batch_id)
+
+    def _get_file_batch(self, _: dict, vector_store_id: str, batch_id: str) -> dict[str, Any]:
+        return self._file_batch(batch_id)
+
+    def _list_file_batch_files(self, params: dict, vector_store_id: str, batch_id: str) -> dict[str, Any]:
+        """A page of `limit` files after the `after` cursor, as the client iterates them."""
+        file_ids = self.file_batches[batch_id]["file_ids"]
+        start = file_ids.index(params["after"]) + 1 if "after" in params else 0
+        end = start + int(params.get("limit", 20))
+        files = [self._vector_store_file(vector_store_id, file_id) for file_id in file_ids[start:end]]
+        return {"object": "list", "data": files, "has_more": end < len(file_ids),
+                "first_id": files[0]["id"] if files else None, "last_id": files[-1]["id"] if files else None}
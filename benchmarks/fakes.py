@@ -0,0 +1,179 @@
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import IO, Any, Iterator
+
+from pydantic import BaseModel
+
+
+class FakeLatency(BaseModel):
+    """Seconds added to every call to each service."""
+    sheets: float = 0.0
+    gcs: float = 0.0
+    openai: float = 0.0
+
+
+A1_RANGE = re.compile(r"(?P<sheet>[^!]+)!(?P<start_col>[A-Z]*)(?P<start_row>\d*)(?::(?P<end_col>[A-Z]*)(?P<end_row>\d*))?")
+
+
+def column_index(column: str) -> int:
+    index = 0
+    for letter in column:
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index - 1
+
+
+def column_letters(index: int) -> str:
+    letters = ""
+    index += 1
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+
+class FakeSheetService:
+    """In-memory SheetServiceFacade. Ranges are A1 notation on whole sheets of a
+    single spreadsheet, as the app uses them, and empty trailing rows are trimmed
+    from reads like the Sheets API does."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sheets: dict[str, list[list[Any]]] = {}
+        self.calls: Counter[str] = Counter()
+        self._lock = threading.Lock()
+
+    def _call(self, method: str):
+        self.calls[f"sheets.{method}"] += 1
+        time.sleep(self.latency)
+
+    @staticmethod
+    def _parse(range_: str) -> tuple[str, int, int, int | None, int | None]:
+        """Sheet name, first row and column (0 based), and last ones (inclusive, None for open ranges)."""
+        match = A1_RANGE.fullmatch(range_)
+        assert match is not None, f"Unsupported range {range_}"
+        start_row = int(match["start_row"]) - 1 if match["start_row"] else 0
+        start_col = column_index(match["start_col"]) if match["start_col"] else 0
+        end_row = int(match["end_row"]) - 1 if match["end_row"] else None
+        end_col = column_index(match["end_col"]) if match["end_col"] else None
+        if match["end_row"] is None and match["end_col"] is None:
+            end_row, end_col = start_row, start_col     # A single cell
+        return match["sheet"], start_row, start_col, end_row, end_col
+
+    def get(self, spreadsheet_id: str, range_: str) -> list[list[Any]]:
+        self._call("get")
+        sheet, start_row, start_col, end_row, end_col = self._parse(range_)
+        with self._lock:
+            rows = self.sheets.get(sheet, [])
+            end = len(rows) if end_row is None else end_row + 1
+            return [list(row[start_col:None if end_col is None else end_col + 1]) for row in rows[start_row:end]]
+
+    def _write(self, sheet: str, start_row: int, start_col: int, body: list[list[Any]]):
+        rows = self.sheets.setdefault(sheet, [])
+        for i, values in enumerate(body):
+            while len(rows) <= start_row + i:
+                rows.append([])
+            row = rows[start_row + i]
+            row.extend([""] * (start_col + len(values) - len(row)))
+            row[start_col:start_col + len(values)] = values
+
+    def update(self, spreadsheet_id: str, range_: str, body: list[list[Any]]):
+        self._call("update")
+        sheet, start_row, start_col, _, _ = self._parse(range_)
+        with self._lock:
+            self._write(sheet, start_row, start_col, body)
+
+    def batch_update(self, spreadsheet_id: str, data: dict[str, list[list[Any]]]):
+        self._call("batch_update")
+        with self._lock:
+            for range_, body in data.items():
+                sheet, start_row, start_col, _, _ = self._parse(range_)
+                self._write(sheet, start_row, start_col, body)
+
+    def append(self, spreadsheet_id: str, range_: str, body: list[list[Any]]) -> dict[str, Any]:
+        """Answers with the range written, like the Sheets API."""
+        self._call("append")
+        sheet, _, start_col, _, _ = self._parse(range_)
+        with self._lock:
+            start_row = len(self.sheets.get(sheet, []))
+            self._write(sheet, start_row, start_col, body)
+        end_col = start_col + max((len(values) for values in body), default=1) - 1
+        updated_range = (f"{sheet}!{column_letters(start_col)}{start_row + 1}:"
+                         f"{column_letters(end_col)}{start_row + len(body)}")
+        return {"updates": {"updatedRange": updated_range, "updatedRows": len(body)}}
+
+
+class FakeBlob:
+    """The google.cloud.storage.Blob fields and download methods the app uses."""
+
+    def __init__(self, bucket: 'FakeBucket', name: str, content: bytes, generation: int = 1,
+                 content_type: str = "application/pdf"):
+        self.bucket = bucket
+        self.name = name
+        self.id = f"{bucket.name}/{name}/{generation}"
+        self.content = content
+        self.content_type = content_type
+        self.generation = generation
+        self.updated = datetime(2024, 12, 21, tzinfo=timezone.utc)
+        self.md5_hash = None
+        self.crc32c = f"crc{generation}"
+        self.size = len(content)
+
+    def download_as_bytes(self) -> bytes:
+        self.bucket._call("download")
+        return self.content
+
+    def download_to_file(self, fp: IO[bytes]):
+        self.bucket._call("download")
+        fp.write(self.content)
+
+
+class FakeBlobsListing:
+    def __init__(self, pages: Iterator[list[FakeBlob]]):
+        self.pages = pages
+
+    def __iter__(self) -> Iterator[FakeBlob]:
+        for page in self.pages:
+            yield from page
+
+
+class FakeBucket:
+    """In-memory google.cloud.storage.Bucket, for a GCSBucketFacade. Listings come
+    in pages of `page_size` blobs, the latency is added per page and per download."""
+
+    def __init__(self, name: str = "bucket", latency: float = 0.0, page_size: int = 1000):
+        self.name = name
+        self.latency = latency
+        self.page_size = page_size
+        self.blobs: dict[str, FakeBlob] = {}
+        self.calls: Counter[str] = Counter()
+        self._lock = threading.Lock()
+
+    def _call(self, method: str):
+        with self._lock:
+            self.calls[f"gcs.{method}"] += 1
+        time.sleep(self.latency)
+
+    def add(self, name: str, content: bytes, generation: int = 1) -> FakeBlob:
+        self.blobs[name] = FakeBlob(self, name, content, generation)
+        return self.blobs[name]
+
+    def list_blobs(self, prefix: str = "", fields: str | None = None) -> FakeBlobsListing:
+        blobs = [blob for name, blob in sorted(self.blobs.items()) if name.startswith(prefix)]
+        pages = [blobs[i:i + self.page_size] for i in range(0, len(blobs), self.page_size)]
+
+        def page(blobs_page: list[FakeBlob]) -> list[FakeBlob]:
+            self._call("list_page")
+            return blobs_page
+
+        return FakeBlobsListing(page(p) for p in pages)
+
+    def blob(self, name: str) -> FakeBlob:
+        return self.blobs[name]
+
+
+def fake_file_content(i: int, size: int) -> bytes:
+    header = f"file {i}\n".encode()
+    return header + b"x" * max(0, size - len(header))
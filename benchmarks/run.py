@@ -0,0 +1,276 @@
+"""Offline benchmarks of the app's hot paths, on fakes of OpenAI, Sheets and GCS.
+
+    python -m benchmarks.run --output benchmarks/results/$(git rev-parse --short HEAD).json
+    python -m benchmarks.compare benchmarks/results/old.json benchmarks/results/new.json
+
+Run from the project root. Timings exclude the setup of the fakes."""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from itertools import count
+from pathlib import Path
+from typing import Callable
+
+import httpx
+from pydantic import BaseModel
+
+from benchmarks.fake_assistant import FakeAssistantServer
+from benchmarks.fakes import FakeBucket, FakeLatency, FakeSheetService, fake_file_content
+from ingestion.db_manager import VectorStoreFileInfo, VectorStoreFilesDB, file_info_row
+from ingestion.manager import IngestionManager, PipelineConfig, SourcesDifferences
+from ingestion.sync_plan import plan_data_version
+from model.answers_generation import FileAnnotation, LLMAnswer, MarkdownAnswer, OpenAIConfig, QuestionsAnswers
+from model.feedback.feedback import COLUMNS_MAPPING, FeedbackLogsConfig, QueuedLogWriter, SheetLogWriter, TestLog
+from model.files.gcs import GCSFile
+from model.files_manager import SheetFilesDB
+from utils.drive_utils import DRIVE_TOKEN_TEMPLATE, DriveConfig, DriveCredentials, ServiceGenerator
+from utils.gcs_utils import GCSBucketFacade
+from utils.openai_limiter import OpenAILimitsConfig
+from utils.services import ServiceRegistry
+
+
+SPREADSHEET_ID = "benchmark"
+FOLDER = "V_bench"
+VECTOR_STORE_ID = "vs_bench"
+ASSISTANT_ID = "asst_bench"
+DRIVE_CONFIG = DriveConfig(DRIVE_CLIENT_ID="client", DRIVE_PROJECT_ID="project", CLIENT_SECRET="secret",
+                           DRIVE_TOKEN="token", DRIVE_REFRESH_TOKEN="refresh")
+_sheet_ids = count(1)
+
+
+class BenchmarkConfig(BaseModel):
+    sizes: list[int] = [100, 1000, 10000]
+    sessions: list[int] = [1, 10, 50]   # Sizes of the session benchmarks, which don't depend on the files
+    repeat: int = 3
+    latency: FakeLatency = FakeLatency()
+    file_size: int = 1024       # Bytes per source file
+    references: int = 10        # Citations per rendered answer
+
+
+class BenchmarkResult(BaseModel):
+    benchmark: str
+    size: int
+    best_seconds: float
+    median_seconds: float
+    per_item_ms: float          # Best time per file (or log, or session)
+    calls: dict[str, int]       # Calls to the fake services in one run
+
+
+class BenchmarkRun(BaseModel):
+    commit: str | None
+    created_at: datetime
+    python: str
+    config: BenchmarkConfig
+    results: list[BenchmarkResult]
+
+    def result(self, benchmark: str, size: int) -> BenchmarkResult | None:
+        return next((r for r in self.results if r.benchmark == benchmark and r.size == size), None)
+
+
+# A benchmark sets up its fakes for `size` files and returns the run to time,
+# which returns the calls made to the fakes
+Benchmark = Callable[[int, BenchmarkConfig], Callable[[], Counter[str]]]
+
+
+def vs_file(i: int, generation: int = 1) -> VectorStoreFileInfo:
+    return VectorStoreFileInfo(
+        id=f"file_{i}", source_file_id=f"doc_{i}", source_type="gcs", folder_id=f"bucket/{FOLDER}",
+        last_modified=datetime(2024, 12, 21, tzinfo=timezone.utc), status="ok",
+        source_id=f"bucket/{FOLDER}/doc_{i}", content_hash=f"crc32c:crc{generation}", generation=generation)
+
+
+def files_db_with(sheets: FakeSheetService, files: list[VectorStoreFileInfo]) -> VectorStoreFilesDB:
+    """A files DB on a new sheet, the ids mapping caches are shared by every files DB of the same sheet."""
+    sheet_name = f"{FOLDER}_{next(_sheet_ids)}"
+    sheets.sheets[sheet_name] = [["id"]] + [file_info_row(f) for f in files]
+    return VectorStoreFilesDB(sheets, SPREADSHEET_ID, sheet_name, VECTOR_STORE_ID)
+
+
+def answer_rendering(size: int, config: BenchmarkConfig, cold: bool) -> Callable[[], Counter[str]]:
+    """MarkdownAnswer of an answer citing `references` of `size` files. Cold runs load the ids mapping first."""
+    sheets = FakeSheetService(config.latency.sheets)
+    files_db = files_db_with(sheets, [vs_file(i) for i in range(size)])
+    markers = [f"【4:{i}†source】" for i in range(config.references)]
+    answer = LLMAnswer(
+        answer=" ".join(f"Paso {i}{marker}" for i, marker in enumerate(markers)),
+        references=[FileAnnotation(text=marker, file_id=f"file_{i * size // config.references}")
+                    for i, marker in enumerate(markers)],
+        thread_id="thread_1", run_id="run_1")
+    files_manager = SheetFilesDB(files_db)
+    if not cold:
+        files_manager.ids_mapping.refresh()
+
+    def run() -> Counter[str]:
+        if cold:
+            files_manager.ids_mapping.invalidate()
+        sheets.calls.clear()
+        MarkdownAnswer.from_llm_answer(answer, files_manager)
+        return sheets.calls
+    return run
+
+
+def sync_diffing(size: int, config: BenchmarkConfig) -> Callable[[], Counter[str]]:
+    """Full listing plan of a folder of `size` files: a quarter new, a quarter updated,
+    half unchanged, and `size / 4` rows of deleted files."""
+    sheets = FakeSheetService(config.latency.sheets)
+    bucket = FakeBucket(latency=config.latency.gcs)
+    for i in range(size):
+        bucket.add(f"{FOLDER}/doc_{i}.pdf", b"", generation=2 if i % 4 == 1 else 1)
+    files = [vs_file(i) for i in range(size) if i % 4 != 0] + [vs_file(size + i) for i in range(size // 4)]
+    files_db = files_db_with(sheets, files)
+    snapshots_path = Path(tempfile.mkdtemp())
+
+    def run() -> Counter[str]:
+        sheets.calls.clear()
+        bucket.calls.clear()
+        plan = plan_data_version(GCSBucketFacade(bucket), files_db, FOLDER, snapshots_path, full_listing=True)
+        assert len(plan.differences.new_files) == len(range(0, size, 4))
+        return sheets.calls + bucket.calls
+    return run
+
+
+def ingestion_throughput(size: int, config: BenchmarkConfig) -> Callable[[], Counter[str]]:
+    """Sync of `size` new files, with the pipeline settings of config.toml."""
+    sheets = FakeSheetService(config.latency.sheets)
+    bucket = FakeBucket(latency=config.latency.gcs)
+    files = [GCSFile.from_blob(bucket.add(f"{FOLDER}/doc_{i}.pdf", fake_file_content(i, config.file_size)))
+             for i in range(size)]
+    files_db = files_db_with(sheets, [])
+    server = FakeAssistantServer(latency=config.latency.openai)
+    manager = IngestionManager(server.client(), files_db)
+    pipeline_config = PipelineConfig(attach_batch_size=50, write_buffer_delay=0.5, retry_delay=0.01)
+
+    def run() -> Counter[str]:
+        report = manager.sync(SourcesDifferences(new_files=files), GCSBucketFacade(bucket), pipeline_config)
+        assert len(report.ingested) == size, report.failures[:3]
+        openai_calls = Counter(f"openai.{method} {path.split('/')[1]}" for method, path in server.requests)
+        return sheets.calls + bucket.calls + openai_calls
+    return run
+
+
+def feedback_writes(size: int, config: BenchmarkConfig) -> Callable[[], Counter[str]]:
+    """`size` feedback logs written through the queued sheet writer, until flushed."""
+    sheets = FakeSheetService(config.latency.sheets)
+    sheets.sheets["Logs"] = [list(COLUMNS_MAPPING)]
+    logs_config = FeedbackLogsConfig(spreadsheet_id=SPREADSHEET_ID, sheet_name="Logs")
+    logs = [TestLog(user="user", version="v16", question=f"question {i}", answer="answer", was_solved="Yes",
+                    shared_sources="No", sources=None, was_detailed="Yes", note=None, thread_id="thread_1",
+                    run_id="run_1") for i in range(size)]
+
+    def run() -> Counter[str]:
+        writer = QueuedLogWriter(SheetLogWriter(sheets, logs_config), logs_config.max_batch, logs_config.max_delay)
+        for log in logs:
+            writer.write(log)
+        writer.close()
+        return sheets.calls
+    return run
+
+
+def drive_token_file() -> Path:
+    """A saved token of DRIVE_CONFIG valid for an hour, so the credentials aren't refreshed."""
+    expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=1)
+    token = {**DRIVE_TOKEN_TEMPLATE, "token": DRIVE_CONFIG.DRIVE_TOKEN, "refresh_token": DRIVE_CONFIG.DRIVE_REFRESH_TOKEN,
+             "client_id": DRIVE_CONFIG.DRIVE_CLIENT_ID, "client_secret": DRIVE_CONFIG.CLIENT_SECRET,
+             "expiry": expiry.isoformat() + "Z"}
+    token_file = Path(tempfile.mkdtemp()) / "token.json"
+    token_file.write_text(json.dumps(token), encoding="utf8")
+    return token_file
+
+
+def session_startup(size: int, config: BenchmarkConfig, shared: bool) -> Callable[[], Counter[str]]:
+    """`size` cold sessions getting the clients of a page: the OpenAI client, the assistant and
+    the Sheets service. Shared sessions get them from the process registry, the others build
+    their own, as every session did before the registry."""
+    server = FakeAssistantServer(latency=config.latency.openai)
+    server.client().beta.assistants.retrieve(ASSISTANT_ID)
+    server.requests.clear()
+    token_file = drive_token_file()
+
+    def run() -> Counter[str]:
+        registry = ServiceRegistry(DRIVE_CONFIG, OpenAIConfig(OPENAI_API_KEY="fake", OPENAI_ORG_ID="org"),
+                                   token_file, httpx.MockTransport(server.handle))
+        for _ in range(size):
+            if shared:
+                registry.questions_answers(ASSISTANT_ID, limits=OpenAILimitsConfig(enabled=False))
+                registry.sheet_service()
+            else:
+                QuestionsAnswers(server.client(), ASSISTANT_ID)
+                ServiceGenerator(DriveCredentials(DRIVE_CONFIG, token_file)).get_sheet_service()
+        return Counter(f"openai.{method} {path.split('/')[1]}" for method, path in server.requests)
+    return run
+
+
+BENCHMARKS: dict[str, Benchmark] = {
+    "answer_rendering_cold": lambda size, config: answer_rendering(size, config, cold=True),
+    "answer_rendering_warm": lambda size, config: answer_rendering(size, config, cold=False),
+    "sync_diffing": sync_diffing,
+    "ingestion_throughput": ingestion_throughput,
+    "feedback_writes": feedback_writes,
+    "session_startup_per_session": lambda size, config: session_startup(size, config, shared=False),
+    "session_startup_shared": lambda size, config: session_startup(size, config, shared=True),
+}
+SESSION_BENCHMARKS = {"session_startup_per_session", "session_startup_shared"}
+
+
+def run_benchmark(name: str, size: int, config: BenchmarkConfig) -> BenchmarkResult:
+    seconds = []
+    calls: Counter[str] = Counter()
+    for _ in range(config.repeat):
+        run = BENCHMARKS[name](size, config)
+        start = time.perf_counter()
+        calls = run()
+        seconds.append(time.perf_counter() - start)
+    return BenchmarkResult(benchmark=name, size=size, best_seconds=min(seconds),
+                           median_seconds=statistics.median(seconds), per_item_ms=min(seconds) / size * 1000,
+                           calls=dict(sorted(calls.items())))
+
+
+def current_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(config: BenchmarkConfig, names: list[str] | None = None) -> BenchmarkRun:
+    results = []
+    for name in names or list(BENCHMARKS):
+        for size in config.sessions if name in SESSION_BENCHMARKS else config.sizes:
+            result = run_benchmark(name, size, config)
+            print(f"{name} [{size}]: {result.best_seconds:.3f} s ({result.per_item_ms:.3f} ms per item)")
+            results.append(result)
+    return BenchmarkRun(commit=current_commit(), created_at=datetime.now(timezone.utc),
+                        python=platform.python_version(), config=config, results=results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the offline benchmarks.")
+    parser.add_argument("--output", type=Path, help="JSON file for the results")
+    parser.add_argument("--sizes", type=int, nargs="+", default=BenchmarkConfig().sizes)
+    parser.add_argument("--sessions", type=int, nargs="+", default=BenchmarkConfig().sessions)
+    parser.add_argument("--repeat", type=int, default=BenchmarkConfig().repeat)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="Benchmarks to run, all by default")
+    parser.add_argument("--sheets-latency", type=float, default=0.0, help="Seconds per Sheets call")
+    parser.add_argument("--gcs-latency", type=float, default=0.0, help="Seconds per GCS call")
+    parser.add_argument("--openai-latency", type=float, default=0.0, help="Seconds per OpenAI request")
+    args = parser.parse_args()
+
+    config = BenchmarkConfig(
+        sizes=args.sizes, sessions=args.sessions, repeat=args.repeat,
+        latency=FakeLatency(sheets=args.sheets_latency, gcs=args.gcs_latency, openai=args.openai_latency))
+    benchmark_run = run_benchmarks(config, args.only)
+    if args.output is not None:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(benchmark_run.model_dump_json(indent=2), encoding="utf8")
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,19 @@
 import os
+from contextlib import nullcontext
 
-from openai import OpenAI
 import streamlit as st
 from pydantic import BaseModel
 import tomli
 
-from model.feedback.feedback import TestLog, SheetLogWriter, YesNoPartially
+from model.feedback.feedback import TestLog, YesNoPartially
 from model.files_manager import SheetFilesDB
-from model.answers_generation import MarkdownAnswer, OpenAIConfig, QuestionsAnswers
-from ingestion.db_manager import VectorStoreFilesDB
-from utils.streamlit_utils import AppConfig
+from model.answers_generation import MarkdownAnswer, OpenAIConfig, QuestionsAnswers, QuestionsAnswersI
+from model.run_polling import RunTimeoutError
+from utils.streamlit_utils import AppConfig, answer_trace, cached_answers_model, get_files_db
 from utils.config_utils import load_environment_config, load_toml_config
-from utils.drive_utils import DriveCredentials, DriveConfig, get_sheet_service
-from defaults import DEFAULT_CONFIG_FILE
+from utils.drive_utils import DriveConfig
+from utils.services import StartupTimer, get_service_registry
+from defaults import ANSWERS_CACHE_FILE, DEFAULT_CONFIG_FILE, DRIVE_TOKEN_CACHE_FILE, FEEDBACK_LOGS_FILE, FILES_DB_FILE
 
 
 class StreamlitConfig(BaseModel):
@@ -22,10 +23,14 @@ class StreamlitConfig(BaseModel):
 streamlit_config: StreamlitConfig = load_environment_config(StreamlitConfig, os.getenv)
 openai_config: OpenAIConfig = load_environment_config(OpenAIConfig, os.getenv)
 drive_config: DriveConfig = load_environment_config(DriveConfig, os.getenv)
+services = get_service_registry(drive_config, openai_config, DRIVE_TOKEN_CACHE_FILE)
 
 
 st.set_page_config(layout="wide")
 
+if "startup_timer" not in st.session_state:
+    st.session_state.startup_timer = StartupTimer("Streamlit_APP")
+
 if "app_config" not in st.session_state:
     st.session_state.app_config = load_toml_config(AppConfig, DEFAULT_CONFIG_FILE)
 
@@ -34,32 +39,28 @@ if 'answer' not in st.session_state:
 if 'submitted' not in st.session_state:
     st.session_state.submitted = False
 
-if 'answer_model' not in st.session_state:
-    _app_config: AppConfig = st.session_state.app_config
-    # noinspection PyTypeHints
-    openai_client = OpenAI(api_key=openai_config.OPENAI_API_KEY, organization=openai_config.OPENAI_ORG_ID)
-    st.session_state.answer_model = QuestionsAnswers(openai_client, _app_config.assistant.id)
-
 
 FilesManagersDict = dict[str, SheetFilesDB]
 
 
 if 'files_managers' not in st.session_state:
     _app_config: AppConfig = st.session_state.app_config
-    sheet_service = get_sheet_service(drive_config)
     files_managers: FilesManagersDict = {}
     for data_version in _app_config.vector_stores.data_versions:
-        vs = VectorStoreFilesDB(
-            sheet_service,
-            _app_config.vector_stores.spreadsheet_id,
-            data_version.sheet_name,
-            data_version.vector_store_id)
-        files_managers[data_version.version] = SheetFilesDB(vs)
+        vs = get_files_db(services, _app_config.vector_stores, data_version, FILES_DB_FILE, _app_config.sheets)
+        files_managers[data_version.version] = SheetFilesDB(vs, services.ids_mapping_cache(vs))
     st.session_state.files_managers = files_managers
 
-if 'drive_credentials' not in st.session_state:
+if 'answer_model' not in st.session_state:
+    _app_config: AppConfig = st.session_state.app_config
     # noinspection PyTypeHints
-    st.session_state.drive_credentials = DriveCredentials(drive_config)
+    st.session_state.answer_model = cached_answers_model(
+        services.questions_answers(_app_config.assistant.id, _app_config.run_polling, _app_config.openai_limits),
+        _app_config,
+        list(st.session_state.files_managers.values()),
+        ANSWERS_CACHE_FILE,
+        services)
+
 if 'streamlit_config' not in st.session_state:
     # noinspection PyTypeHints
     st.session_state.streamlit_config = streamlit_config
@@ -72,17 +73,29 @@ def generate_answer():
     question: str = st.session_state.question
     version: str = st.session_state.version
     files_managers: FilesManagersDict = st.session_state.files_managers
-    answer_model: QuestionsAnswers = st.session_state.answer_model
+    answer_model: QuestionsAnswersI = st.session_state.answer_model
     vector_store_id = files_managers[version].files_db.vector_store_id
-    answer = answer_model.answer(question, vector_store_id)
-
-    markdown_answer = MarkdownAnswer.from_llm_answer(answer, files_managers[version])
+    app_config: AppConfig = st.session_state.app_config
+    trace = answer_trace(services, app_config.tracing)
+    try:
+        with trace or nullcontext():
+            answer = answer_model.answer(question, vector_store_id)
+            markdown_answer = MarkdownAnswer.from_llm_answer(answer, files_managers[version])
+    except RunTimeoutError as e:
+        print(e)
+        st.session_state.answer = None
+        st.error("El asistente no respondió a tiempo, intente de nuevo en unos minutos.")
+        return
+
+    if trace is not None:
+        markdown_answer.timings = trace.timings()
     st.session_state.answer = markdown_answer
 
 
 def main():
 
     password = st.text_input("Password", key="password")
+    st.session_state.startup_timer.report()
     if password != st.session_state.streamlit_config.STREAMLIT_PASSWORD:
         st.stop()
 
@@ -127,14 +140,14 @@ def main():
                 was_detailed=was_detailed,
                 note=note if note != "" else None,
                 thread_id=answer.thread_id,
-                run_id=answer.run_id
+                run_id=answer.run_id,
+                timings=answer.timings if app_config.tracing.log_timings and answer.timings else None
             )
 
             if st.form_submit_button("Submit"):
-                sheet_service = get_sheet_service(drive_config)
-                # noinspection PyTypeHints
-                st.session_state.log_writer = SheetLogWriter(sheet_service, app_config.feedback_logs)
-                st.session_state.log_writer.write(test_log)
+                log_writer = services.feedback_log_writer(app_config.feedback_logs, FEEDBACK_LOGS_FILE,
+                                                          app_config.sheets)
+                log_writer.write(test_log)
                 st.success("Submitted")
 
 
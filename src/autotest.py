@@ -1,34 +1,45 @@
+"""Answer the autotest questions with the assistant and save the answers.
+
+    python autotest.py v16 [--workers 4] [--requests-per-minute 30]"""
+import argparse
 import json
+from pathlib import Path
 
 import pandas as pd
-from tqdm import tqdm
-from pydantic import BaseModel
 
-from defaults import DEFAULT_ENV_FILE
+from defaults import DEFAULT_CONFIG_FILE, DEFAULT_ENV_FILE, DRIVE_TOKEN_CACHE_FILE, FILES_DB_FILE
 from model.answers_generation import MarkdownAnswer, OpenAIConfig, QuestionsAnswers
 
-from ingestion.db_manager import VectorStoreFilesDB
 from model.files_manager import SheetFilesDB
-from autotest.db_manager import SheetManager
-from src.utils.config_utils import DotEnvConfigGenerator, load_environment_config
-from utils.drive_utils import DriveConfig, get_document_id, get_sheet_service
+from autotest.db_manager import Question, SheetManager
+from autotest.runner import AutotestExample, AutotestRunner
+from utils.config_utils import DotEnvConfigGenerator, load_environment_config, load_toml_config
+from utils.drive_utils import DriveConfig, get_document_id
+from utils.services import get_service_registry
+from utils.streamlit_utils import AppConfig, get_files_db
 
 
-class AutotestExample(BaseModel):
-    question_id: int
-    question: str
-    gold_document_id: str
-    assistant_id: str
-    answer: str
-    answer_sources_ids: list[str]
+CHECKPOINT_FILE = Path("answers.jsonl")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Answer the autotest questions with the assistant.")
+    parser.add_argument("data_version", help="Version of the vector store to answer with, e.g. v16")
+    parser.add_argument("--workers", type=int, default=4, help="Questions answered at the same time")
+    parser.add_argument("--requests-per-minute", type=int, default=30, help="Questions started per minute")
+    args = parser.parse_args()
+
     file_config_generator = DotEnvConfigGenerator(DEFAULT_ENV_FILE)
     drive_config: DriveConfig = load_environment_config(DriveConfig, file_config_generator.getenv)
-    sheet_service = get_sheet_service(drive_config)
-
     openai_config: OpenAIConfig = load_environment_config(OpenAIConfig, file_config_generator.getenv)
+    app_config = load_toml_config(AppConfig, DEFAULT_CONFIG_FILE)
+    services = get_service_registry(drive_config, openai_config, DRIVE_TOKEN_CACHE_FILE)
+    sheet_service = services.sheet_service(app_config.sheets)
+
+    data_versions = {v.version: v for v in app_config.vector_stores.data_versions}
+    if args.data_version not in data_versions:
+        parser.error(f"Unknown data version {args.data_version}, expected one of {', '.join(data_versions)}")
+    data_version = data_versions[args.data_version]
 
     spreadsheet_id = '1Ax7kL_8lvBWSWQlNAtVrHAUNX_9Ep9gn04FNGXJSob0'
     sheet_name = 'Hoja 2'
@@ -36,41 +47,40 @@ def main():
     sheet_manager = SheetManager(sheet_service, spreadsheet_id, sheet_name)
     questions = sheet_manager.get_questions()
 
-    DB_SPREADSHEET_ID = "1XAhPXBsAecJUiyI13l6qtiI-iuITA4XjyDI11BLmGDo"
-    DB_SHEET_NAME = "VectorStore"
-
-    vs_files_db = VectorStoreFilesDB(sheet_service,
-                                     DB_SPREADSHEET_ID,
-                                     DB_SHEET_NAME,
-                                     openai_config.VECTOR_STORE_ID)
+    vs_files_db = get_files_db(services, app_config.vector_stores, data_version, FILES_DB_FILE, app_config.sheets)
     files_manager = SheetFilesDB(vs_files_db)
+    # Loaded up front, before the runner threads need it
+    files_manager.ids_mapping.refresh()
 
     vs_files = vs_files_db.get_all()
     vs_files_df = pd.DataFrame([file.model_dump() for file in vs_files])
-    
+
     filtered_questions = []
     for q in questions:
         if q.gold_document_id not in vs_files_df['source_id'].values:
             print(f"Missing source file: {q.gold_document_id}")
         else:
             filtered_questions.append(q)
-    
-    qa = QuestionsAnswers(openai_config)
 
-    answers: list[AutotestExample] = []
-    for q in tqdm(filtered_questions):
-        llm_answer = qa.answer(q.question)
+    # A batch job, its runs leave room in the rate limits for the chat
+    openai_client = services.openai_client("background", app_config.openai_limits)
+    qa = QuestionsAnswers(openai_client, app_config.assistant.id, app_config.run_polling)
+
+    def answer_question(q: Question) -> AutotestExample:
+        llm_answer = qa.answer(q.question, data_version.vector_store_id)
         markdown_answer = MarkdownAnswer.from_llm_answer(llm_answer, files_manager)
-        autotest_example = AutotestExample(
+        return AutotestExample(
             question_id=q.id,
             question=q.question,
             gold_document_id=q.gold_document_id,
-            assistant_id=openai_config.VECTOR_STORE_ID,
+            assistant_id=app_config.assistant.id,
             answer=llm_answer.answer,
             answer_sources_ids=[get_document_id(r) for r in markdown_answer.references_urls]
         )
-        answers.append(autotest_example)
-    
+
+    runner = AutotestRunner(answer_question, CHECKPOINT_FILE, args.workers, args.requests_per_minute)
+    answers = sorted(runner.run(filtered_questions), key=lambda a: a.question_id)
+
     with open('answers.json', 'w', encoding="utf8") as f:
         json.dump([a.model_dump() for a in answers], f, indent=4)
 
@@ -0,0 +1,110 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+
+from openai import RateLimitError
+from pydantic import BaseModel
+from tqdm import tqdm
+
+from autotest.db_manager import Question
+
+
+class AutotestExample(BaseModel):
+    question_id: int
+    question: str
+    gold_document_id: str
+    assistant_id: str
+    answer: str
+    answer_sources_ids: list[str]
+
+
+AnswerQuestion = Callable[[Question], AutotestExample]
+
+
+class RateLimiter:
+    """Shared pacing for the runner workers.
+    Spaces request starts to respect `requests_per_minute` and, after a rate limit
+    error, pauses every worker until the suggested time has passed."""
+
+    def __init__(self, requests_per_minute: int | None = None):
+        self.interval = 60 / requests_per_minute if requests_per_minute else 0.0
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+        time.sleep(max(0.0, start - now))
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._next_start = max(self._next_start, time.monotonic() + seconds)
+
+
+def retry_after(error: RateLimitError, default: float) -> float:
+    value = error.response.headers.get("retry-after", None)
+    try:
+        return float(value) if value is not None else default
+    except ValueError:
+        return default
+
+
+class AutotestRunner:
+    """Answers the autotest questions with concurrent workers.
+
+    Every answer is appended to a JSONL checkpoint as soon as it is ready, so a rerun
+    with the same checkpoint only answers the questions that are missing."""
+
+    def __init__(self, answer_question: AnswerQuestion, checkpoint_file: Path,
+                 workers: int = 4, requests_per_minute: int | None = None,
+                 max_retries: int = 5, retry_delay: float = 5.0):
+        self.answer_question = answer_question
+        self.checkpoint_file = checkpoint_file
+        self.workers = workers
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self._checkpoint_lock = threading.Lock()
+
+    def load_checkpoint(self) -> list[AutotestExample]:
+        if not self.checkpoint_file.exists():
+            return []
+        with open(self.checkpoint_file, "r", encoding="utf8") as f:
+            return [AutotestExample.model_validate_json(line) for line in f if line.strip()]
+
+    def run(self, questions: list[Question]) -> list[AutotestExample]:
+        """Answers the missing questions and returns every answer in the checkpoint."""
+        answered_ids = {example.question_id for example in self.load_checkpoint()}
+        pending = [q for q in questions if q.id not in answered_ids]
+        print(f"Questions: {len(questions)}, already answered: {len(questions) - len(pending)}")
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(tqdm(executor.map(self._answer, pending), total=len(pending)))
+
+        return self.load_checkpoint()
+
+    def _answer(self, question: Question) -> bool:
+        attempt = 0
+        while True:
+            self.rate_limiter.wait()
+            try:
+                example = self.answer_question(question)
+                break
+            except RateLimitError as e:
+                if attempt >= self.max_retries:
+                    print(f"Error: rate limited answering question {question.id}: {e}")
+                    return False
+                self.rate_limiter.pause(retry_after(e, self.retry_delay * 2 ** attempt))
+                attempt += 1
+            except Exception as e:
+                print(f"Error: failed to answer question {question.id}: {e}")
+                return False
+
+        with self._checkpoint_lock:
+            with open(self.checkpoint_file, "a", encoding="utf8") as f:
+                f.write(example.model_dump_json() + "\n")
+        return True
@@ -8,6 +8,12 @@ DEFAULT_ENV_FILE = PROJECT_PATH / ".env"
 DEFAULT_CONFIG_FILE = CORE_PATH / "configs" / "config.toml"
 DRIVE_CREDENTIALS_FILE = PROJECT_PATH / "drive_credentials.json"
 DRIVE_TOKEN_FILE = PROJECT_PATH / "drive_token.json"
+DRIVE_TOKEN_CACHE_FILE = PROJECT_PATH / "drive_token_cache.json"
+FILES_REGISTRY_FILE = PROJECT_PATH / "files_registry.db"
+ANSWERS_CACHE_FILE = PROJECT_PATH / "answers_cache.db"
+FILES_DB_FILE = PROJECT_PATH / "files_db.db"
+FEEDBACK_LOGS_FILE = PROJECT_PATH / "feedback_logs.jsonl"
+GCS_SNAPSHOTS_PATH = PROJECT_PATH / "gcs_snapshots"
 
 DEV_ENV_FILE = PROJECT_PATH / "dev.env"
 DEV_CONFIG_FILE = CORE_PATH / "configs" / "config.dev.toml"
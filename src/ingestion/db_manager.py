@@ -1,5 +1,7 @@
+import threading
 from datetime import datetime
-from typing import Literal
+from pathlib import Path
+from typing import Literal, Protocol
 
 from pydantic import BaseModel
 
@@ -13,6 +15,11 @@ FileSources = Literal["drive", "gcs"]
 FileStatus = Literal["ok", "updated", "deleted"]
 
 
+# Sheet columns, rows written before the checksum columns were added have only the first 7
+FILES_DB_COLUMNS = ["A", "B", "C", "D", "E", "F", "G", "H", "I"]
+FILES_DB_LAST_COLUMN = FILES_DB_COLUMNS[-1]
+
+
 class VectorStoreFileInfo(BaseModel):
     """Represents a file in the VectorStore database.
     Has information on both the OpenAI vector store file and 
@@ -25,6 +32,57 @@ class VectorStoreFileInfo(BaseModel):
     last_modified: datetime     # Last modified time of the file
     status: FileStatus          # Status of the file in the VectorStore
     source_id: str              # Source file id (full file path)
+    content_hash: str | None = None  # Checksum of the source file content
+    generation: int | None = None    # GCS generation of the source file
+
+    @classmethod
+    def from_row(cls, row: list[str]) -> 'VectorStoreFileInfo':
+        row = row + [""] * (len(FILES_DB_COLUMNS) - len(row))
+        return cls(
+            id=row[0], 
+            source_file_id=row[1], 
+            source_type=row[2],                                 # type: ignore
+            folder_id=row[3], 
+            last_modified=datetime.fromisoformat(row[4]),
+            status=row[5],                                      # type: ignore
+            source_id=row[6],
+            content_hash=row[7] or None,
+            generation=int(row[8]) if row[8] else None)
+
+
+def file_info_row(file_info: VectorStoreFileInfo) -> list[str]:
+    return [
+        file_info.id, 
+        file_info.source_file_id, 
+        file_info.source_type, 
+        file_info.folder_id, 
+        str(file_info.last_modified),
+        file_info.status,
+        file_info.source_id,
+        file_info.content_hash or "",
+        str(file_info.generation) if file_info.generation is not None else ""]
+
+
+class VectorStoreFilesDBI(Protocol):
+    """Where the files of a vector store are tracked, one per data version."""
+    vector_store_id: str
+    sheet_name: str
+
+    def write(self, file_info: VectorStoreFileInfo): ...
+
+    def write_many(self, files_info: list[VectorStoreFileInfo]): ...
+
+    def write_buffer(self, max_rows: int = 50, max_delay: float = 5.0) -> 'FilesWriteBuffer': ...
+
+    def get_ids_mapping(self) -> dict[str, str]: ...
+
+    def get_all(self) -> list[VectorStoreFileInfo]: ...
+
+    def get_all_rows(self) -> list[VectorStoreFileInfo]: ...
+
+    def update_status(self, file_info: VectorStoreFileInfo, status: FileStatus): ...
+
+    def update_statuses(self, updates: list[tuple[VectorStoreFileInfo, FileStatus]]) -> list[VectorStoreFileInfo]: ...
 
 
 class VectorStoreFilesDB(DriveSheetManager):
@@ -37,15 +95,19 @@ class VectorStoreFilesDB(DriveSheetManager):
         self.vector_store_id = vector_store_id
     
     def write(self, file_info: VectorStoreFileInfo):
-        next_row = self.next_row()
-        self.write_row(next_row, [
-            file_info.id, 
-            file_info.source_file_id, 
-            file_info.source_type, 
-            file_info.folder_id, 
-            str(file_info.last_modified),
-            file_info.status,
-            file_info.source_id])
+        self.write_many([file_info])
+
+    def write_many(self, files_info: list[VectorStoreFileInfo]):
+        """Appends all the rows with a single call."""
+        if len(files_info) == 0:
+            return
+        self.service.append(
+            spreadsheet_id=self.spreadsheet_id,
+            range_=f"{self.sheet_name}!A:{FILES_DB_LAST_COLUMN}",
+            body=[file_info_row(file_info) for file_info in files_info])
+
+    def write_buffer(self, max_rows: int = 50, max_delay: float = 5.0) -> 'FilesWriteBuffer':
+        return FilesWriteBuffer(self, max_rows, max_delay)
     
     def get_ids_mapping(self) -> dict[str, str]:
         result = self.service.get(
@@ -65,30 +127,140 @@ class VectorStoreFilesDB(DriveSheetManager):
     def get_all(self) -> list[VectorStoreFileInfo]:
         result = self.service.get(
             spreadsheet_id=self.spreadsheet_id, 
-            range_=f"{self.sheet_name}!A2:G")
+            range_=f"{self.sheet_name}!A2:{FILES_DB_LAST_COLUMN}")
         
-        return [VectorStoreFileInfo(
-            id=r[0], 
-            source_file_id=r[1], 
-            source_type=r[2], 
-            folder_id=r[3], 
-            last_modified=datetime.fromisoformat(r[4]),
-            status=r[5],
-            source_id=r[6]) for r in result if r[5] == "ok"]
-    
-    def update_status(self, source_id: str, status: FileStatus):
-        rows_dict = self.get_rows_dict()
-        row = rows_dict.get(source_id, None)
+        return [VectorStoreFileInfo.from_row(r) for r in result if r[5] == "ok"]
 
-        current_entry = self.service.get(
+    def get_all_rows(self) -> list[VectorStoreFileInfo]:
+        """Every row, whatever its status, in sheet order."""
+        result = self.service.get(
             spreadsheet_id=self.spreadsheet_id, 
-            range_=f"{self.sheet_name}!A:F{row}")
+            range_=f"{self.sheet_name}!A2:{FILES_DB_LAST_COLUMN}")
         
-        assert current_entry[0][1] == source_id, "Mismatch in source id."
-        assert current_entry[0][5] == "ok", "File status is not ok."
+        return [VectorStoreFileInfo.from_row(r) for r in result]
+
+    def replace_all_rows(self, files_info: list[VectorStoreFileInfo]):
+        """Overwrites the rows with `files_info` in a single call."""
+        self.service.update(
+            spreadsheet_id=self.spreadsheet_id,
+            range_=f"{self.sheet_name}!A2:{FILES_DB_LAST_COLUMN}",
+            body=[file_info_row(file_info) for file_info in files_info])
+    
+    def update_status(self, file_info: VectorStoreFileInfo, status: FileStatus):
+        assert not self.update_statuses([(file_info, status)]), \
+            f"File '{file_info.id}' of '{file_info.source_id}' not found or status is not ok."
 
-        if row is not None:
-            self.service.update(
+    def update_statuses(self, updates: list[tuple[VectorStoreFileInfo, FileStatus]]) -> list[VectorStoreFileInfo]:
+        """Updates the status of several files with one read and one write.
+        Rows are resolved from a single snapshot of the sheet by file id and source id,
+        so other "ok" rows of the same source id are kept. Returns the files without
+        an "ok" row, the rest are written."""
+        if len(updates) == 0:
+            return []
+
+        snapshot = self.service.get(
+            spreadsheet_id=self.spreadsheet_id, 
+            range_=f"{self.sheet_name}!A2:G")
+        ok_rows: dict[tuple[str, str], list[int]] = {}
+        for i, r in enumerate(snapshot):
+            if len(r) > 6 and r[5] == "ok":
+                ok_rows.setdefault((r[0], r[6]), []).append(i + 2)
+
+        data = {}
+        skipped = []
+        for file_info, status in updates:
+            # Rows with the same file id and source id are the same file
+            rows = ok_rows.pop((file_info.id, file_info.source_id), [])
+            if len(rows) == 0:
+                skipped.append(file_info)
+            for row in rows:
+                data[f"{self.sheet_name}!F{row}"] = [[status]]
+
+        if data:
+            self.service.batch_update(
                 spreadsheet_id=self.spreadsheet_id,
-                range_=f"{self.sheet_name}!F{row}",
-                body=[[status]])
+                data=data)
+        return skipped
+
+
+class PendingRows:
+    """Rows that couldn't be written to a files DB, kept in a local JSONL file
+    until they're written by the next sync."""
+
+    def __init__(self, file: Path):
+        self.file = file
+
+    def add(self, files_info: list[VectorStoreFileInfo]):
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.file, "a", encoding="utf8") as f:
+            for file_info in files_info:
+                f.write(file_info.model_dump_json() + "\n")
+
+    def get_all(self) -> list[VectorStoreFileInfo]:
+        if not self.file.exists():
+            return []
+        with open(self.file, "r", encoding="utf8") as f:
+            return [VectorStoreFileInfo.model_validate_json(line) for line in f if line.strip()]
+
+    def write_to(self, files_db: VectorStoreFilesDBI) -> int:
+        """Writes the rows with a single call and forgets them, they're kept if it fails.
+        Returns the rows written."""
+        rows = self.get_all()
+        files_db.write_many(rows)
+        self.file.unlink(missing_ok=True)
+        return len(rows)
+
+
+class FilesWriteBuffer:
+    """Queues VectorStoreFilesDB rows and writes them with a single append call.
+    Rows are flushed when `max_rows` are queued, `max_delay` seconds after the
+    first queued row, or when leaving the context manager.
+    If a flush fails the rows are kept for the next one. Only `flush` raises, the
+    size and time triggered flushes log the error, so writers are never interrupted."""
+
+    def __init__(self, files_db: VectorStoreFilesDBI, max_rows: int = 50, max_delay: float = 5.0):
+        self.files_db = files_db
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self._rows: list[VectorStoreFileInfo] = []
+        self._lock = threading.RLock()
+        self._timer: threading.Timer | None = None
+
+    @property
+    def pending(self) -> list[VectorStoreFileInfo]:
+        with self._lock:
+            return list(self._rows)
+
+    def write(self, file_info: VectorStoreFileInfo):
+        with self._lock:
+            self._rows.append(file_info)
+            if len(self._rows) >= self.max_rows:
+                self._timed_flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_delay, self._timed_flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            rows, self._rows = self._rows, []
+            try:
+                self.files_db.write_many(rows)
+            except Exception:
+                self._rows = rows + self._rows
+                raise
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Error flushing rows to '{self.files_db.sheet_name}': {e}")
+
+    def __enter__(self) -> 'FilesWriteBuffer':
+        return self
+
+    def __exit__(self, *_):
+        self.flush()
@@ -0,0 +1,92 @@
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+from typing import IO, Callable
+
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def content_hash(content: bytes | IO[bytes]) -> str:
+    """sha256 of the content, file objects are read in chunks and rewound."""
+    if isinstance(content, bytes):
+        return hashlib.sha256(content).hexdigest()
+
+    digest = hashlib.sha256()
+    content.seek(0)
+    for chunk in iter(lambda: content.read(HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+class OpenAIFilesRegistry:
+    """SQLite registry of the files uploaded to OpenAI, by content hash.
+
+    Identical files (e.g. the same PDF in several data versions) are uploaded once
+    and shared. Every source file using an OpenAI file in a vector store is a
+    reference, the OpenAI file can be deleted once it has no references left."""
+
+    def __init__(self, db_file: Path | str):
+        self.db_file = db_file
+        self._connection = sqlite3.connect(db_file, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._hash_locks: dict[str, threading.Lock] = {}
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "content_hash TEXT PRIMARY KEY, "
+                "file_id TEXT NOT NULL UNIQUE)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS file_references ("
+                "file_id TEXT NOT NULL, "
+                "vector_store_id TEXT NOT NULL, "
+                "source_id TEXT NOT NULL, "
+                "PRIMARY KEY (file_id, vector_store_id, source_id))")
+
+    def get_file_id(self, content_hash: str) -> str | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT file_id FROM files WHERE content_hash = ?", (content_hash,)).fetchone()
+        return None if row is None else row[0]
+
+    def get_or_upload(self, content_hash: str, upload: Callable[[], str]) -> str:
+        """Returns the file id registered for the content, calling `upload` only if there is none.
+        Concurrent calls with the same content upload it once."""
+        with self._lock:
+            hash_lock = self._hash_locks.setdefault(content_hash, threading.Lock())
+
+        with hash_lock:
+            file_id = self.get_file_id(content_hash)
+            if file_id is None:
+                file_id = upload()
+                with self._lock, self._connection:
+                    self._connection.execute(
+                        "INSERT INTO files (content_hash, file_id) VALUES (?, ?)", (content_hash, file_id))
+            return file_id
+
+    def add_reference(self, file_id: str, vector_store_id: str, source_id: str):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO file_references (file_id, vector_store_id, source_id) VALUES (?, ?, ?)",
+                (file_id, vector_store_id, source_id))
+
+    def remove_reference(self, file_id: str, vector_store_id: str, source_id: str) -> tuple[int, int]:
+        """Removes the reference and returns how many are left for the file,
+        in the vector store and in total."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM file_references WHERE file_id = ? AND vector_store_id = ? AND source_id = ?",
+                (file_id, vector_store_id, source_id))
+            in_store = self._connection.execute(
+                "SELECT COUNT(*) FROM file_references WHERE file_id = ? AND vector_store_id = ?",
+                (file_id, vector_store_id)).fetchone()[0]
+            total = self._connection.execute(
+                "SELECT COUNT(*) FROM file_references WHERE file_id = ?", (file_id,)).fetchone()[0]
+        return in_store, total
+
+    def forget_file(self, file_id: str):
+        """Removes a deleted OpenAI file from the registry."""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
@@ -1,60 +1,509 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import IO, Callable
+
 from httpx import delete
 from openai import OpenAI
+from pydantic import BaseModel
 
-from ingestion.db_manager import VectorStoreFileInfo, VectorStoreFilesDB
+from ingestion.db_manager import FileStatus, FilesWriteBuffer, VectorStoreFileInfo, VectorStoreFilesDBI
+from ingestion.files_registry import OpenAIFilesRegistry, content_hash
 from model.files.gcs import GCSFile
+from utils.gcs_utils import GCSBucketFacade, ListingChanges
+from utils.memory_utils import MemoryHighWaterMark
+from utils.retry_utils import retry_call
 
 
-class SourcesDifferences:
+class SourcesDifferences(BaseModel):
     """Represents the differences between the source files and the VectorStore files."""
-    
-    def __init__(self):
-        self.new_files: list[GCSFile] = []
-        self.updated: list[tuple[GCSFile, VectorStoreFileInfo]] = []
-        self.deleted: list[VectorStoreFileInfo] = []
-        self.no_changes: list[GCSFile] = []
+    new_files: list[GCSFile] = []
+    updated: list[tuple[GCSFile, VectorStoreFileInfo]] = []
+    deleted: list[VectorStoreFileInfo] = []
+    no_changes: list[GCSFile] = []
+
+
+def source_file_changed(source_file: GCSFile, vs_file: VectorStoreFileInfo) -> bool:
+    """A source file changed if its GCS generation and checksum differ from the stored ones.
+    Files without stored checksums fall back to comparing the modification time."""
+    if source_file.generation is not None and source_file.generation == vs_file.generation:
+        return False
+    if source_file.content_hash is not None and vs_file.content_hash is not None:
+        return source_file.content_hash != vs_file.content_hash
+    return vs_file.last_modified < source_file.updated
+
+
+def by_source_id(vs_files: list[VectorStoreFileInfo]) -> tuple[dict[str, VectorStoreFileInfo],
+                                                                list[VectorStoreFileInfo]]:
+    """The first VectorStore file of each source id, and the duplicates with other file ids after it.
+    Rows with the same file id are the same file, their statuses are updated together."""
+    vs_files_dict: dict[str, VectorStoreFileInfo] = {}
+    duplicates: list[VectorStoreFileInfo] = []
+    seen: set[tuple[str, str]] = set()
+    for vs_file in vs_files:
+        if (vs_file.id, vs_file.source_id) in seen:
+            continue
+        seen.add((vs_file.id, vs_file.source_id))
+        if vs_file.source_id in vs_files_dict:
+            duplicates.append(vs_file)
+        else:
+            vs_files_dict[vs_file.source_id] = vs_file
+    return vs_files_dict, duplicates
+
+
+def compute_differences(source_files: list[GCSFile], vs_files: list[VectorStoreFileInfo]) -> SourcesDifferences:
+    """Compares the source files with the VectorStore files by source id, in linear time.
+    Duplicated VectorStore files of a source id are deleted, only the first one is compared."""
+    vs_files_dict, duplicates = by_source_id(vs_files)
+
+    differences = SourcesDifferences()
+    for source_file in source_files:
+        vs_file = vs_files_dict.pop(source_file.source_id, None)
+        if vs_file is None:
+            differences.new_files.append(source_file)
+        elif source_file_changed(source_file, vs_file):
+            differences.updated.append((source_file, vs_file))
+        else:
+            differences.no_changes.append(source_file)
+
+    differences.deleted = list(vs_files_dict.values()) + duplicates
+    return differences
+
+
+def compute_incremental_differences(changes: ListingChanges,
+                                    vs_files: list[VectorStoreFileInfo]) -> SourcesDifferences:
+    """The differences from the blobs changed since the last sync. Blobs not
+    listed as changed are unchanged, and not included in `no_changes`. Duplicated
+    VectorStore files of the listed blobs are deleted, like by `compute_differences`."""
+    vs_files_dict, duplicates = by_source_id(vs_files)
+
+    differences = SourcesDifferences()
+    for source_file in changes.changed:
+        vs_file = vs_files_dict.get(source_file.source_id, None)
+        if vs_file is None:
+            differences.new_files.append(source_file)
+        elif source_file_changed(source_file, vs_file):
+            differences.updated.append((source_file, vs_file))
+        else:
+            differences.no_changes.append(source_file)
+
+    changed_ids = {source_file.source_id for source_file in changes.changed}
+    for entry in changes.deleted:
+        vs_file = vs_files_dict.get(entry.source_id, None)
+        if vs_file is not None and entry.source_id not in changed_ids:
+            differences.deleted.append(vs_file)
+
+    listed_ids = changed_ids | {entry.source_id for entry in changes.deleted}
+    differences.deleted.extend(vs_file for vs_file in duplicates if vs_file.source_id in listed_ids)
+    return differences
+
+
+# Vector store file statuses of files that won't be searchable
+INDEXING_FAILED_STATUSES = {"failed", "cancelled"}
+
+
+class PipelineConfig(BaseModel):
+    download_workers: int = 4
+    upload_workers: int = 4
+    attach_workers: int = 2
+    queue_size: int = 8         # Max files waiting between two stages
+    max_retries: int = 3        # Retries per file and stage
+    retry_delay: float = 1.0    # Seconds before the first retry
+    attach_batch_size: int = 1  # Files attached per vector store file batch, 1 attaches one by one
+    write_buffer_rows: int = 50     # Database rows written per sheet call
+    write_buffer_delay: float = 5.0 # Max seconds a row waits in the write buffer
+    # Files up to this size are downloaded to memory, bigger ones to a temporary file.
+    # At most (download_workers + upload_workers + queue_size) files are held at once.
+    max_memory_per_file: int = 16 * 1024 * 1024
+    batch_timeout: float = 600  # Seconds to wait for the batches to be indexed
+
+
+class FileFailure(BaseModel):
+    source_id: str
+    stage: str
+    error: str
+
+
+class SyncReport(BaseModel):
+    ingested: list[str] = []
+    removed: list[str] = []
+    failures: list[FileFailure] = []
+    indexing: dict[str, str] = {}   # Source id -> vector store file status, batch mode only
+    pending: list[VectorStoreFileInfo] = []     # Rows of ingested files the files DB didn't take
+    peak_memory_mb: float = 0.0     # Memory high-water mark during the sync
+
+    def is_ready(self) -> bool:
+        """True when every file attached in batch mode has been indexed."""
+        return all(status == "completed" for status in self.indexing.values())
 
 
 class IngestionManager:
-    def __init__(self, openai_client: OpenAI, vs_files_db: VectorStoreFilesDB):
+    def __init__(self, openai_client: OpenAI, vs_files_db: VectorStoreFilesDBI,
+                 files_registry: OpenAIFilesRegistry | None = None):
         self.openai_client = openai_client
         self.vs_files_db = vs_files_db
+        self.files_registry = files_registry
 
-    def ingest_file(self, file: GCSFile, file_bytes: bytes):
-        vs_file = self.openai_client.files.create(
-            file=(file.full_file_name, file_bytes),
-            purpose="assistants"
+    def upload_file(self, file: GCSFile, file_bytes: bytes | IO[bytes]) -> str:
+        """Uploads the file to OpenAI and returns the file id.
+        With a files registry, a file with the same content is reused instead."""
+        def upload() -> str:
+            vs_file = self.openai_client.files.create(
+                file=(file.full_file_name, file_bytes),
+                purpose="assistants"
+            )
+            return vs_file.id
+
+        if self.files_registry is None:
+            return upload()
+        return self.files_registry.get_or_upload(content_hash(file_bytes), upload)
+
+    def add_to_vector_store(self, file_id: str, source_id: str):
+        self.openai_client.beta.vector_stores.files.create(
+            vector_store_id=self.vs_files_db.vector_store_id,
+            file_id=file_id
+        )
+        self._add_reference(file_id, source_id)
+
+    def attach_files_batch(self, file_ids: dict[str, str]) -> str:
+        """Adds the files, by source id, to the vector store with a single file batch.
+        Returns the batch id."""
+        batch = self.openai_client.beta.vector_stores.file_batches.create(
+            vector_store_id=self.vs_files_db.vector_store_id,
+            file_ids=list(dict.fromkeys(file_ids.values()))
+        )
+        for source_id, file_id in file_ids.items():
+            self._add_reference(file_id, source_id)
+        return batch.id
+
+    def wait_for_batch(self, batch_id: str, timeout: float | None = None,
+                       initial_delay: float = 1.0, max_delay: float = 30.0) -> str:
+        """Polls the file batch with exponential backoff until it leaves the
+        'in_progress' status or the timeout expires. Returns the last status."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = initial_delay
+        while True:
+            batch = self.openai_client.beta.vector_stores.file_batches.retrieve(
+                batch_id,
+                vector_store_id=self.vs_files_db.vector_store_id
+            )
+            if batch.status != "in_progress":
+                return batch.status
+            if deadline is not None and time.monotonic() + delay > deadline:
+                return batch.status
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+    def get_batch_files_status(self, batch_id: str) -> dict[str, str]:
+        """Returns the indexing status of every file in the batch, by file id."""
+        files = self.openai_client.beta.vector_stores.file_batches.list_files(
+            batch_id,
+            vector_store_id=self.vs_files_db.vector_store_id,
+            limit=100
         )
+        return {file.id: file.status for file in files}
 
-        file_info = VectorStoreFileInfo(
-            id=vs_file.id,
+    def file_info(self, file: GCSFile, file_id: str) -> VectorStoreFileInfo:
+        return VectorStoreFileInfo(
+            id=file_id,
             source_file_id=file.file_name,
             source_type="gcs",
             folder_id=file.file_folder,
             last_modified=file.updated,
             status="ok",
-            source_id=file.file_folder + "/" + file.file_name
+            source_id=file.file_folder + "/" + file.file_name,
+            content_hash=file.content_hash,
+            generation=file.generation
         )
 
-        self.vs_files_db.write(file_info)
-        self.openai_client.beta.vector_stores.files.create(
-            vector_store_id=self.vs_files_db.vector_store_id,
-            file_id=vs_file.id
-        )
-    
+    def register_file(self, file: GCSFile, file_id: str):
+        """Writes the uploaded file entry in the database."""
+        self.vs_files_db.write(self.file_info(file, file_id))
+
+    def attach_file(self, file: GCSFile, file_id: str):
+        self.add_to_vector_store(file_id, file.source_id)
+        self.register_file(file, file_id)
+
+    def ingest_file(self, file: GCSFile, file_bytes: bytes):
+        file_id = self.upload_file(file, file_bytes)
+        self.attach_file(file, file_id)
+
+    def remove_file(self, file: VectorStoreFileInfo):
+        """Removes the file from the vector store and from OpenAI, without touching the database.
+        With a files registry, shared files are kept while other source files still use them."""
+        in_store, total = 0, 0
+        if self.files_registry is not None:
+            in_store, total = self.files_registry.remove_reference(
+                file.id, self.vs_files_db.vector_store_id, file.source_id)
+
+        if in_store == 0:
+            self.openai_client.beta.vector_stores.files.delete(
+                vector_store_id=self.vs_files_db.vector_store_id,
+                file_id=file.id
+            )
+        if total == 0:
+            self.openai_client.files.delete(file.id)
+            if self.files_registry is not None:
+                self.files_registry.forget_file(file.id)
+
+    def _add_reference(self, file_id: str, source_id: str):
+        if self.files_registry is not None:
+            self.files_registry.add_reference(file_id, self.vs_files_db.vector_store_id, source_id)
+
     def delete_file(self, file: VectorStoreFileInfo):
-        self.openai_client.beta.vector_stores.files.delete(
-            vector_store_id=self.vs_files_db.vector_store_id,
-            file_id=file.id
-        )
-        self.openai_client.files.delete(file.id)
-        self.vs_files_db.update_status(file.source_id, "deleted")
+        self.remove_file(file)
+        self.vs_files_db.update_status(file, "deleted")
 
     def update_file(self, gcs_file: GCSFile, file_bytes: bytes, vs_file: VectorStoreFileInfo):
-        self.openai_client.beta.vector_stores.files.delete(
-            vector_store_id=self.vs_files_db.vector_store_id,
-            file_id=vs_file.id
-        )
-        self.openai_client.files.delete(vs_file.id)
-        self.vs_files_db.update_status(vs_file.source_id, "updated")
+        self.remove_file(vs_file)
+        self.vs_files_db.update_status(vs_file, "updated")
         self.ingest_file(gcs_file, file_bytes)
+
+    def sync(self, differences: SourcesDifferences, bucket: GCSBucketFacade,
+             config: PipelineConfig | None = None) -> SyncReport:
+        """Applies the differences with the concurrent ingestion pipeline."""
+        pipeline = IngestionPipeline(self, bucket, config or PipelineConfig())
+        return pipeline.run(differences)
+
+
+class IngestionJob:
+    """A file moving through the ingestion pipeline."""
+
+    def __init__(self, file: GCSFile):
+        self.file = file
+        self.content: IO[bytes] | None = None
+        self.file_id: str | None = None
+
+    def close(self):
+        if self.content is not None:
+            self.content.close()
+            self.content = None
+
+
+_STOP = object()
+
+
+class IngestionPipeline:
+    """Syncs a data version with overlapping download, upload and attach stages.
+
+    Each stage has its own worker threads and hands files to the next one through a
+    bounded queue, so a slow stage applies backpressure instead of piling up bytes in
+    memory. Every stage is retried per file, failures are collected in the report and
+    the rest of the files keep going.
+    New database rows go through a write buffer and every sheet call is serialized,
+    the Google API client is not thread safe."""
+
+    def __init__(self, manager: IngestionManager, bucket: GCSBucketFacade, config: PipelineConfig):
+        self.manager = manager
+        self.bucket = bucket
+        self.config = config
+        self._report_lock = threading.Lock()
+        self._report = SyncReport()
+        self._batches: list[tuple[str, list[IngestionJob]]] = []
+        self._buffer: FilesWriteBuffer | None = None
+
+    def run(self, differences: SourcesDifferences) -> SyncReport:
+        self._report = SyncReport()
+        self._batches = []
+
+        # Old versions of updated files are removed first, so the database never
+        # holds two "ok" rows for the same source id.
+        to_remove: list[tuple[VectorStoreFileInfo, FileStatus]] = \
+            [(file, "deleted") for file in differences.deleted] + \
+            [(vs_file, "updated") for _, vs_file in differences.updated]
+        removed = self._remove_files(to_remove)
+
+        to_ingest = list(differences.new_files)
+        to_ingest += [gcs_file for gcs_file, vs_file in differences.updated if vs_file in removed]
+        with MemoryHighWaterMark() as memory:
+            self._ingest_files(to_ingest)
+        self._report.peak_memory_mb = memory.peak_mb
+        self._wait_for_batches()
+        self._flush_buffer()
+
+        return self._report
+
+    def _remove_files(self, files: list[tuple[VectorStoreFileInfo, FileStatus]]) -> list[VectorStoreFileInfo]:
+        """Returns the files removed and marked with their status, found by file id and source id."""
+        def remove(file: VectorStoreFileInfo) -> bool:
+            return self._retry(file.source_id, "remove", partial(self.manager.remove_file, file))
+
+        with ThreadPoolExecutor(max_workers=self.config.upload_workers) as executor:
+            removed = list(executor.map(remove, [file for file, _ in files]))
+
+        updates = [(file, status) for (file, status), ok in zip(files, removed) if ok]
+        # Not retried here, the files DB calls are retried by the Sheets facade
+        try:
+            skipped = self.manager.vs_files_db.update_statuses(updates)
+        except Exception as e:
+            print(f"Failed to update the status of {len(updates)} files: {e}")
+            self._report.failures += [FileFailure(source_id=file.source_id, stage="status", error=str(e))
+                                      for file, _ in updates]
+            return []
+
+        # Rows removed or changed since the differences were computed, the rest are written
+        updated = [file for file, _ in updates if file not in skipped]
+        self._report.failures += [FileFailure(source_id=file.source_id, stage="status",
+                                              error="File not found or status is not ok.")
+                                  for file in skipped]
+        self._report.removed += [file.source_id for file in updated]
+        return updated
+
+    def _ingest_files(self, files: list[GCSFile]):
+        self._buffer = self.manager.vs_files_db.write_buffer(
+            self.config.write_buffer_rows, self.config.write_buffer_delay)
+
+        size = self.config.queue_size
+        downloads: queue.Queue = queue.Queue(maxsize=size)
+        uploads: queue.Queue = queue.Queue(maxsize=size)
+        attachments: queue.Queue = queue.Queue(maxsize=size)
+
+        stages = [
+            self._start_stage("download", self._download, self.config.download_workers, downloads, uploads),
+            self._start_stage("upload", self._upload, self.config.upload_workers, uploads, attachments),
+            self._start_attach_stage(attachments),
+        ]
+
+        for file in files:
+            downloads.put(IngestionJob(file))
+
+        # Stop each stage once the previous one has drained
+        inbox = downloads
+        for threads, outbox in zip(stages, [uploads, attachments, None]):
+            for _ in threads:
+                inbox.put(_STOP)
+            for thread in threads:
+                thread.join()
+            if outbox is not None:
+                inbox = outbox
+
+    def _start_stage(self, stage: str, fn: Callable[[IngestionJob], None], workers: int,
+                     inbox: queue.Queue, outbox: queue.Queue | None,
+                     done: Callable[[IngestionJob], None] | None = None) -> list[threading.Thread]:
+        """`done` is called once per job that succeeded, outside the retries of `fn`."""
+        def worker():
+            while True:
+                job = inbox.get()
+                if job is _STOP:
+                    break
+                if not self._retry(job.file.source_id, stage, partial(fn, job)):
+                    job.close()
+                    continue
+                if done is not None:
+                    done(job)
+                if outbox is not None:
+                    outbox.put(job)
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, workers))]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def _start_attach_stage(self, inbox: queue.Queue) -> list[threading.Thread]:
+        if self.config.attach_batch_size <= 1:
+            return self._start_stage("attach", self._attach, self.config.attach_workers, inbox, None,
+                                     done=self._attached)
+
+        def worker():
+            jobs: list[IngestionJob] = []
+            while True:
+                job = inbox.get()
+                if job is not _STOP:
+                    jobs.append(job)
+                if jobs and (job is _STOP or len(jobs) >= self.config.attach_batch_size):
+                    self._attach_batch(jobs)
+                    jobs = []
+                if job is _STOP:
+                    break
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        return [thread]
+
+    def _download(self, job: IngestionJob):
+        job.close()
+        job.content = self.bucket.download_to_file(job.file, self.config.max_memory_per_file)
+
+    def _upload(self, job: IngestionJob):
+        assert job.content is not None, "File was not downloaded."
+        job.file_id = self.manager.upload_file(job.file, job.content)
+        job.close()
+
+    def _attach(self, job: IngestionJob):
+        assert job.file_id is not None, "File was not uploaded."
+        self.manager.add_to_vector_store(job.file_id, job.file.source_id)
+
+    def _attached(self, job: IngestionJob):
+        self._register(job)
+        with self._report_lock:
+            self._report.ingested.append(job.file.source_id)
+
+    def _attach_batch(self, jobs: list[IngestionJob]):
+        file_ids = {job.file.source_id: job.file_id for job in jobs if job.file_id is not None}
+        try:
+            batch_id = retry_call(partial(self.manager.attach_files_batch, file_ids),
+                                  max_retries=self.config.max_retries, delay=self.config.retry_delay)
+        except Exception as e:
+            print(f"Failed to attach a batch of {len(jobs)} files: {e}")
+            with self._report_lock:
+                self._report.failures += [FileFailure(source_id=job.file.source_id, stage="attach", error=str(e))
+                                          for job in jobs]
+            return
+
+        # Registered once the batch is indexed
+        self._batches.append((batch_id, jobs))
+
+    def _wait_for_batches(self):
+        """Registers the files of each batch once it's indexed. Files whose indexing failed
+        are removed and reported instead, so the next sync ingests them again."""
+        deadline = time.monotonic() + self.config.batch_timeout
+        for batch_id, jobs in self._batches:
+            try:
+                self.manager.wait_for_batch(batch_id, timeout=max(0.0, deadline - time.monotonic()))
+                statuses = self.manager.get_batch_files_status(batch_id)
+            except Exception as e:
+                print(f"Failed to get the status of batch '{batch_id}': {e}")
+                statuses = {}
+            for job in jobs:
+                status = statuses.get(job.file_id or "", "unknown")
+                self._report.indexing[job.file.source_id] = status
+                if status in INDEXING_FAILED_STATUSES:
+                    self._unindexed(job, status)
+                else:
+                    self._attached(job)
+
+    def _unindexed(self, job: IngestionJob, status: str):
+        assert job.file_id is not None, "File was not uploaded."
+        file_info = self.manager.file_info(job.file, job.file_id)
+        self._retry(job.file.source_id, "remove", partial(self.manager.remove_file, file_info))
+        with self._report_lock:
+            self._report.failures.append(FileFailure(source_id=job.file.source_id, stage="index",
+                                                     error=f"Indexing {status}."))
+
+    def _register(self, job: IngestionJob):
+        assert job.file_id is not None, "File was not uploaded."
+        assert self._buffer is not None, "Write buffer not initialized."
+        self._buffer.write(self.manager.file_info(job.file, job.file_id))
+
+    def _flush_buffer(self):
+        """The rows the files DB didn't take go to the report, to be written later.
+        Their files are attached, without the rows the next sync would ingest them again."""
+        assert self._buffer is not None, "Write buffer not initialized."
+        try:
+            self._buffer.flush()
+        except Exception as e:
+            print(f"Failed to write {len(self._buffer.pending)} rows to the database: {e}")
+            with self._report_lock:
+                self._report.pending = self._buffer.pending
+
+    def _retry(self, source_id: str, stage: str, fn: Callable[[], None]) -> bool:
+        try:
+            retry_call(fn, max_retries=self.config.max_retries, delay=self.config.retry_delay)
+            return True
+        except Exception as e:
+            print(f"Failed to {stage} '{source_id}': {e}")
+            with self._report_lock:
+                self._report.failures.append(FileFailure(source_id=source_id, stage=stage, error=str(e)))
+            return False
@@ -0,0 +1,233 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from ingestion.db_manager import FilesWriteBuffer, FileStatus, VectorStoreFileInfo, VectorStoreFilesDB, file_info_row
+
+
+FILES_TABLE_COLUMNS = ["id", "source_file_id", "source_type", "folder_id", "last_modified",
+                       "status", "source_id", "content_hash", "generation"]
+
+
+def file_info_values(file_info: VectorStoreFileInfo) -> tuple:
+    return (
+        file_info.id,
+        file_info.source_file_id,
+        file_info.source_type,
+        file_info.folder_id,
+        file_info.last_modified.isoformat(),
+        file_info.status,
+        file_info.source_id,
+        file_info.content_hash,
+        file_info.generation)
+
+
+class SheetChangedError(Exception):
+    """The sheet was changed by someone else since the files DB was last mirrored to it."""
+    pass
+
+
+def files_rows_fingerprint(files_info: list[VectorStoreFileInfo]) -> str:
+    """Changes when any row changes, compared as they are written to the sheet."""
+    return hashlib.sha256(json.dumps([file_info_row(f) for f in files_info]).encode()).hexdigest()
+
+
+class SQLiteVectorStoreFilesDB:
+    """VectorStoreFilesDB on a local SQLite file, every data version in the same table.
+    `sheet_name` identifies the data version, as in the sheets backend.
+
+    Lookups are indexed and don't count against the Sheets quota, the sheet can
+    still be kept up to date for humans with a SheetMirror."""
+
+    def __init__(self, db_file: Path | str, sheet_name: str, vector_store_id: str):
+        self.db_file = db_file
+        self.sheet_name = sheet_name
+        self.vector_store_id = vector_store_id
+        self._connection = sqlite3.connect(db_file, check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+        self._version = 0
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "row_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "sheet_name TEXT NOT NULL, "
+                "id TEXT NOT NULL, "
+                "source_file_id TEXT NOT NULL, "
+                "source_type TEXT NOT NULL, "
+                "folder_id TEXT NOT NULL, "
+                "last_modified TEXT NOT NULL, "
+                "status TEXT NOT NULL, "
+                "source_id TEXT NOT NULL, "
+                "content_hash TEXT, "
+                "generation INTEGER)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS files_id ON files (sheet_name, id)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS files_source_id ON files (sheet_name, source_id)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS files_status ON files (sheet_name, status)")
+
+    @property
+    def version(self) -> int:
+        """Increases with every change, to know when to mirror."""
+        with self._lock:
+            return self._version
+
+    def write(self, file_info: VectorStoreFileInfo):
+        self.write_many([file_info])
+
+    def write_many(self, files_info: list[VectorStoreFileInfo]):
+        if len(files_info) == 0:
+            return
+        rows = [(self.sheet_name, *file_info_values(f)) for f in files_info]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                f"INSERT INTO files (sheet_name, {', '.join(FILES_TABLE_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * (len(FILES_TABLE_COLUMNS) + 1))})", rows)
+            self._version += 1
+
+    def write_buffer(self, max_rows: int = 50, max_delay: float = 5.0) -> FilesWriteBuffer:
+        return FilesWriteBuffer(self, max_rows, max_delay)
+
+    def get_ids_mapping(self) -> dict[str, str]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, source_file_id FROM files WHERE sheet_name = ? AND status = 'ok' ORDER BY row_id",
+                (self.sheet_name,)).fetchall()
+        return {file_id: source_file_id for file_id, source_file_id in rows}
+
+    def _select(self, where: str, params: tuple) -> list[VectorStoreFileInfo]:
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT {', '.join(FILES_TABLE_COLUMNS)} FROM files "
+                f"WHERE sheet_name = ? {where} ORDER BY row_id", (self.sheet_name, *params)).fetchall()
+        return [VectorStoreFileInfo(**dict(zip(FILES_TABLE_COLUMNS, row))) for row in rows]
+
+    def get_all(self) -> list[VectorStoreFileInfo]:
+        return self._select("AND status = 'ok'", ())
+
+    def get_all_rows(self) -> list[VectorStoreFileInfo]:
+        return self._select("", ())
+
+    def get_by_source_id(self, source_id: str) -> VectorStoreFileInfo | None:
+        files = self._select("AND status = 'ok' AND source_id = ?", (source_id,))
+        return files[0] if files else None
+
+    def update_status(self, file_info: VectorStoreFileInfo, status: FileStatus):
+        assert not self.update_statuses([(file_info, status)]), \
+            f"File '{file_info.id}' of '{file_info.source_id}' not found or status is not ok."
+
+    def update_statuses(self, updates: list[tuple[VectorStoreFileInfo, FileStatus]]) -> list[VectorStoreFileInfo]:
+        """Updates the status of several files in one transaction, by file id and source id,
+        so other "ok" rows of the same source id are kept. Returns the files without an "ok" row."""
+        if len(updates) == 0:
+            return []
+
+        skipped = []
+        with self._lock, self._connection:
+            for file_info, status in updates:
+                cursor = self._connection.execute(
+                    "UPDATE files SET status = ? "
+                    "WHERE sheet_name = ? AND id = ? AND source_id = ? AND status = 'ok'",
+                    (status, self.sheet_name, file_info.id, file_info.source_id))
+                if cursor.rowcount == 0:
+                    skipped.append(file_info)
+            self._version += 1
+        return skipped
+
+    def import_rows(self, files_info: list[VectorStoreFileInfo]) -> bool:
+        """Loads the rows of an existing files DB, only if this data version is empty."""
+        with self._lock:
+            count = self._connection.execute(
+                "SELECT COUNT(*) FROM files WHERE sheet_name = ?", (self.sheet_name,)).fetchone()[0]
+        if count > 0:
+            return False
+        self.write_many(files_info)
+        return True
+
+    def replace_rows(self, files_info: list[VectorStoreFileInfo]):
+        """Replaces every row of this data version in one transaction, e.g. with the sheet's."""
+        rows = [(self.sheet_name, *file_info_values(f)) for f in files_info]
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM files WHERE sheet_name = ?", (self.sheet_name,))
+            self._connection.executemany(
+                f"INSERT INTO files (sheet_name, {', '.join(FILES_TABLE_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * (len(FILES_TABLE_COLUMNS) + 1))})", rows)
+            self._version += 1
+
+
+class SheetMirror:
+    """Copies a SQLiteVectorStoreFilesDB to its sheet, for humans to read.
+    A background thread mirrors every `interval` seconds, when there are changes.
+    `in_sync` skips mirroring until the first change, e.g. right after an import.
+
+    The sheet is compared with the rows last imported from or mirrored to it before
+    it's overwritten: if someone else changed it meanwhile, mirroring raises
+    SheetChangedError and the sheet is kept."""
+
+    def __init__(self, files_db: SQLiteVectorStoreFilesDB, sheet_db: VectorStoreFilesDB,
+                 interval: float = 60.0, in_sync: bool = False):
+        self.files_db = files_db
+        self.sheet_db = sheet_db
+        self.interval = interval
+        self._mirrored_version = files_db.version if in_sync else -1
+        self._sheet_fingerprint = files_rows_fingerprint(files_db.get_all_rows()) if in_sync else None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.last_mirrored_at: datetime | None = None
+
+    def mirror(self) -> bool:
+        """Mirrors now if there are changes, returns whether it wrote to the sheet."""
+        with self._lock:
+            version = self.files_db.version
+            if version == self._mirrored_version:
+                return False
+            if self._sheet_fingerprint is not None and \
+                    files_rows_fingerprint(self.sheet_db.get_all_rows()) != self._sheet_fingerprint:
+                raise SheetChangedError(f"'{self.sheet_db.sheet_name}' changed since it was last mirrored, "
+                                        f"restart to import it again")
+            rows = self.files_db.get_all_rows()
+            self.sheet_db.replace_all_rows(rows)
+            self._mirrored_version = version
+            self._sheet_fingerprint = files_rows_fingerprint(rows)
+            self.last_mirrored_at = datetime.now()
+            return True
+
+    def start(self) -> 'SheetMirror':
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.mirror()
+            except Exception as e:
+                print(f"Error mirroring files DB to '{self.sheet_db.sheet_name}': {e}")
+
+
+def open_sqlite_files_db(db_file: Path | str, sheet_db: VectorStoreFilesDB,
+                         mirror_interval: float | None = 60.0) -> tuple[SQLiteVectorStoreFilesDB, SheetMirror | None]:
+    """The SQLite files DB of the sheet's data version and its mirror. It's loaded from
+    the sheet, if empty or different from it, and mirrored to it every `mirror_interval`
+    seconds (None to not mirror)."""
+    files_db = SQLiteVectorStoreFilesDB(db_file, sheet_db.sheet_name, sheet_db.vector_store_id)
+    sheet_rows = sheet_db.get_all_rows()
+    if files_db.import_rows(sheet_rows):
+        print(f"Imported '{sheet_db.sheet_name}' from the sheet")
+    elif files_rows_fingerprint(files_db.get_all_rows()) != files_rows_fingerprint(sheet_rows):
+        # The sheet changed since the local file was last mirrored, e.g. synced from another machine
+        files_db.replace_rows(sheet_rows)
+        print(f"Imported '{sheet_db.sheet_name}' again, the local files DB was stale")
+    mirror = None
+    if mirror_interval is not None:
+        mirror = SheetMirror(files_db, sheet_db, mirror_interval, in_sync=True).start()
+    return files_db, mirror
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable
+
+from pydantic import BaseModel
+
+from ingestion.db_manager import PendingRows, VectorStoreFileInfo, VectorStoreFilesDBI
+from ingestion.manager import (IngestionManager, PipelineConfig, SourcesDifferences, SyncReport, compute_differences,
+                               compute_incremental_differences)
+from model.files.gcs import GCSFile
+from utils.gcs_utils import GCSBucketFacade, ListingSnapshot, SnapshotEntry
+
+
+SYNC_CONTENT_TYPES = ["application/pdf"]
+
+
+class SyncPlanConfig(BaseModel):
+    ttl: float = 600.0  # Seconds a computed plan is reused
+    workers: int = 4    # Data versions planned at once
+
+
+class StalePlanError(Exception):
+    pass
+
+
+def snapshot_file(snapshots_path: Path, bucket_folder: str) -> Path:
+    return snapshots_path / f"{bucket_folder.strip('/').replace('/', '_')}.json"
+
+
+def pending_rows(snapshots_path: Path, bucket_folder: str) -> PendingRows:
+    """The files DB rows the last sync of the folder couldn't write, next to its snapshot."""
+    return PendingRows(snapshots_path / f"{bucket_folder.strip('/').replace('/', '_')}.pending.jsonl")
+
+
+def write_pending_rows(files_db: VectorStoreFilesDBI, snapshots_path: Path, bucket_folder: str):
+    """Raises if they can't be written, the files would be seen as new and ingested again."""
+    written = pending_rows(snapshots_path, bucket_folder).write_to(files_db)
+    if written > 0:
+        print(f"Wrote {written} pending rows of the last sync of '{bucket_folder}'")
+
+
+def vs_files_fingerprint(vs_files: list[VectorStoreFileInfo]) -> str:
+    """Changes when a file is added to, removed from or updated in the files DB."""
+    rows = sorted((f.source_id, f.id, f.content_hash or "", f.generation or 0) for f in vs_files)
+    return hashlib.sha256(json.dumps(rows).encode()).hexdigest()
+
+
+class DataVersionPlan(BaseModel):
+    bucket_folder: str
+    sheet_name: str
+    vector_store_id: str
+    vs_files: list[VectorStoreFileInfo]
+    vs_files_fingerprint: str
+    listed_files: list[GCSFile]     # Every file with a full listing, else the changed ones
+    total_files: int                # Files in the bucket folder
+    differences: SourcesDifferences
+    snapshot: ListingSnapshot       # Saved once the plan is executed
+    deleted_blobs: dict[str, SnapshotEntry] = {}    # Of the deleted files, put back in the snapshot if they fail
+
+
+class SyncPlan(BaseModel):
+    """The differences of every data version, computed once to be shown and executed,
+    in the app or later with the sync CLI."""
+    created_at: datetime
+    full_listing: bool
+    versions: dict[str, DataVersionPlan]    # By bucket folder
+
+    @property
+    def fingerprint(self) -> str:
+        return hashlib.sha256(self.model_dump_json(exclude={"created_at"}).encode()).hexdigest()
+
+    def age(self) -> float:
+        return (datetime.now(timezone.utc) - self.created_at).total_seconds()
+
+    @classmethod
+    def load(cls, file: Path) -> 'SyncPlan':
+        return cls.model_validate_json(file.read_text(encoding="utf8"))
+
+    def save(self, file: Path):
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_text(self.model_dump_json(), encoding="utf8")
+
+
+def plan_data_version(bucket: GCSBucketFacade, files_db: VectorStoreFilesDBI, bucket_folder: str,
+                      snapshots_path: Path, full_listing: bool = False) -> DataVersionPlan:
+    snapshot = ListingSnapshot() if full_listing else ListingSnapshot.load(snapshot_file(snapshots_path, bucket_folder))
+    changes = bucket.list_changes(bucket_folder, SYNC_CONTENT_TYPES, snapshot)
+    write_pending_rows(files_db, snapshots_path, bucket_folder)
+    vs_files = files_db.get_all()
+    # Without a snapshot every blob is listed, and the files DB rows without one are deleted
+    if full_listing or len(snapshot.blobs) == 0:
+        differences = compute_differences(changes.changed, vs_files)
+    else:
+        differences = compute_incremental_differences(changes, vs_files)
+
+    # Deleted blobs keep their previous entry, files DB rows without one get an entry by source id,
+    # which isn't a blob name, so both are listed as deleted by the next sync
+    previous = {e.source_id: (name, e) for name, e in snapshot.blobs.items() if name not in changes.snapshot.blobs}
+    listed_ids = {e.source_id for e in changes.snapshot.blobs.values()}
+    deleted_blobs: dict[str, SnapshotEntry] = {}
+    for vs_file in differences.deleted:
+        if vs_file.source_id in listed_ids:
+            continue
+        name, entry = previous.get(vs_file.source_id, (vs_file.source_id, SnapshotEntry(
+            generation=vs_file.generation, updated=vs_file.last_modified, source_id=vs_file.source_id)))
+        deleted_blobs[name] = entry
+
+    return DataVersionPlan(
+        bucket_folder=bucket_folder,
+        sheet_name=files_db.sheet_name,
+        vector_store_id=files_db.vector_store_id,
+        vs_files=vs_files,
+        vs_files_fingerprint=vs_files_fingerprint(vs_files),
+        listed_files=changes.changed,
+        total_files=len(changes.snapshot.blobs),
+        differences=differences,
+        snapshot=changes.snapshot,
+        deleted_blobs=deleted_blobs)
+
+
+def build_sync_plan(bucket: GCSBucketFacade, files_dbs: dict[str, VectorStoreFilesDBI], snapshots_path: Path,
+                    full_listing: bool = False, workers: int = 4) -> SyncPlan:
+    """Plans every data version, by bucket folder, `workers` at a time."""
+    created_at = datetime.now(timezone.utc)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {bucket_folder: executor.submit(plan_data_version, bucket, files_db, bucket_folder,
+                                                  snapshots_path, full_listing)
+                   for bucket_folder, files_db in files_dbs.items()}
+        versions = {bucket_folder: future.result() for bucket_folder, future in futures.items()}
+    return SyncPlan(created_at=created_at, full_listing=full_listing, versions=versions)
+
+
+def execute_sync_plan(plan: SyncPlan, bucket: GCSBucketFacade, files_dbs: dict[str, VectorStoreFilesDBI],
+                      ingestion_manager: Callable[[VectorStoreFilesDBI], IngestionManager],
+                      pipeline_config: PipelineConfig, snapshots_path: Path,
+                      force: bool = False) -> dict[str, SyncReport]:
+    """Syncs every data version of the plan and saves its listing snapshot.
+    Fails before syncing anything if a files DB changed since the plan was computed, unless `force`.
+    Rows the files DB didn't take are kept, and written before the next plan or sync."""
+    for bucket_folder in plan.versions:
+        write_pending_rows(files_dbs[bucket_folder], snapshots_path, bucket_folder)
+    if not force:
+        for bucket_folder, version_plan in plan.versions.items():
+            if vs_files_fingerprint(files_dbs[bucket_folder].get_all()) != version_plan.vs_files_fingerprint:
+                raise StalePlanError(f"The files of '{bucket_folder}' changed since the plan was computed")
+
+    reports: dict[str, SyncReport] = {}
+    for bucket_folder, version_plan in plan.versions.items():
+        differences = version_plan.differences
+        print(f"Syncing files for data version: {bucket_folder}")
+        print(f"New files: {len(differences.new_files)}")
+        print(f"Deleted files: {len(differences.deleted)}")
+        print(f"Updated files: {len(differences.updated)}")
+
+        report = ingestion_manager(files_dbs[bucket_folder]).sync(differences, bucket, pipeline_config)
+        print(f"Ingested: {len(report.ingested)}, removed: {len(report.removed)}, "
+              f"failed: {len(report.failures)}, peak memory: {report.peak_memory_mb:.1f} MB")
+        reports[bucket_folder] = report
+        if report.pending:
+            pending_rows(snapshots_path, bucket_folder).add(report.pending)
+            print(f"Kept {len(report.pending)} rows for the next sync")
+
+        # Failed files are listed as changed, or deleted, again in the next sync
+        failed = {failure.source_id for failure in report.failures}
+        failed_deletions = {name: e for name, e in version_plan.deleted_blobs.items() if e.source_id in failed}
+        version_plan.snapshot.without(failed).with_blobs(failed_deletions) \
+            .save(snapshot_file(snapshots_path, bucket_folder))
+    return reports
+
+
+class SyncPlanCache:
+    """The last plan of each listing mode, rebuilt on request or once older than `ttl` seconds."""
+
+    def __init__(self, ttl: float = 600.0):
+        self.ttl = ttl
+        self._plans: dict[bool, SyncPlan] = {}
+        self._lock = threading.Lock()
+
+    def get(self, full_listing: bool, build: Callable[[], SyncPlan], refresh: bool = False) -> SyncPlan:
+        with self._lock:
+            plan = self._plans.get(full_listing, None)
+            if refresh or plan is None or plan.age() > self.ttl:
+                start = time.perf_counter()
+                plan = build()
+                print(f"Sync plan computed in {time.perf_counter() - start:.2f} s")
+                self._plans[full_listing] = plan
+            return plan
+
+    def invalidate(self):
+        with self._lock:
+            self._plans.clear()
@@ -0,0 +1,238 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Iterator, Protocol
+
+from pydantic import BaseModel
+
+from model.answers_generation import (AnswerDelta, LLMAnswer, QuestionsAnswersI, StreamingQuestionsAnswersI,
+                                      answer_to_deltas, deltas_to_answer)
+
+
+DEFAULT_LRU_SIZE = 512
+
+
+def normalize_question(question: str) -> str:
+    """Lowercase, without accents, punctuation nor repeated whitespace,
+    so trivially different spellings of a question share the cache entry."""
+    text = unicodedata.normalize("NFKD", question.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def answer_cache_key(question: str, vector_store_id: str, assistant_id: str) -> str:
+    key = "\n".join([assistant_id, vector_store_id, normalize_question(question)])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class CachedAnswer(BaseModel):
+    answer: LLMAnswer
+    files_fingerprint: str  # The vector store files the answer was generated with
+
+
+class AnswersCacheStorageI(Protocol):
+    def get(self, key: str) -> CachedAnswer | None: ...
+
+    def set(self, key: str, value: CachedAnswer) -> None: ...
+
+    def delete(self, key: str) -> None: ...
+
+    def clear(self) -> None: ...
+
+
+class LRUAnswersCacheStorage:
+    """In memory storage that keeps the `max_size` most recently used answers."""
+
+    def __init__(self, max_size: int = DEFAULT_LRU_SIZE):
+        self.max_size = max_size
+        self._entries: OrderedDict[str, CachedAnswer] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> CachedAnswer | None:
+        with self._lock:
+            value = self._entries.get(key, None)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: CachedAnswer) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteAnswersCacheStorage:
+    """On disk storage, survives restarts of the app."""
+
+    def __init__(self, db_file: Path | str):
+        self.db_file = db_file
+        self._connection = sqlite3.connect(db_file, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "key TEXT PRIMARY KEY, "
+                "value TEXT NOT NULL)")
+
+    def get(self, key: str) -> CachedAnswer | None:
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM answers WHERE key = ?", (key,)).fetchone()
+        return None if row is None else CachedAnswer.model_validate_json(row[0])
+
+    def set(self, key: str, value: CachedAnswer) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO answers (key, value) VALUES (?, ?)", (key, value.model_dump_json()))
+
+    def delete(self, key: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM answers WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM answers")
+
+
+class LayeredAnswersCacheStorage:
+    """Looks up the layers in order (e.g. LRU then SQLite) and fills the faster
+    layers with the answers found in the slower ones."""
+
+    def __init__(self, layers: list[AnswersCacheStorageI]):
+        self.layers = layers
+
+    def get(self, key: str) -> CachedAnswer | None:
+        for i, layer in enumerate(self.layers):
+            value = layer.get(key)
+            if value is not None:
+                for faster_layer in self.layers[:i]:
+                    faster_layer.set(key, value)
+                return value
+        return None
+
+    def set(self, key: str, value: CachedAnswer) -> None:
+        for layer in self.layers:
+            layer.set(key, value)
+
+    def delete(self, key: str) -> None:
+        for layer in self.layers:
+            layer.delete(key)
+
+    def clear(self) -> None:
+        for layer in self.layers:
+            layer.clear()
+
+
+class CacheStats(BaseModel):
+    hits: int = 0
+    misses: int = 0
+    invalidated: int = 0  # Misses because the vector store files changed
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
+class AnswersCache:
+    """Answers by question, vector store and assistant, counting hits and misses.
+    An entry is only valid for the files fingerprint it was stored with."""
+
+    def __init__(self, storage: AnswersCacheStorageI):
+        self.storage = storage
+        self._stats = CacheStats()
+        self._lock = threading.Lock()
+
+    def get(self, question: str, vector_store_id: str, assistant_id: str,
+            files_fingerprint: str) -> LLMAnswer | None:
+        key = answer_cache_key(question, vector_store_id, assistant_id)
+        cached = self.storage.get(key)
+        stale = cached is not None and cached.files_fingerprint != files_fingerprint
+        if stale:
+            self.storage.delete(key)
+
+        with self._lock:
+            if cached is None or stale:
+                self._stats.misses += 1
+                self._stats.invalidated += stale
+                return None
+            self._stats.hits += 1
+        return cached.answer
+
+    def set(self, question: str, vector_store_id: str, assistant_id: str,
+            files_fingerprint: str, answer: LLMAnswer) -> None:
+        key = answer_cache_key(question, vector_store_id, assistant_id)
+        self.storage.set(key, CachedAnswer(answer=answer, files_fingerprint=files_fingerprint))
+
+    @property
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return self._stats.model_copy()
+
+    def clear(self) -> None:
+        self.storage.clear()
+        with self._lock:
+            self._stats = CacheStats()
+
+
+class AnswersModelI(QuestionsAnswersI, StreamingQuestionsAnswersI, Protocol):
+    pass
+
+
+class CachedQuestionsAnswers:
+    """Answer model in front of another one, serving repeated questions from the cache.
+
+    `files_fingerprint` returns the fingerprint of a vector store's files, so the
+    cached answers are invalidated when a sync changes them. Cached answers keep
+    the thread and run ids of the run that generated them. Streamed answers are
+    only cached once the stream ends, which the models only do for completed runs,
+    not if it raises or the caller stops reading it."""
+
+    def __init__(self, model: AnswersModelI, cache: AnswersCache, assistant_id: str,
+                 files_fingerprint: Callable[[str], str]):
+        self.model = model
+        self.cache = cache
+        self.assistant_id = assistant_id
+        self.files_fingerprint = files_fingerprint
+
+    def answer(self, question: str, vector_store_id: str) -> LLMAnswer:
+        fingerprint = self.files_fingerprint(vector_store_id)
+        answer = self.cache.get(question, vector_store_id, self.assistant_id, fingerprint)
+        if answer is None:
+            answer = self.model.answer(question, vector_store_id)
+            self.cache.set(question, vector_store_id, self.assistant_id, fingerprint, answer)
+        return answer
+
+    def answer_stream(self, question: str, vector_store_id: str) -> Iterator[AnswerDelta]:
+        fingerprint = self.files_fingerprint(vector_store_id)
+        answer = self.cache.get(question, vector_store_id, self.assistant_id, fingerprint)
+        if answer is not None:
+            yield from answer_to_deltas(answer)
+            return
+
+        deltas = []
+        for delta in self.model.answer_stream(question, vector_store_id):
+            deltas.append(delta)
+            yield delta
+        self.cache.set(question, vector_store_id, self.assistant_id, fingerprint, deltas_to_answer(deltas))
+
+
+def build_answers_cache(db_file: Path | str, lru_size: int = DEFAULT_LRU_SIZE) -> AnswersCache:
+    """An answers cache in memory in front of the SQLite file."""
+    return AnswersCache(LayeredAnswersCacheStorage([
+        LRUAnswersCacheStorage(lru_size),
+        SQLiteAnswersCacheStorage(db_file)]))
@@ -1,11 +1,17 @@
+import asyncio
+import re
+import time
 from concurrent.futures import thread
 from time import sleep
-from typing import Protocol
-from openai import OpenAI
-from openai.types.beta.threads import Message
+from typing import Iterator, Literal, Protocol
+from openai import NOT_GIVEN, APITimeoutError, AsyncOpenAI, NotGiven, OpenAI
+from openai.types.beta.threads import Message, Run
 from pydantic import BaseModel
 
 from model.files_manager import FilesManagerI
+from model.run_polling import (RunFailedError, RunPoller, RunPollingConfig, RunPollState, RunStatusCallback,
+                               RunTimeoutError, cancel_run, cancel_run_async)
+from utils.tracing import current_trace, span
 
 
 class OpenAIConfig(BaseModel):
@@ -25,14 +31,70 @@ class LLMAnswer(BaseModel):
     run_id: str
 
 
+class AnswerDelta(BaseModel):
+    """A piece of a streamed answer. The first one carries the thread and run ids."""
+    text: str = ""
+    references: list[FileAnnotation] = []
+    thread_id: str | None = None
+    run_id: str | None = None
+
+
+def answer_to_deltas(answer: LLMAnswer) -> Iterator[AnswerDelta]:
+    """Splits a complete answer in deltas, each citation in its own one."""
+    yield AnswerDelta(thread_id=answer.thread_id, run_id=answer.run_id)
+    if len(answer.references) == 0:
+        yield AnswerDelta(text=answer.answer)
+        return
+
+    markers = "|".join(re.escape(r.text) for r in answer.references)
+    for piece in re.split(f"({markers})", answer.answer):
+        references = [r for r in answer.references if r.text == piece]
+        yield AnswerDelta(text=piece, references=references)
+
+
+def deltas_to_answer(deltas: list[AnswerDelta]) -> LLMAnswer:
+    return LLMAnswer(
+        answer="".join(d.text for d in deltas),
+        references=[r for d in deltas for r in d.references],
+        thread_id=next((d.thread_id for d in deltas if d.thread_id), ""),
+        run_id=next((d.run_id for d in deltas if d.run_id), ""))
+
+
 class QuestionsAnswersI(Protocol):
     def answer(self, question: str, vector_store_id: str) -> LLMAnswer: ...
 
 
+class StreamingQuestionsAnswersI(Protocol):
+    def answer_stream(self, question: str, vector_store_id: str) -> Iterator[AnswerDelta]: ...
+
+
+class AsyncQuestionsAnswersI(Protocol):
+    async def answer(self, question: str, vector_store_id: str) -> LLMAnswer: ...
+
+
+def llm_answer_from_message(message: Message, thread_id: str, run_id: str) -> LLMAnswer:
+    content = message.content[0]
+    references = []
+    for annotation in content.text.annotations:  # type: ignore
+        annotation_obj = FileAnnotation(
+            text=annotation.text, 
+            file_id=annotation.file_citation.file_id)  # type: ignore
+        references.append(annotation_obj)
+
+    return LLMAnswer(
+        answer=content.text.value,  # type: ignore
+        references=references,
+        thread_id=thread_id,
+        run_id=run_id)
+
+
 class QuestionsAnswersMock:
 
+    def __init__(self, delay: float = 1.0):
+        self.delay = delay  # Seconds per answer, like a run of the assistant
+
     def answer(self, _: str, __: str) -> LLMAnswer:
-        sleep(1)
+        sleep(self.delay)
         answer = "This is a mock answer\n\n[[REF 1]]\n\n[[REF 2]]"
         references = [
             FileAnnotation(text="[[REF 1]]", file_id="mock_file_1"),
@@ -44,55 +106,210 @@ class QuestionsAnswersMock:
             thread_id="mock_thread_id",
             run_id="mock_run_id")
 
+    def answer_stream(self, question: str, vector_store_id: str) -> Iterator[AnswerDelta]:
+        yield from answer_to_deltas(self.answer(question, vector_store_id))
+
+
+class ThreadMessage(BaseModel):
+    role: Literal["user", "assistant"]
+    content: str
+
 
 class QuestionsAnswers:
-    def __init__(self, client: OpenAI, assistant_id: str):
+    """Runs are polled with the schedule of `polling`, `on_status` is called on every status change."""
+
+    def __init__(self, client: OpenAI, assistant_id: str, polling: RunPollingConfig | None = None,
+                 on_status: RunStatusCallback | None = None):
 
         self.client = client
         self.assistant = self.client.beta.assistants.retrieve(assistant_id)
+        self.poller = RunPoller(polling, on_status)
+
+    def create_thread(self, vector_store_id: str, history: list[ThreadMessage] | None = None) -> str:
+        """A new thread on the vector store, starting with the `history` messages."""
+        with span("openai.thread_create"):
+            thread = self.client.beta.threads.create(
+                messages=[m.model_dump() for m in history or []],
+                tool_resources={
+                    "file_search": {"vector_store_ids": [vector_store_id]}
+                }
+            )
+        return thread.id
 
     def answer(self, question: str, vector_store_id: str) -> LLMAnswer:
+        return self.answer_in_thread(question, self.create_thread(vector_store_id))
+
+    def answer_in_thread(self, question: str, thread_id: str) -> LLMAnswer:
+        """Answers in an existing thread, with the previous messages as context."""
+        with span("openai.message_create"):
+            self.client.beta.threads.messages.create(
+                thread_id=thread_id,
+                role="user",
+                content=question
+            )
+
+        with span("openai.run"):
+            run = self.client.beta.threads.runs.create(
+                thread_id=thread_id,
+                assistant_id=self.assistant.id
+            )
+            run = self.poller.poll(self.client, thread_id, run.id)
+
+        if run.status == 'completed':
+            with span("openai.messages_list"):
+                messages = self.client.beta.threads.messages.list(
+                    thread_id=thread_id
+                )
+            m: Message = messages.data[0]
+            return llm_answer_from_message(m, thread_id, run.id)
+
+        else:
+            raise RunFailedError(f"Thread run failed with status {run.status}")
+
+    def answer_stream(self, question: str, vector_store_id: str) -> Iterator[AnswerDelta]:
+        """Same as `answer`, but yields the text and citations as the run produces them.
+        Only ends normally once the run completed, otherwise raises RunFailedError."""
+        yield from self.answer_stream_in_thread(question, self.create_thread(vector_store_id))
+
+    def answer_stream_in_thread(self, question: str, thread_id: str) -> Iterator[AnswerDelta]:
+        """The `openai.run` stage includes the time the caller takes to consume the deltas.
+        The run events go through the status hooks and timeouts of the polled runs: a run past
+        the deadline, queued for too long, or without events for that long, is cancelled
+        and raises RunTimeoutError."""
+        with span("openai.message_create"):
+            self.client.beta.threads.messages.create(
+                thread_id=thread_id,
+                role="user",
+                content=question
+            )
+
+        config = self.poller.config
+        state = RunPollState(config, self.poller.on_status, self.poller.clock)
+        timeouts = [t for t in (config.deadline, config.queued_timeout) if t is not None]
+        try:
+            yield from self._stream_run(thread_id, state, min(timeouts) if timeouts else NOT_GIVEN)
+        except APITimeoutError as e:
+            run = state.run
+            if run is None:
+                raise
+            cancel_run(self.client, thread_id, run.id)
+            raise RunTimeoutError(f"Run {run.id} sent no events for {min(timeouts)} s", run) from e
+        except RunTimeoutError as e:
+            cancel_run(self.client, thread_id, e.run.id)
+            raise
+
+    def _stream_run(self, thread_id: str, state: RunPollState,
+                    read_timeout: float | NotGiven) -> Iterator[AnswerDelta]:
+        trace = current_trace()
+        started_at = time.perf_counter()
+        first_token = True
+        completed = False
+        with span("openai.run"), self.client.beta.threads.runs.stream(
+                thread_id=thread_id, 
+                assistant_id=self.assistant.id,
+                timeout=read_timeout) as stream:
+            for event in stream:
+                # Every event checks the timeouts, run events also update the status
+                if isinstance(event.data, Run):
+                    state.update(event.data)
+                elif state.run is not None:
+                    state.update(state.run)
 
-        thread = self.client.beta.threads.create(
+                if first_token and trace is not None and event.event == "thread.message.delta":
+                    trace.add("openai.first_token", started_at, time.perf_counter())
+                    first_token = False
+
+                if event.event == "thread.run.created":
+                    yield AnswerDelta(thread_id=thread_id, run_id=event.data.id)
+
+                elif event.event == "thread.message.delta":
+                    for content in event.data.delta.content or []:
+                        if content.type != "text" or content.text is None:
+                            continue
+                        references = [
+                            FileAnnotation(text=a.text, file_id=a.file_citation.file_id)  # type: ignore
+                            for a in content.text.annotations or [] 
+                            if a.type == "file_citation" and a.text is not None]
+                        yield AnswerDelta(text=content.text.value or "", references=references)
+
+                elif event.event == "thread.run.completed":
+                    completed = True
+
+                elif event.event == "thread.run.requires_action":
+                    # The assistant has no functions to call, the run would wait until it expires
+                    cancel_run(self.client, thread_id, event.data.id)
+                    raise RunFailedError(f"Thread run {event.data.id} requires an action")
+
+                elif event.event in ("thread.run.failed", "thread.run.cancelled",
+                                     "thread.run.expired", "thread.run.incomplete"):
+                    raise RunFailedError(f"Thread run failed with status {event.data.status}")
+
+                elif event.event == "error":
+                    raise RunFailedError(f"Thread run stream error: {event.data.message}")
+
+        if not completed:
+            raise RunFailedError(f"Thread run stream of {thread_id} ended before the run completed")
+
+
+class AsyncQuestionsAnswers:
+    """QuestionsAnswers on AsyncOpenAI, so several questions (or data versions)
+    can be answered concurrently from one process.
+    Answers that take longer than `timeout` seconds, or whose task is cancelled,
+    cancel their run in the server. Runs are polled with the schedule of `polling`."""
+
+    def __init__(self, client: AsyncOpenAI, assistant_id: str, timeout: float | None = None,
+                 polling: RunPollingConfig | None = None):
+        self.client = client
+        self.assistant_id = assistant_id
+        self.timeout = timeout
+        self.poller = RunPoller(polling)
+
+    @classmethod
+    async def create(cls, client: AsyncOpenAI, assistant_id: str, timeout: float | None = None,
+                     polling: RunPollingConfig | None = None) -> 'AsyncQuestionsAnswers':
+        assistant = await client.beta.assistants.retrieve(assistant_id)
+        return cls(client, assistant.id, timeout, polling)
+
+    async def answer(self, question: str, vector_store_id: str) -> LLMAnswer:
+        return await asyncio.wait_for(self._answer(question, vector_store_id), self.timeout)
+
+    async def answer_many(self, questions: list[tuple[str, str]]) -> list[LLMAnswer | BaseException]:
+        """Answers (question, vector_store_id) pairs concurrently, failed answers are returned as exceptions."""
+        return await asyncio.gather(
+            *(self.answer(question, vector_store_id) for question, vector_store_id in questions),
+            return_exceptions=True)
+
+    async def _answer(self, question: str, vector_store_id: str) -> LLMAnswer:
+        thread = await self.client.beta.threads.create(
             tool_resources={
                 "file_search": {"vector_store_ids": [vector_store_id]}
             }
         )
-        
-        self.client.beta.threads.messages.create(
+
+        await self.client.beta.threads.messages.create(
             thread_id=thread.id,
             role="user",
             content=question
         )
 
-        run = self.client.beta.threads.runs.create_and_poll(
+        run = await self.client.beta.threads.runs.create(
             thread_id=thread.id,
-            assistant_id=self.assistant.id
+            assistant_id=self.assistant_id
         )
 
-        if run.status == 'completed':
-            messages = self.client.beta.threads.messages.list(
-                thread_id=thread.id
-            )
-            m: Message = messages.data[0]
-            content = m.content[0]
-            references = []
-            for annotation in content.text.annotations:  # type: ignore
-                annotation_obj = FileAnnotation(
-                    text=annotation.text, 
-                    file_id=annotation.file_citation.file_id)  # type: ignore
-                references.append(annotation_obj)
-
-            llm_answer = LLMAnswer(
-                answer=content.text.value,  # type: ignore
-                references=references,
-                thread_id=thread.id,
-                run_id=run.id)
-
-            return llm_answer
+        try:
+            run = await self.poller.poll_async(self.client, thread.id, run.id)
+        except asyncio.CancelledError:
+            await asyncio.shield(cancel_run_async(self.client, thread.id, run.id))
+            raise
 
-        else:
-            raise Exception(f"Thread run failed with status {run.status}")
+        if run.status != 'completed':
+            raise RunFailedError(f"Thread run failed with status {run.status}")
+
+        messages = await self.client.beta.threads.messages.list(
+            thread_id=thread.id
+        )
+        return llm_answer_from_message(messages.data[0], thread.id, run.id)
 
 
 class MarkdownAnswer(BaseModel):
@@ -101,28 +318,66 @@ class MarkdownAnswer(BaseModel):
     references_urls: set[str]
     thread_id: str
     run_id: str
+    timings: dict[str, float] = {}  # Seconds per stage, when the answer was traced
 
     @classmethod
     def from_llm_answer(cls, answer: LLMAnswer, files_manager: FilesManagerI) -> 'MarkdownAnswer':
-        answer_text = answer.answer
-        references = []
-        references_urls = set()
-        for i, r in enumerate(answer.references):
+        builder = MarkdownAnswerBuilder(files_manager, answer.thread_id, answer.run_id)
+        builder.add(AnswerDelta(text=answer.answer, references=answer.references))
+        return builder.build()
+
+
+# A citation marker that has not been fully streamed yet
+PARTIAL_CITATION = re.compile(r"【[^】]*$")
+
+
+class MarkdownAnswerBuilder:
+    """Builds a MarkdownAnswer from a streamed answer.
+    References are resolved as soon as their citation arrives, so the partial
+    answer can be rendered after every delta."""
+
+    def __init__(self, files_manager: FilesManagerI, thread_id: str = "", run_id: str = ""):
+        self.files_manager = files_manager
+        self.thread_id = thread_id
+        self.run_id = run_id
+        self.raw_text = ""
+        self.annotations: list[FileAnnotation] = []
+        self.references: list[str] = []
+        self.references_urls: set[str] = set()
+
+    def add(self, delta: AnswerDelta):
+        self.thread_id = delta.thread_id or self.thread_id
+        self.run_id = delta.run_id or self.run_id
+        self.raw_text += delta.text
+        for annotation in delta.references:
+            self._add_reference(annotation)
+
+    def _add_reference(self, annotation: FileAnnotation):
+        i = len(self.annotations)
+        self.annotations.append(annotation)
+
+        file_link = self.files_manager.get_file_link(annotation.file_id)
+        file_name = file_link.name
+        file_url = file_link.url
+        reference_text = f" {i + 1}. [{file_name}]({file_url})\n\n"
+
+        if file_url in self.references_urls:
+            return
+
+        self.references.append(reference_text)
+        self.references_urls.add(file_url)
+
+    @property
+    def text(self) -> str:
+        answer_text = self.raw_text
+        for i, r in enumerate(self.annotations):
             reference_text = f" [ Referencia #{i + 1} ]"
             answer_text = answer_text.replace(r.text, reference_text)
+        return PARTIAL_CITATION.sub("", answer_text)
 
-            file_link = files_manager.get_file_link(r.file_id)
-            file_name = file_link.name
-            file_url = file_link.url
-            reference_text = f" {i + 1}. [{file_name}]({file_url})\n\n"
-
-            if file_url in references_urls:
-                continue
-
-            references.append(reference_text)
-            references_urls.add(file_url)
-        return cls(text=answer_text, 
-                   references=references, 
-                   references_urls=references_urls,
-                   thread_id=answer.thread_id,
-                   run_id=answer.run_id)
+    def build(self) -> MarkdownAnswer:
+        return MarkdownAnswer(text=self.text, 
+                              references=list(self.references), 
+                              references_urls=set(self.references_urls),
+                              thread_id=self.thread_id,
+                              run_id=self.run_id)
@@ -0,0 +1,128 @@
+import threading
+import time
+from typing import Iterator
+
+from openai import OpenAI
+from pydantic import BaseModel
+
+from model.answers_generation import AnswerDelta, LLMAnswer, QuestionsAnswers, ThreadMessage
+
+
+DEFAULT_IDLE_TIMEOUT = 30 * 60.0
+
+# A conversation (e.g. a Streamlit session) on a vector store
+ConversationKey = tuple[str, str]
+
+
+class ConversationThread(BaseModel):
+    thread_id: str
+    last_used: float
+
+
+class ThreadsPool:
+    """The assistant thread of every open conversation.
+    Threads idle for more than `idle_timeout` seconds are dropped and deleted in the
+    server, checked in a background thread at most once every `idle_timeout / 10`."""
+
+    def __init__(self, client: OpenAI, idle_timeout: float = DEFAULT_IDLE_TIMEOUT):
+        self.client = client
+        self.idle_timeout = idle_timeout
+        self._threads: dict[ConversationKey, ConversationThread] = {}
+        self._lock = threading.Lock()
+        self._last_expiry = time.monotonic()
+
+    def get(self, key: ConversationKey) -> str | None:
+        self._schedule_expiry()
+        with self._lock:
+            thread = self._threads.get(key, None)
+            if thread is None or time.monotonic() - thread.last_used > self.idle_timeout:
+                return None
+            thread.last_used = time.monotonic()
+            return thread.thread_id
+
+    def add(self, key: ConversationKey, thread_id: str):
+        with self._lock:
+            previous = self._threads.get(key, None)
+            self._threads[key] = ConversationThread(thread_id=thread_id, last_used=time.monotonic())
+        if previous is not None and previous.thread_id != thread_id:
+            self._delete_threads([previous.thread_id])
+
+    def close(self, conversation_id: str):
+        """Deletes the threads of the conversation, on every vector store."""
+        with self._lock:
+            keys = [key for key in self._threads if key[0] == conversation_id]
+            thread_ids = [self._threads.pop(key).thread_id for key in keys]
+        self._delete_threads(thread_ids)
+
+    def expire_idle(self) -> list[str]:
+        """Deletes the idle threads and returns their ids."""
+        now = time.monotonic()
+        with self._lock:
+            self._last_expiry = now
+            keys = [key for key, thread in self._threads.items() if now - thread.last_used > self.idle_timeout]
+            thread_ids = [self._threads.pop(key).thread_id for key in keys]
+        self._delete_threads(thread_ids)
+        return thread_ids
+
+    def _schedule_expiry(self):
+        with self._lock:
+            due = time.monotonic() - self._last_expiry > self.idle_timeout / 10
+            if due:
+                self._last_expiry = time.monotonic()
+        if due:
+            threading.Thread(target=self.expire_idle, daemon=True).start()
+
+    def _delete_threads(self, thread_ids: list[str]):
+        for thread_id in thread_ids:
+            try:
+                self.client.beta.threads.delete(thread_id)
+            except Exception as e:
+                print(f"Error deleting thread {thread_id}: {e}")
+
+
+class ConversationQuestionsAnswers:
+    """Answers the messages of a conversation in one assistant thread per vector store,
+    so the model keeps the context of the previous turns.
+
+    A conversation without a thread (new, expired, or answered from a cache so far)
+    gets one starting with the `history` messages."""
+
+    def __init__(self, model: QuestionsAnswers, threads: ThreadsPool):
+        self.model = model
+        self.threads = threads
+
+    def _thread(self, vector_store_id: str, conversation_id: str, history: list[ThreadMessage]) -> str:
+        key = (conversation_id, vector_store_id)
+        thread_id = self.threads.get(key)
+        if thread_id is None:
+            thread_id = self.model.create_thread(vector_store_id, history)
+            self.threads.add(key, thread_id)
+        return thread_id
+
+    def answer(self, question: str, vector_store_id: str, conversation_id: str,
+               history: list[ThreadMessage] | None = None) -> LLMAnswer:
+        thread_id = self._thread(vector_store_id, conversation_id, history or [])
+        return self.model.answer_in_thread(question, thread_id)
+
+    def answer_stream(self, question: str, vector_store_id: str, conversation_id: str,
+                      history: list[ThreadMessage] | None = None) -> Iterator[AnswerDelta]:
+        thread_id = self._thread(vector_store_id, conversation_id, history or [])
+        yield from self.model.answer_stream_in_thread(question, thread_id)
+
+    def conversation(self, conversation_id: str) -> 'ConversationAnswers':
+        return ConversationAnswers(self, conversation_id)
+
+
+class ConversationAnswers:
+    """The first turn of a conversation as a plain answer model, so it can go behind the
+    answers caches. A question the caches miss starts the conversation thread."""
+
+    def __init__(self, model: ConversationQuestionsAnswers, conversation_id: str):
+        self.model = model
+        self.conversation_id = conversation_id
+
+    def answer(self, question: str, vector_store_id: str) -> LLMAnswer:
+        return self.model.answer(question, vector_store_id, self.conversation_id)
+
+    def answer_stream(self, question: str, vector_store_id: str) -> Iterator[AnswerDelta]:
+        yield from self.model.answer_stream(question, vector_store_id, self.conversation_id)
@@ -1,5 +1,13 @@
+import atexit
+import json
+import queue
+import re
+import sqlite3
+import threading
+import time
 from concurrent.futures import thread
-from typing import Literal
+from pathlib import Path
+from typing import Any, Callable, Literal, Protocol
 
 from googleapiclient.discovery import build
 from pydantic import BaseModel
@@ -23,7 +31,8 @@ COLUMNS_MAPPING = {
     "La respuesta fue detallada?": "was_detailed",
     "Sugerencia": "note",
     "Thread ID": "thread_id",
-    "Run ID": "run_id"
+    "Run ID": "run_id",
+    "Timings": "timings"    # Optional column
 }
 
 
@@ -39,32 +48,96 @@ class TestLog(BaseModel):
     note: str | None
     thread_id: str
     run_id: str
+    timings: dict[str, float] | None = None    # Seconds per stage of the answer, when traced
+
+
+FeedbackSink = Literal["sheets", "jsonl", "sqlite"]
 
 
 class FeedbackLogsConfig(BaseModel):
     spreadsheet_id: str
     sheet_name: str
+    sink: FeedbackSink = "sheets"
+    max_batch: int = 20         # Logs written with a single call
+    max_delay: float = 2.0      # Seconds a log can wait for the batch to fill
+    max_attempts: int = 3       # Failed writes of a batch before it goes to the fallback sink
+
+
+# The rows of an A1 range, e.g. "FeedbackLogs!A12:M31"
+A1_ROWS = re.compile(r"!\$?[A-Z]+\$?(\d+)(?::\$?[A-Z]+\$?(\d+))?$")
+
+
+def appended_rows(response: dict[str, Any] | None) -> tuple[int, int] | None:
+    """The first and last rows written by an append, from the updatedRange of its response."""
+    match = A1_ROWS.search(((response or {}).get("updates", {})).get("updatedRange", ""))
+    if match is None:
+        return None
+    return int(match[1]), int(match[2] or match[1])
+
+
+class FeedbackLogWriter(Protocol):
+    def write(self, test_log: TestLog): ...
+
+
+class FeedbackLogSink(Protocol):
+    def write_many(self, test_logs: list[TestLog]): ...
 
 
 class SheetLogWriter:
     def __init__(self, sheet_service: SheetServiceFacade, config: FeedbackLogsConfig):
         self.sheet_service = sheet_service
         self.config = config
+        self._headers: list[str] | None = None
+
+    @property
+    def headers(self) -> list[str]:
+        """The sheet columns, read once."""
+        if self._headers is None:
+            self._headers = self.sheet_service.get(self.config.spreadsheet_id, f"{self.config.sheet_name}!1:1")[0]
+        return self._headers
 
     def write(self, test_log: TestLog):
-        headers = self.sheet_service.get(self.config.spreadsheet_id, f"{self.config.sheet_name}!1:1")
-        last_id = len(self.sheet_service.get(self.config.spreadsheet_id , f"{self.config.sheet_name}!A:A"))
+        self.write_many([test_log])
 
-        init_dict = test_log.model_dump()
-        init_dict.update({"id": last_id})
-        init_dict.update({"sources": ",".join(init_dict["sources"])})
+    def write_many(self, test_logs: list[TestLog]):
+        """Appends the logs with a single call, then writes their ids: the row number minus
+        the header, from the rows the append reports, so concurrent writers can't repeat them.
+        Rows whose ids can't be written are kept without them."""
+        if len(test_logs) == 0:
+            return
 
-        values_list = [init_dict[COLUMNS_MAPPING[header]] for header in headers[0]]
+        rows = []
+        for test_log in test_logs:
+            init_dict = test_log.model_dump()
+            init_dict.update({"id": ""})
+            init_dict.update({"sources": ",".join(init_dict["sources"] or [])})
+            init_dict.update({"timings": json.dumps(init_dict["timings"]) if init_dict["timings"] else ""})
+            rows.append([init_dict[COLUMNS_MAPPING[header]] for header in self.headers])
 
-        self.sheet_service.update(
-            self.config.spreadsheet_id, 
-            f"{self.config.sheet_name}!A{last_id + 1}", 
-            [values_list])
+        # Up to L, or further when the sheet has the optional columns
+        last_column = chr(ord("A") + max(len(self.headers), 12) - 1)
+        response = self.sheet_service.append(
+            self.config.spreadsheet_id,
+            f"{self.config.sheet_name}!A:{last_column}",
+            rows)
+        self._write_ids(response, len(rows))
+
+    def _write_ids(self, response: dict[str, Any] | None, count: int):
+        written = appended_rows(response)
+        if written is None or written[1] - written[0] + 1 != count:
+            print(f"Unknown rows of {count} feedback logs, written without ids")
+            return
+
+        first, last = written
+        id_column = chr(ord("A") + self.headers.index("ID"))
+        try:
+            self.sheet_service.update(
+                self.config.spreadsheet_id,
+                f"{self.config.sheet_name}!{id_column}{first}:{id_column}{last}",
+                [[row - 1] for row in range(first, last + 1)])
+        except Exception as e:
+            # Not raised, the batch would be appended again
+            print(f"Error writing the ids of feedback rows {first} to {last}: {e}")
 
     def get_all(self) -> list[TestLog]:
         result = self.sheet_service.get(
@@ -72,4 +145,177 @@ class SheetLogWriter:
             f"{self.config.sheet_name}!A2:L")
 
         return [TestLog(**dict(zip(COLUMNS_MAPPING.values(), r))) for r in result]
-        
\ No newline at end of file
+
+
+class JSONLLogWriter:
+    """Appends the logs to a local JSON lines file."""
+
+    def __init__(self, file: Path):
+        self.file = file
+        self._lock = threading.Lock()
+
+    def write(self, test_log: TestLog):
+        self.write_many([test_log])
+
+    def write_many(self, test_logs: list[TestLog]):
+        with self._lock, open(self.file, "a", encoding="utf8") as f:
+            f.write("".join(test_log.model_dump_json() + "\n" for test_log in test_logs))
+
+    def get_all(self) -> list[TestLog]:
+        if not self.file.exists():
+            return []
+        with open(self.file, "r", encoding="utf8") as f:
+            return [TestLog.model_validate_json(line) for line in f if line.strip()]
+
+
+class SQLiteLogWriter:
+    """Stores the logs in a local SQLite file, each batch in one transaction."""
+
+    def __init__(self, db_file: Path | str):
+        self.db_file = db_file
+        self._connection = sqlite3.connect(db_file, check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS feedback_logs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "log TEXT NOT NULL)")
+
+    def write(self, test_log: TestLog):
+        self.write_many([test_log])
+
+    def write_many(self, test_logs: list[TestLog]):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT INTO feedback_logs (log) VALUES (?)", [(t.model_dump_json(),) for t in test_logs])
+
+    def get_all(self) -> list[TestLog]:
+        with self._lock:
+            rows = self._connection.execute("SELECT log FROM feedback_logs ORDER BY id").fetchall()
+        return [TestLog.model_validate_json(row[0]) for row in rows]
+
+
+class QueuedLogWriter:
+    """Returns from `write` at once, a background thread writes the logs to the sink
+    in batches of up to `max_batch`, waiting at most `max_delay` seconds for a batch
+    to fill. Failed batches are retried on their own, so a batch the sink rejects
+    doesn't hold back the next ones, and after `max_attempts` they are written to
+    `fallback`, if given.
+
+    Pending logs are flushed on `close`, called at exit. Logs the sink still can't
+    take then are written to `fallback`, so no feedback is lost."""
+
+    def __init__(self, sink: FeedbackLogSink, max_batch: int = 20, max_delay: float = 2.0,
+                 fallback: FeedbackLogSink | None = None, max_attempts: int = 3):
+        self.sink = sink
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.fallback = fallback
+        self.max_attempts = max_attempts
+        self._queue: queue.Queue[TestLog] = queue.Queue()
+        self._failed: list[tuple[list[TestLog], int]] = []     # Batches and their failed attempts
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, test_log: TestLog):
+        if self._closed.is_set():
+            raise RuntimeError("The log writer is closed")
+        self._queue.put(test_log)
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return self._queue.qsize() + sum(len(batch) for batch, _ in self._failed)
+
+    def flush(self) -> bool:
+        """Writes every pending log now, returns whether none is left pending."""
+        with self._lock:
+            return self._write_pending(self._drain())
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._thread.join()
+        if not self.flush() and self.fallback is not None:
+            with self._lock:
+                batch = [log for logs, _ in self._failed for log in logs]
+                self._failed = []
+                self.fallback.write_many(batch)
+                print(f"Wrote {len(batch)} feedback logs to the fallback sink")
+
+    def _drain(self) -> list[TestLog]:
+        logs = []
+        while True:
+            try:
+                logs.append(self._queue.get_nowait())
+            except queue.Empty:
+                return logs
+
+    def _next_batch(self) -> list[TestLog]:
+        """Waits for a log, then up to `max_delay` seconds for the batch to fill."""
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch and not self._closed.is_set():
+            try:
+                batch.append(self._queue.get(timeout=max(0.0, min(0.1, deadline - time.monotonic()))))
+            except queue.Empty:
+                if time.monotonic() >= deadline:
+                    break
+        return batch
+
+    def _run(self):
+        while not self._closed.is_set():
+            batch = self._next_batch()
+            with self._lock:
+                written = self._write_pending(batch)
+            if not written:
+                self._closed.wait(self.max_delay)
+
+    def _write_pending(self, batch: list[TestLog]) -> bool:
+        """Writes the failed batches and then `batch` under the lock, returns whether none failed."""
+        batches, self._failed = self._failed + [(batch, 0)], []
+        results = [self._write(logs, attempts) for logs, attempts in batches]
+        return all(results)
+
+    def _write(self, batch: list[TestLog], attempts: int) -> bool:
+        """Keeps the batch for later if it fails, or writes it to the fallback after `max_attempts`."""
+        if len(batch) == 0:
+            return True
+        try:
+            self.sink.write_many(batch)
+            return True
+        except Exception as e:
+            print(f"Error writing {len(batch)} feedback logs: {e}")
+            attempts += 1
+
+        if attempts >= self.max_attempts and self.fallback is not None:
+            try:
+                self.fallback.write_many(batch)
+                print(f"Wrote {len(batch)} feedback logs to the fallback sink after {attempts} attempts")
+                return True
+            except Exception as e:
+                print(f"Error writing {len(batch)} feedback logs to the fallback sink: {e}")
+        self._failed.append((batch, attempts))
+        return False
+
+
+def build_feedback_log_writer(sheet_service: SheetServiceFacade, config: FeedbackLogsConfig,
+                              logs_file: Path) -> QueuedLogWriter:
+    """The queued writer of the configured sink. The local sinks store in `logs_file`
+    (.jsonl or .db), the sheets one falls back to it at exit."""
+    jsonl_writer = JSONLLogWriter(logs_file.with_suffix(".jsonl"))
+    sinks: dict[FeedbackSink, Callable[[], FeedbackLogSink]] = {
+        "sheets": lambda: SheetLogWriter(sheet_service, config),
+        "jsonl": lambda: jsonl_writer,
+        "sqlite": lambda: SQLiteLogWriter(logs_file.with_suffix(".db")),
+    }
+    return QueuedLogWriter(sinks[config.sink](), config.max_batch, config.max_delay,
+                           fallback=jsonl_writer if config.sink != "jsonl" else None,
+                           max_attempts=config.max_attempts)
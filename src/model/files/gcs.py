@@ -16,6 +16,10 @@ class GCSFile(BaseModel):
     name: str
     content_type: str
     updated: datetime
+    md5_hash: str | None = None
+    crc32c: str | None = None
+    generation: int | None = None
+    size: int | None = None
 
     @classmethod
     def from_blob(cls, blob: Blob) -> 'GCSFile':
@@ -24,6 +28,10 @@ class GCSFile(BaseModel):
             name=blob.name,                     # type: ignore
             content_type=blob.content_type,
             updated=blob.updated,               # type: ignore
+            md5_hash=blob.md5_hash,
+            crc32c=blob.crc32c,
+            generation=blob.generation,
+            size=blob.size,
         )
     
     @property
@@ -42,4 +50,13 @@ class GCSFile(BaseModel):
     @property
     def source_id(self) -> str:
         return f"{self.file_folder}/{self.file_name}"
-        
+
+    @property
+    def content_hash(self) -> str | None:
+        """Checksum of the content, composite objects have no md5 so crc32c is the fallback."""
+        if self.md5_hash is not None:
+            return f"md5:{self.md5_hash}"
+        if self.crc32c is not None:
+            return f"crc32c:{self.crc32c}"
+        return None
+
@@ -1,10 +1,14 @@
+import hashlib
 import json
+import threading
+import time
 from pathlib import Path
 from typing import Protocol
 
 from pydantic import BaseModel
 
-from ingestion.db_manager import VectorStoreFilesDB
+from ingestion.db_manager import VectorStoreFilesDBI
+from utils.tracing import traced
 
 
 class VectorStoreFile(BaseModel):
@@ -50,12 +54,92 @@ def in_memory_files_manager_from_json(file: Path) -> InMemoryFilesManager:
     return files_manager
 
 
+DEFAULT_IDS_MAPPING_TTL = 300.0
+
+
+class IdsMappingCache:
+    """Caches the file id -> source id mapping of a VectorStoreFilesDB.
+    The mapping is loaded once, by a single caller while the others wait for it, and,
+    when older than `ttl` seconds, refreshed in a background thread while the stale
+    copy keeps being served. Loads that started before an `invalidate` aren't kept."""
+
+    def __init__(self, files_db: VectorStoreFilesDBI, ttl: float = DEFAULT_IDS_MAPPING_TTL):
+        self.files_db = files_db
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._mapping: dict[str, str] | None = None
+        self._loaded_at = 0.0
+        self._generation = 0    # Increased by every invalidate
+        self._refreshing = False
+
+    def get(self) -> dict[str, str]:
+        with self._lock:
+            mapping = self._mapping
+            stale = time.monotonic() - self._loaded_at > self.ttl
+            start_refresh = mapping is not None and stale and not self._refreshing
+            if start_refresh:
+                self._refreshing = True
+
+        if mapping is None:
+            return self._load()
+
+        if start_refresh:
+            threading.Thread(target=self._background_refresh, daemon=True).start()
+        return mapping
+
+    def _load(self) -> dict[str, str]:
+        with self._load_lock:
+            # Loaded by the previous holder, or again if it was invalidated meanwhile
+            while True:
+                with self._lock:
+                    if self._mapping is not None:
+                        return self._mapping
+                self.refresh()
+
+    def refresh(self) -> dict[str, str]:
+        """Reads the mapping, it's only cached if the cache wasn't invalidated meanwhile."""
+        with self._lock:
+            generation = self._generation
+        mapping = self.files_db.get_ids_mapping()
+        with self._lock:
+            if generation == self._generation:
+                self._mapping = mapping
+                self._loaded_at = time.monotonic()
+        return mapping
+
+    def fingerprint(self) -> str:
+        """Changes whenever the set of files in the vector store changes."""
+        file_ids = "\n".join(sorted(self.get().keys()))
+        return hashlib.sha256(file_ids.encode()).hexdigest()
+
+    def invalidate(self) -> None:
+        """Drops the cached mapping, the next `get` reloads it from the sheet."""
+        with self._lock:
+            self._mapping = None
+            self._loaded_at = 0.0
+            self._generation += 1
+
+    def _background_refresh(self) -> None:
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"Error refreshing ids mapping for '{self.files_db.sheet_name}': {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
 class SheetFilesDB:
-    def __init__(self, files_db: VectorStoreFilesDB):
+    """`ids_mapping` is the cache of the files DB shared by the sessions, a new one by default."""
+
+    def __init__(self, files_db: VectorStoreFilesDBI, ids_mapping: IdsMappingCache | None = None):
         self.files_db = files_db
+        self.ids_mapping = ids_mapping or IdsMappingCache(files_db)
 
+    @traced("files.get_file_link")
     def get_file_link(self, idx: str) -> FileLink:
-        files_dict = self.files_db.get_ids_mapping()
+        files_dict = self.ids_mapping.get()
         file = files_dict.get(idx, None)
         if file is None:
             return FileLink(name="File not found", url="")
@@ -0,0 +1,168 @@
+import asyncio
+import time
+from typing import Callable, Mapping
+
+from openai import AsyncOpenAI, OpenAI
+from openai.types.beta.threads import Run
+from pydantic import BaseModel
+
+from utils.tracing import current_trace
+
+
+TERMINAL_STATUSES = {"requires_action", "cancelled", "completed", "failed", "expired", "incomplete"}
+
+
+class RunPollingConfig(BaseModel):
+    fast_interval: float = 0.1              # Seconds between polls during the first `fast_duration` seconds
+    fast_duration: float = 2.0
+    min_interval: float = 0.25              # Then from `min_interval` up to `max_interval`, times `backoff` each poll
+    max_interval: float = 2.0
+    backoff: float = 1.5
+    server_interval: bool = True            # After the fast polls, follows the interval suggested by the server
+    deadline: float | None = 120.0          # Seconds until an unfinished run is cancelled
+    queued_timeout: float | None = 30.0     # Seconds a run can stay queued before it's cancelled
+
+
+class RunTimeoutError(Exception):
+    """The run was cancelled, it took longer than the deadline or stayed queued for too long."""
+
+    def __init__(self, message: str, run: Run):
+        super().__init__(message)
+        self.run = run
+
+
+class RunFailedError(Exception):
+    """The run ended without completing, or its stream ended before it did."""
+    pass
+
+
+# Called with the run and its previous status (None on the first poll) every time the status changes
+RunStatusCallback = Callable[[Run, str | None], None]
+
+
+def server_interval(headers: Mapping[str, str]) -> float | None:
+    """The seconds to the next poll suggested by the server, if any."""
+    poll_after_ms = headers.get("openai-poll-after-ms", None)
+    return int(poll_after_ms) / 1000 if poll_after_ms is not None else None
+
+
+class RunPollSchedule:
+    """Seconds to wait before each poll of a run. Polls fast at first, since most
+    answers finish in a few seconds, then backs off or follows the server."""
+
+    def __init__(self, config: RunPollingConfig, started_at: float):
+        self.config = config
+        self.started_at = started_at
+        self._interval = config.min_interval
+
+    def next_interval(self, now: float, suggested: float | None = None) -> float:
+        config = self.config
+        elapsed = now - self.started_at
+        if elapsed < config.fast_duration:
+            interval = config.fast_interval
+        elif config.server_interval and suggested is not None:
+            interval = min(max(suggested, config.min_interval), config.max_interval)
+        else:
+            interval = self._interval
+            self._interval = min(self._interval * config.backoff, config.max_interval)
+        # Wakes up at the deadline to cancel the run
+        if config.deadline is not None:
+            interval = max(0.0, min(interval, config.deadline - elapsed))
+        return interval
+
+
+class RunPollState:
+    """The statuses seen while polling a run. Calls `on_status` on every transition and,
+    inside a trace, times each status as the stage `openai.run.<status>`."""
+
+    def __init__(self, config: RunPollingConfig, on_status: RunStatusCallback | None = None,
+                 clock: Callable[[], float] = time.perf_counter):
+        self.config = config
+        self.on_status = on_status
+        self.clock = clock
+        self.started_at = clock()
+        self.schedule = RunPollSchedule(config, self.started_at)
+        self.status: str | None = None
+        self.status_since = self.started_at
+        self.run: Run | None = None    # The last one seen
+
+    def update(self, run: Run):
+        """Raises RunTimeoutError when the run has to be cancelled."""
+        now = self.clock()
+        self.run = run
+        if run.status != self.status:
+            self._end_status(now)
+            previous, self.status, self.status_since = self.status, run.status, now
+            if self.on_status is not None:
+                self.on_status(run, previous)
+        if run.status in TERMINAL_STATUSES:
+            return
+
+        config = self.config
+        if run.status == "queued" and config.queued_timeout is not None \
+                and now - self.status_since >= config.queued_timeout:
+            self._end_status(now)
+            raise RunTimeoutError(f"Run {run.id} queued for more than {config.queued_timeout} s", run)
+        if config.deadline is not None and now - self.started_at >= config.deadline:
+            self._end_status(now)
+            raise RunTimeoutError(f"Run {run.id} not finished after {config.deadline} s", run)
+
+    def _end_status(self, now: float):
+        trace = current_trace()
+        if trace is not None and self.status is not None:
+            trace.add(f"openai.run.{self.status}", self.status_since, now)
+
+
+class RunPoller:
+    """Polls runs until they finish, with the schedule of `config` instead of the
+    fixed interval of `runs.create_and_poll`. Runs past the deadline, or queued for
+    too long, are cancelled and raise RunTimeoutError."""
+
+    def __init__(self, config: RunPollingConfig | None = None, on_status: RunStatusCallback | None = None,
+                 sleep: Callable[[float], None] = time.sleep, clock: Callable[[], float] = time.perf_counter):
+        self.config = config or RunPollingConfig()
+        self.on_status = on_status
+        self.sleep = sleep
+        self.clock = clock
+
+    def poll(self, client: OpenAI, thread_id: str, run_id: str) -> Run:
+        state = RunPollState(self.config, self.on_status, self.clock)
+        while True:
+            response = client.beta.threads.runs.with_raw_response.retrieve(run_id, thread_id=thread_id)
+            run = response.parse()
+            try:
+                state.update(run)
+            except RunTimeoutError:
+                cancel_run(client, thread_id, run_id)
+                raise
+            if run.status in TERMINAL_STATUSES:
+                return run
+            self.sleep(state.schedule.next_interval(self.clock(), server_interval(response.headers)))
+
+    async def poll_async(self, client: AsyncOpenAI, thread_id: str, run_id: str) -> Run:
+        state = RunPollState(self.config, self.on_status, self.clock)
+        while True:
+            response = await client.beta.threads.runs.with_raw_response.retrieve(run_id, thread_id=thread_id)
+            run = response.parse()
+            try:
+                state.update(run)
+            except RunTimeoutError:
+                await cancel_run_async(client, thread_id, run_id)
+                raise
+            if run.status in TERMINAL_STATUSES:
+                return run
+            await asyncio.sleep(state.schedule.next_interval(self.clock(), server_interval(response.headers)))
+
+
+def cancel_run(client: OpenAI, thread_id: str, run_id: str):
+    try:
+        client.beta.threads.runs.cancel(run_id, thread_id=thread_id)
+    except Exception as e:
+        print(f"Error cancelling run {run_id}: {e}")
+
+
+async def cancel_run_async(client: AsyncOpenAI, thread_id: str, run_id: str):
+    try:
+        await client.beta.threads.runs.cancel(run_id, thread_id=thread_id)
+    except Exception as e:
+        print(f"Error cancelling run {run_id}: {e}")
@@ -0,0 +1,220 @@
+import threading
+import zlib
+from typing import Callable, Iterator, Protocol
+
+import numpy as np
+from openai import OpenAI
+from pydantic import BaseModel
+
+from model.answers_cache import DEFAULT_LRU_SIZE, AnswersModelI, CacheStats, normalize_question
+from model.answers_generation import AnswerDelta, LLMAnswer, answer_to_deltas, deltas_to_answer
+
+
+DEFAULT_SEMANTIC_THRESHOLD = 0.9
+DEFAULT_HASHING_DIMENSIONS = 1024
+DEFAULT_HISTOGRAM_BINS = 20
+
+
+class AnswersCacheConfig(BaseModel):
+    lru_size: int = DEFAULT_LRU_SIZE
+    semantic: bool = False
+    semantic_threshold: float = DEFAULT_SEMANTIC_THRESHOLD
+    embedding_model: str = "text-embedding-3-small"
+
+
+class EmbedderI(Protocol):
+    def embed(self, texts: list[str]) -> np.ndarray:
+        """One L2 normalized row per text."""
+        ...
+
+
+def l2_normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class HashingEmbedder:
+    """Offline embedder for tests, the hashed counts of the words and character
+    n-grams of the normalized question. Questions that differ in one word, e.g.
+    "facturas A" and "facturas B", score above any useful threshold, so the app
+    uses OpenAIEmbedder."""
+
+    def __init__(self, dimensions: int = DEFAULT_HASHING_DIMENSIONS, ngram_size: int = 3):
+        self.dimensions = dimensions
+        self.ngram_size = ngram_size
+
+    def _features(self, text: str) -> list[str]:
+        features = []
+        for word in normalize_question(text).split():
+            features.append(word)
+            padded = f" {word} "
+            features.extend(padded[i:i + self.ngram_size] for i in range(len(padded) - self.ngram_size + 1))
+        return features
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                vectors[row, zlib.crc32(feature.encode()) % self.dimensions] += 1
+        return l2_normalize(vectors)
+
+
+class OpenAIEmbedder:
+    def __init__(self, client: OpenAI, model: str = "text-embedding-3-small"):
+        self.client = client
+        self.model = model
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        response = self.client.embeddings.create(model=self.model, input=texts)
+        vectors = np.array([e.embedding for e in sorted(response.data, key=lambda e: e.index)], dtype=np.float32)
+        return l2_normalize(vectors)
+
+
+class SemanticIndex:
+    """The embedded questions of a vector store and their answers, as a matrix
+    searched with a single matrix-vector product."""
+
+    def __init__(self, files_fingerprint: str, dimensions: int):
+        self.files_fingerprint = files_fingerprint
+        self.vectors = np.zeros((0, dimensions), dtype=np.float32)
+        self.answers: list[LLMAnswer] = []
+
+    def __len__(self) -> int:
+        return len(self.answers)
+
+    def search(self, vector: np.ndarray) -> tuple[float, LLMAnswer | None]:
+        """The most similar cached question, as (cosine similarity, answer)."""
+        if len(self) == 0:
+            return 0.0, None
+        scores = self.vectors @ vector
+        best = int(np.argmax(scores))
+        return float(scores[best]), self.answers[best]
+
+    def add(self, vector: np.ndarray, answer: LLMAnswer, max_entries: int):
+        self.vectors = np.vstack([self.vectors, vector[np.newaxis, :]])[-max_entries:]
+        self.answers = (self.answers + [answer])[-max_entries:]
+
+
+class SimilarityHistogram(BaseModel):
+    """Counts of the best similarity score of every lookup, to tune the threshold."""
+    edges: list[float]
+    counts: list[int]
+
+    @classmethod
+    def empty(cls, bins: int = DEFAULT_HISTOGRAM_BINS) -> 'SimilarityHistogram':
+        return cls(edges=np.linspace(0, 1, bins + 1).tolist(), counts=[0] * bins)
+
+    def add(self, score: float):
+        i = int(np.searchsorted(self.edges, score, side="right")) - 1
+        self.counts[min(max(i, 0), len(self.counts) - 1)] += 1
+
+    def above(self, threshold: float) -> int:
+        """Lookups that would be hits with `threshold`, up to the bin resolution."""
+        return sum(c for edge, c in zip(self.edges, self.counts) if edge >= threshold)
+
+
+class SemanticAnswersCache:
+    """Answers by question similarity, one index per assistant and vector store.
+    An index is emptied when the files fingerprint of its vector store changes."""
+
+    def __init__(self, embedder: EmbedderI, threshold: float = DEFAULT_SEMANTIC_THRESHOLD,
+                 max_entries_per_store: int = 10_000, histogram_bins: int = DEFAULT_HISTOGRAM_BINS):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries_per_store = max_entries_per_store
+        self.histogram_bins = histogram_bins
+        self._indexes: dict[tuple[str, str], SemanticIndex] = {}
+        self._stats = CacheStats()
+        self._histogram = SimilarityHistogram.empty(histogram_bins)
+        self._lock = threading.Lock()
+
+    def _index(self, vector_store_id: str, assistant_id: str, files_fingerprint: str,
+               dimensions: int) -> tuple[SemanticIndex, bool]:
+        """The index of the vector store, and whether an outdated one was dropped."""
+        key = (assistant_id, vector_store_id)
+        index = self._indexes.get(key, None)
+        if index is not None and index.files_fingerprint == files_fingerprint:
+            return index, False
+        self._indexes[key] = SemanticIndex(files_fingerprint, dimensions)
+        return self._indexes[key], index is not None and len(index) > 0
+
+    def get(self, question: str, vector_store_id: str, assistant_id: str,
+            files_fingerprint: str) -> tuple[LLMAnswer | None, np.ndarray]:
+        """The cached answer of the most similar question above the threshold, if any,
+        and the question embedding to store its answer with."""
+        vector = self.embedder.embed([question])[0]
+        with self._lock:
+            index, invalidated = self._index(vector_store_id, assistant_id, files_fingerprint, len(vector))
+            score, answer = index.search(vector)
+            self._histogram.add(score)
+            hit = answer is not None and score >= self.threshold
+            self._stats.hits += hit
+            self._stats.misses += not hit
+            self._stats.invalidated += invalidated
+        return (answer if hit else None), vector
+
+    def set(self, vector: np.ndarray, vector_store_id: str, assistant_id: str,
+            files_fingerprint: str, answer: LLMAnswer):
+        with self._lock:
+            index, _ = self._index(vector_store_id, assistant_id, files_fingerprint, len(vector))
+            index.add(vector, answer, self.max_entries_per_store)
+
+    @property
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return self._stats.model_copy()
+
+    @property
+    def histogram(self) -> SimilarityHistogram:
+        with self._lock:
+            return self._histogram.model_copy(deep=True)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+            self._stats = CacheStats()
+            self._histogram = SimilarityHistogram.empty(self.histogram_bins)
+
+
+class SemanticCachedQuestionsAnswers:
+    """Answer model in front of another one, serving paraphrases of answered questions
+    from a SemanticAnswersCache."""
+
+    def __init__(self, model: AnswersModelI, cache: SemanticAnswersCache, assistant_id: str,
+                 files_fingerprint: Callable[[str], str]):
+        self.model = model
+        self.cache = cache
+        self.assistant_id = assistant_id
+        self.files_fingerprint = files_fingerprint
+
+    def answer(self, question: str, vector_store_id: str) -> LLMAnswer:
+        fingerprint = self.files_fingerprint(vector_store_id)
+        answer, vector = self.cache.get(question, vector_store_id, self.assistant_id, fingerprint)
+        if answer is None:
+            answer = self.model.answer(question, vector_store_id)
+            self.cache.set(vector, vector_store_id, self.assistant_id, fingerprint, answer)
+        return answer
+
+    def answer_stream(self, question: str, vector_store_id: str) -> Iterator[AnswerDelta]:
+        fingerprint = self.files_fingerprint(vector_store_id)
+        answer, vector = self.cache.get(question, vector_store_id, self.assistant_id, fingerprint)
+        if answer is not None:
+            yield from answer_to_deltas(answer)
+            return
+
+        deltas = []
+        for delta in self.model.answer_stream(question, vector_store_id):
+            deltas.append(delta)
+            yield delta
+        self.cache.set(vector, vector_store_id, self.assistant_id, fingerprint, deltas_to_answer(deltas))
+
+
+def similarity_histogram(embedder: EmbedderI, questions: list[str], paraphrases: list[str],
+                         bins: int = DEFAULT_HISTOGRAM_BINS) -> SimilarityHistogram:
+    """Histogram of the similarity between each question and its paraphrase,
+    e.g. autotest questions and reworded versions of them, to tune the threshold."""
+    scores = np.sum(embedder.embed(questions) * embedder.embed(paraphrases), axis=1)
+    histogram = SimilarityHistogram.empty(bins)
+    for score in scores:
+        histogram.add(float(score))
+    return histogram
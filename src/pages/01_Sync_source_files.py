@@ -2,26 +2,30 @@ from datetime import datetime
 import os
 import tomli
 import json
-from openai import OpenAI
 import streamlit as st
 import pandas as pd
-from tqdm import tqdm
 
-from ingestion.db_manager import VectorStoreFileInfo, VectorStoreFilesDB
+from ingestion.db_manager import VectorStoreFileInfo, VectorStoreFilesDBI
 from model.files.gcs import GCSFile
 from model.answers_generation import OpenAIConfig
-from ingestion.manager import IngestionManager, SourcesDifferences
-from utils.streamlit_utils import VectorStoreConfig
-from defaults import DEV_CONFIG_FILE, DEFAULT_CONFIG_FILE
+from model.semantic_cache import AnswersCacheConfig, OpenAIEmbedder
+from ingestion.files_registry import OpenAIFilesRegistry
+from ingestion.manager import IngestionManager, PipelineConfig, SyncReport
+from ingestion.sync_plan import StalePlanError, SyncPlan, SyncPlanConfig, build_sync_plan, execute_sync_plan
+from utils.streamlit_utils import VectorStoreConfig, get_files_db
+from defaults import ANSWERS_CACHE_FILE, DEV_CONFIG_FILE, DEFAULT_CONFIG_FILE, FILES_REGISTRY_FILE, DRIVE_TOKEN_CACHE_FILE, FILES_DB_FILE, GCS_SNAPSHOTS_PATH
 from utils.config_utils import load_environment_config
-from utils.drive_utils import DriveConfig, get_sheet_service
+from utils.drive_utils import DriveConfig, ResilientSheetServiceFacade, SheetsResilienceConfig
+from utils.services import get_service_registry
 from utils.gcs_utils import GCSBucketFacade, GCSConfig, get_gcs_bucket
+from utils.openai_limiter import OpenAILimitsConfig
+from utils.tracing import TracingConfig
 
 
 drive_config: DriveConfig = load_environment_config(DriveConfig, os.getenv)
 gcs_config: GCSConfig = load_environment_config(GCSConfig, os.getenv)
 openai_config: OpenAIConfig = load_environment_config(OpenAIConfig, os.getenv)
-openai_client = OpenAI(api_key=openai_config.OPENAI_API_KEY, organization=openai_config.OPENAI_ORG_ID)
+services = get_service_registry(drive_config, openai_config, DRIVE_TOKEN_CACHE_FILE)
 
 
 # with open(DEV_CONFIG_FILE, mode="rb") as fp:
@@ -31,6 +35,12 @@ with open(DEFAULT_CONFIG_FILE, mode="rb") as fp:
     config = tomli.load(fp)
 
 vector_store_config = VectorStoreConfig(**config["vector_stores"])
+sync_plan_config = SyncPlanConfig(**config.get("sync_plan", {}))
+sync_plan_cache = services.sync_plan_cache(sync_plan_config.ttl)
+sheets_config = SheetsResilienceConfig(**config.get("sheets", {}))
+openai_limits = OpenAILimitsConfig(**config.get("openai_limits", {}))
+# Ingestion leaves room in the rate limits for the answers of the other sessions
+openai_client = services.openai_client("background", openai_limits)
 
 
 st.set_page_config(layout="wide")
@@ -71,107 +81,183 @@ dev_bucket = [
 ]
 
 
-VectorStoresDict = dict[str, VectorStoreFilesDB]
-DifferencesDict = dict[str, SourcesDifferences]
+VectorStoresDict = dict[str, VectorStoreFilesDBI]
+ReportsDict = dict[str, SyncReport]
 
 
 if 'vs_files_db_dict' not in st.session_state:
-    sheet_service = get_sheet_service(drive_config)
     vs_files_db_dict: VectorStoresDict = {}
     for data_version in vector_store_config.data_versions:
-        vs_files_db_dict[data_version.bucket_folder] = VectorStoreFilesDB(
-            sheet_service,
-            vector_store_config.spreadsheet_id,
-            data_version.sheet_name,
-            data_version.vector_store_id)
+        vs_files_db_dict[data_version.bucket_folder] = get_files_db(
+            services, vector_store_config, data_version, FILES_DB_FILE, sheets_config)
     st.session_state.vs_files_db_dict = vs_files_db_dict
 
+if "files_registry" not in st.session_state:
+    st.session_state.files_registry = OpenAIFilesRegistry(FILES_REGISTRY_FILE)
+
 if "bucket" not in st.session_state:
     st.session_state.bucket = get_gcs_bucket(vector_store_config.bucket_name, gcs_config)
 
-if 'diffs_dict' not in st.session_state:
-    st.session_state.diffs_dict = None
+if 'sync_plan' not in st.session_state:
+    st.session_state.sync_plan = None
+
+if 'sync_reports' not in st.session_state:
+    st.session_state.sync_reports = None
+
+if 'sync_error' not in st.session_state:
+    st.session_state.sync_error = None
 
 
 def sync_files():
-    sources_differences_dict: DifferencesDict = st.session_state.diffs_dict
+    sync_plan: SyncPlan = st.session_state.sync_plan
     vs_files_db_dict: VectorStoresDict = st.session_state.vs_files_db_dict
     bucket: GCSBucketFacade = st.session_state.bucket
-
-    for bucket_folder, sources_differences in sources_differences_dict.items():
-        files_db = vs_files_db_dict[bucket_folder]
-        ingestion_manager = IngestionManager(openai_client, files_db)
-
-        print(f"Syncing files for data version: {bucket_folder}")
-
-        print(f"New files: {len(sources_differences.new_files)}")
-        for file in tqdm(sources_differences.new_files):
-            file_bytes = bucket.download_as_bytes(file)
-            ingestion_manager.ingest_file(file, file_bytes)
-        
-        print(f"Deleted files: {len(sources_differences.deleted)}")
-        for file in tqdm(sources_differences.deleted):
-            ingestion_manager.delete_file(file)
-
-        print(f"Updated files: {len(sources_differences.updated)}")
-        for file_blob, file_vs in tqdm(sources_differences.updated):
-            file_bytes = bucket.download_as_bytes(file_blob)
-            ingestion_manager.update_file(file_blob, file_bytes, file_vs)
+    pipeline_config = PipelineConfig(**config.get("ingestion", {}))
+
+    def ingestion_manager(files_db: VectorStoreFilesDBI) -> IngestionManager:
+        return IngestionManager(openai_client, files_db, st.session_state.files_registry)
+
+    try:
+        sync_reports = execute_sync_plan(sync_plan, bucket, vs_files_db_dict, ingestion_manager,
+                                         pipeline_config, GCS_SNAPSHOTS_PATH)
+        st.session_state.sync_error = None
+    except StalePlanError as e:
+        sync_reports = None
+        st.session_state.sync_error = f"{e}, refresh the plan and try again."
+    finally:
+        sync_plan_cache.invalidate()
+
+    for files_db in vs_files_db_dict.values():
+        services.ids_mapping_cache(files_db).invalidate()
+    st.session_state.sync_reports = sync_reports
+
+
+def build_plan(full_listing: bool) -> SyncPlan:
+    return build_sync_plan(st.session_state.bucket, st.session_state.vs_files_db_dict, GCS_SNAPSHOTS_PATH,
+                           full_listing, sync_plan_config.workers)
+
+
+@st.cache_data(max_entries=4)
+def plan_dataframes(fingerprint: str, _sync_plan: SyncPlan) -> dict[str, tuple[pd.DataFrame, pd.DataFrame]]:
+    """The files DB and bucket tables of every data version, built once per plan."""
+    return {bucket_folder: (pd.DataFrame([file.model_dump() for file in version_plan.vs_files]),
+                            pd.DataFrame([file.model_dump() for file in version_plan.listed_files]))
+            for bucket_folder, version_plan in _sync_plan.versions.items()}
+
+
+def show_answers_cache_stats():
+    answers_cache = services.answers_cache(ANSWERS_CACHE_FILE)
+    stats = answers_cache.stats
+    st.markdown("### Answers cache")
+    st.markdown(f"Hits: {stats.hits}, misses: {stats.misses} "
+                f"({stats.invalidated} by synced files), hit rate: {stats.hit_rate:.0%}")
+    st.button("Clear answers cache", on_click=answers_cache.clear)
+
+    cache_config = AnswersCacheConfig(**config.get("answers_cache", {}))
+    if not cache_config.semantic:
+        return
+    # The cache keeps the embedder of its first caller, which embeds the questions of the chat
+    semantic_cache = services.semantic_answers_cache(OpenAIEmbedder(services.openai_client(limits=openai_limits),
+                                                                    cache_config.embedding_model),
+                                                     cache_config.semantic_threshold)
+    stats = semantic_cache.stats
+    histogram = semantic_cache.histogram
+    st.markdown(f"Similar questions (threshold {semantic_cache.threshold}): hits: {stats.hits}, "
+                f"misses: {stats.misses}, hit rate: {stats.hit_rate:.0%}")
+    with st.expander("Similarity scores"):
+        st.bar_chart(pd.DataFrame({"lookups": histogram.counts},
+                                  index=[f"{edge:.2f}" for edge in histogram.edges[:-1]]))
+    st.button("Clear similar questions cache", on_click=semantic_cache.clear)
+
+
+def show_latency_stats():
+    tracing_config = TracingConfig(**config.get("tracing", {}))
+    if not tracing_config.enabled:
+        return
+    percentiles = services.latency_stats(tracing_config.export_interval).percentiles()
+    st.markdown("### Answer latency")
+    st.dataframe(pd.DataFrame([{"stage": stage, "count": p.count, "p50 (s)": p.p50, "p95 (s)": p.p95,
+                                "p99 (s)": p.p99} for stage, p in percentiles.items()]))
+
+
+def show_sheets_metrics():
+    sheet_service = services.sheet_service(sheets_config)
+    if not isinstance(sheet_service, ResilientSheetServiceFacade):
+        return
+    metrics = sheet_service.metrics()
+    st.markdown("### Sheets API")
+    st.markdown(f"Calls: {metrics.calls}, retries: {metrics.retries}, quota errors: {metrics.quota_errors}, "
+                f"failed: {metrics.failures}, throttled: {metrics.throttled_seconds:.1f} s, "
+                f"circuit {metrics.circuit_state} (opened {metrics.circuit_opened} times)")
+
+
+def show_openai_limiter_stats():
+    if not openai_limits.enabled:
+        return
+    stats = services.openai_limiter(openai_limits).stats()
+    st.markdown("### OpenAI rate limits")
+    st.markdown(", ".join(f"{priority}: {requests} requests, waited {stats.waited_seconds[priority]:.1f} s"
+                          for priority, requests in stats.requests.items()) +
+                f" ({stats.rate_limited} rate limited, {stats.active} in flight, {stats.waiting} waiting)")
 
 
 def main():
     st.markdown("# Sync source files")
-    vs_files_db_dict: VectorStoresDict = st.session_state.vs_files_db_dict
-
-    diffs_dict: DifferencesDict = {}
-    for bucket_folder, vs_files_db in vs_files_db_dict.items():
+    show_answers_cache_stats()
+    show_latency_stats()
+    show_sheets_metrics()
+    show_openai_limiter_stats()
+
+    sync_reports: ReportsDict | None = st.session_state.sync_reports
+    if sync_reports is not None:
+        for bucket_folder, report in sync_reports.items():
+            st.markdown(f"Last sync of '{bucket_folder}': {len(report.ingested)} ingested, "
+                        f"{len(report.removed)} removed, {len(report.failures)} failed, "
+                        f"peak memory {report.peak_memory_mb:.1f} MB")
+            if report.indexing:
+                indexed = sum(status == "completed" for status in report.indexing.values())
+                st.markdown(f"Indexed files: {indexed}/{len(report.indexing)}"
+                            f"{' (ready to query)' if report.is_ready() else ''}")
+            if report.pending:
+                st.warning(f"{len(report.pending)} rows couldn't be written to the files DB, "
+                           f"they'll be written before the next sync")
+            for failure in report.failures:
+                st.error(f"{failure.source_id} ({failure.stage}): {failure.error}")
+    if st.session_state.sync_error is not None:
+        st.error(st.session_state.sync_error)
+
+    full_listing = st.checkbox("Full listing", help="Compare every file in the bucket, "
+                               "instead of only the ones changed since the last sync")
+    refresh = st.button("Refresh plan")
+    sync_plan = sync_plan_cache.get(full_listing, lambda: build_plan(full_listing), refresh)
+    dataframes = plan_dataframes(sync_plan.fingerprint, sync_plan)
+
+    st.markdown(f"Sync plan `{sync_plan.fingerprint[:12]}`, computed "
+                f"{sync_plan.age() / 60:.0f} min ago (refreshed every {sync_plan_config.ttl / 60:.0f} min)")
+    st.download_button("Download plan", sync_plan.model_dump_json(), file_name="sync_plan.json",
+                       help="Execute it later with: python sync.py execute sync_plan.json")
+
+    for bucket_folder, version_plan in sync_plan.versions.items():
         st.markdown(f"# Data version: {bucket_folder}")
-
-        files = vs_files_db.get_all()
-        
-        vs_files_df = pd.DataFrame([file.model_dump() for file in files])
-        vs_files_indexs = set(range(len(files)))
+        vs_files_df, bucket_df = dataframes[bucket_folder]
 
         st.markdown("### Files in VectorStore")
         st.markdown(f"DataBase URL: [optimus_openai_files_system]"
                     f"(https://docs.google.com/spreadsheets/d/{vector_store_config.spreadsheet_id})")
-        st.markdown(f"Sheet: '{vs_files_db.sheet_name}'")
+        st.markdown(f"Sheet: '{version_plan.sheet_name}'")
         with st.expander("Explore"):
             st.dataframe(vs_files_df)
-        st.markdown(f"Total files: {len(files)}")
-
-        bucket: GCSBucketFacade = st.session_state.bucket
-        bucket_blobs = bucket.get_folder_files(bucket_folder, ["application/pdf"])
-        # bucket_blobs = dev_bucket
-        bucket_df = pd.DataFrame([file.model_dump() for file in bucket_blobs])
+        st.markdown(f"Total files: {len(version_plan.vs_files)}")
 
         st.markdown("### Files in Google Cloud Storage")
         st.markdown(f"Bucket: 'bucket-optimusprime'")
-        with st.expander("Explore"):
+        with st.expander("Explore" if sync_plan.full_listing else "Explore changed files"):
             st.dataframe(bucket_df)
-        st.markdown(f"Total files: {len(bucket_blobs)}")
-
-        sources_differences = SourcesDifferences()
-
-        if len(files) == 0:
-            sources_differences.new_files = bucket_blobs
-
-        else:
-            for blob in bucket_blobs:
-                row = vs_files_df.index[vs_files_df['source_id'] == blob.source_id]
-                if row.empty:
-                    sources_differences.new_files.append(blob)
-                else:
-                    vs_file_index = int(row[0])
-                    vs_files_indexs.remove(vs_file_index)
-                    vs_file: VectorStoreFileInfo = files[vs_file_index]
-                    if vs_file.last_modified < blob.updated:
-                        sources_differences.updated.append((blob, vs_file))
-                    else:
-                        sources_differences.no_changes.append(blob)
-        
-        for idx in vs_files_indexs:
-            sources_differences.deleted.append(files[idx])
+        changed = len(version_plan.listed_files)
+        st.markdown(f"Total files: {version_plan.total_files}, changed since the last sync: "
+                    f"{changed}, unchanged: {version_plan.total_files - changed}")
+
+        sources_differences = version_plan.differences
         
         st.markdown("### Differences")
 
@@ -190,10 +276,8 @@ def main():
         with st.expander(f"No changes files ({len(sources_differences.no_changes)})"):
             for file in sources_differences.no_changes:
                 st.write(file.source_id)
-        
-        diffs_dict[bucket_folder] = sources_differences
 
-    st.session_state.diffs_dict = diffs_dict
+    st.session_state.sync_plan = sync_plan
     st.button("Sync files", on_click=sync_files)
 
 
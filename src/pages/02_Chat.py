@@ -1,23 +1,27 @@
+from contextlib import nullcontext
 from copy import deepcopy
 import os
+from uuid import uuid4
 from time import sleep
 from typing import Literal
-from openai import OpenAI
 from pydantic import BaseModel
 import streamlit as st
 
-from model.answers_generation import MarkdownAnswer, OpenAIConfig, QuestionsAnswers, QuestionsAnswersI, QuestionsAnswersMock
-from defaults import DEFAULT_CONFIG_FILE, OPTIMUS_IMAGE
-from ingestion.db_manager import VectorStoreFilesDB
+from model.answers_generation import MarkdownAnswer, MarkdownAnswerBuilder, OpenAIConfig, QuestionsAnswers, QuestionsAnswersI, QuestionsAnswersMock, StreamingQuestionsAnswersI, ThreadMessage
+from model.conversations import ConversationQuestionsAnswers
+from model.run_polling import RunFailedError, RunTimeoutError
+from defaults import ANSWERS_CACHE_FILE, DEFAULT_CONFIG_FILE, OPTIMUS_IMAGE, DRIVE_TOKEN_CACHE_FILE, FILES_DB_FILE
 from model.files_manager import FileLink, InMemoryFilesManager, SheetFilesDB
-from utils.streamlit_utils import AppConfig
-from utils.drive_utils import DriveConfig, get_sheet_service
+from utils.streamlit_utils import AppConfig, answer_trace, cached_answers_model, get_files_db
+from utils.drive_utils import DriveConfig
+from utils.services import StartupTimer, get_service_registry
 from utils.config_utils import load_environment_config, load_toml_config
 from model.feedback.feedback import TestLog, SheetLogWriter, YesNoPartially
 
 
 openai_config: OpenAIConfig = load_environment_config(OpenAIConfig, os.getenv)
 drive_config: DriveConfig = load_environment_config(DriveConfig, os.getenv)
+services = get_service_registry(drive_config, openai_config, DRIVE_TOKEN_CACHE_FILE)
 
 
 
@@ -34,29 +38,34 @@ TEST_CONVERSATION = [
 FilesManagersDict = dict[str, SheetFilesDB]
 
 
+if "startup_timer" not in st.session_state:
+    st.session_state.startup_timer = StartupTimer("Chat")
+
 if "app_config" not in st.session_state:
     st.session_state.app_config = load_toml_config(AppConfig, DEFAULT_CONFIG_FILE)
 
 if "conversation" not in st.session_state:
     st.session_state.conversation = deepcopy(TEST_CONVERSATION)
-if 'answer_model' not in st.session_state:
-    _app_config: AppConfig = st.session_state.app_config
-    openai_client = OpenAI(api_key=openai_config.OPENAI_API_KEY, organization=openai_config.OPENAI_ORG_ID)
-    st.session_state.answer_model = QuestionsAnswers(openai_client, _app_config.assistant.id)
-
+if "pending_answer" not in st.session_state:
+    st.session_state.pending_answer = False
+if "conversation_id" not in st.session_state:
+    st.session_state.conversation_id = uuid4().hex
 if 'files_managers' not in st.session_state:
     _app_config: AppConfig = st.session_state.app_config
-    sheet_service = get_sheet_service(drive_config)
     files_managers: FilesManagersDict = {}
     for data_version in _app_config.vector_stores.data_versions:
-        vs = VectorStoreFilesDB(
-            sheet_service,
-            _app_config.vector_stores.spreadsheet_id,
-            data_version.sheet_name,
-            data_version.vector_store_id)
-        files_managers[data_version.version] = SheetFilesDB(vs)
+        vs = get_files_db(services, _app_config.vector_stores, data_version, FILES_DB_FILE, _app_config.sheets)
+        files_managers[data_version.version] = SheetFilesDB(vs, services.ids_mapping_cache(vs))
     st.session_state.files_managers = files_managers
 
+if 'conversation_model' not in st.session_state:
+    _app_config: AppConfig = st.session_state.app_config
+    # noinspection PyTypeHints
+    _questions_answers = services.questions_answers(_app_config.assistant.id, _app_config.run_polling,
+                                                    _app_config.openai_limits)
+    st.session_state.conversation_model = ConversationQuestionsAnswers(
+        _questions_answers, services.threads_pool(_app_config.openai_limits))
+
     # st.session_state.files_manager = InMemoryFilesManager({
     #     "mock_file_1": FileLink(name="Google", url="https://www.google.com"),
     #     "mock_file_2": FileLink(name="X", url="https://www.x.com")
@@ -64,26 +73,83 @@ if 'files_managers' not in st.session_state:
 
 
 def reset_chat():
+    conversation_model: ConversationQuestionsAnswers = st.session_state.conversation_model
+    conversation_model.threads.close(st.session_state.conversation_id)
+    st.session_state.conversation_id = uuid4().hex
     st.session_state.conversation = deepcopy(TEST_CONVERSATION)
+    st.session_state.pending_answer = False
+
+
+def first_turn_model(conversation_id: str) -> StreamingQuestionsAnswersI:
+    """The answers caches in front of the conversation, a miss starts its thread in the threads pool."""
+    app_config: AppConfig = st.session_state.app_config
+    conversation_model: ConversationQuestionsAnswers = st.session_state.conversation_model
+    return cached_answers_model(
+        conversation_model.conversation(conversation_id),
+        app_config,
+        list(st.session_state.files_managers.values()),
+        ANSWERS_CACHE_FILE,
+        services)
 
 
 def submit_message():
-    with st.spinner("Thinking..."):
-        
-        message = st.session_state.message
-        conversation: list[ChatMessage] = st.session_state.conversation
-        
-        conversation.append(ChatMessage(role="user", content=message))
+    message = st.session_state.message
+    conversation: list[ChatMessage] = st.session_state.conversation
+    conversation.append(ChatMessage(role="user", content=message))
+    st.session_state.pending_answer = True
 
-        version: str = st.session_state.chat_version
-        files_managers: FilesManagersDict = st.session_state.files_managers
-        vector_store_id: str = files_managers[version].files_db.vector_store_id
 
-        answer_model: QuestionsAnswersI = st.session_state.answer_model
-        answer = answer_model.answer(message, vector_store_id)
+def stream_answer():
+    """Answers the last user message, rendering the answer while it is streamed."""
+    st.session_state.pending_answer = False
+    conversation: list[ChatMessage] = st.session_state.conversation
+    message: str = conversation[-1].content  # type: ignore
 
-        markdown_answer = MarkdownAnswer.from_llm_answer(answer, files_managers[version])
-        conversation.append(ChatMessage(role="assistant", content=markdown_answer))
+    version: str = st.session_state.chat_version
+    files_managers: FilesManagersDict = st.session_state.files_managers
+    vector_store_id: str = files_managers[version].files_db.vector_store_id
+
+    # The first question can be answered from the caches, the following ones
+    # need the context of the conversation thread
+    history = [ThreadMessage(role=m.role, content=m.content if isinstance(m.content, str) else m.content.text)
+               for m in conversation[len(TEST_CONVERSATION):-1]]
+    app_config: AppConfig = st.session_state.app_config
+    trace = answer_trace(services, app_config.tracing)
+    try:
+        with trace or nullcontext():
+            if len(history) == 0:
+                answer_model = first_turn_model(st.session_state.conversation_id)
+                deltas = answer_model.answer_stream(message, vector_store_id)
+            else:
+                conversation_model: ConversationQuestionsAnswers = st.session_state.conversation_model
+                deltas = conversation_model.answer_stream(message, vector_store_id, st.session_state.conversation_id,
+                                                          history)
+            builder = MarkdownAnswerBuilder(files_managers[version])
+
+            with st.chat_message("assistant", avatar=str(OPTIMUS_IMAGE)):
+                placeholder = st.empty()
+                placeholder.markdown("Thinking...")
+                for delta in deltas:
+                    builder.add(delta)
+                    if builder.raw_text:
+                        placeholder.markdown(builder.text)
+
+                markdown_answer = builder.build()
+                st.markdown("#### Referencias")
+                for reference in markdown_answer.references:
+                    st.markdown(reference)
+    except RunTimeoutError as e:
+        print(e)
+        st.error("El asistente no respondió a tiempo, intente de nuevo en unos minutos.")
+        return
+    except RunFailedError as e:
+        print(e)
+        st.error("El asistente no pudo responder, intente de nuevo.")
+        return
+
+    if trace is not None:
+        markdown_answer.timings = trace.timings()
+    conversation.append(ChatMessage(role="assistant", content=markdown_answer))
 
 
 def main():
@@ -121,10 +187,13 @@ def main():
                 with st.chat_message("user"):
                     st.write(message.content)
 
+    if st.session_state.pending_answer:
+        stream_answer()
     
     st.chat_input("Say something", key="message", on_submit=submit_message)
 
     st.button("Reset chat", on_click=reset_chat)
+    st.session_state.startup_timer.report()
 
 if __name__ == '__main__':
     main()
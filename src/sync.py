@@ -0,0 +1,72 @@
+"""Sync the source files without the app, e.g. from a scheduled job.
+
+    python sync.py plan sync_plan.json [--full-listing]
+    python sync.py execute sync_plan.json [--force]
+
+A plan downloaded from the Sync page can be executed as well."""
+import argparse
+from pathlib import Path
+
+from defaults import (DEFAULT_CONFIG_FILE, DEFAULT_ENV_FILE, DRIVE_TOKEN_CACHE_FILE, FILES_DB_FILE,
+                      FILES_REGISTRY_FILE, GCS_SNAPSHOTS_PATH)
+from ingestion.db_manager import VectorStoreFilesDBI
+from ingestion.files_registry import OpenAIFilesRegistry
+from ingestion.manager import IngestionManager
+from ingestion.sync_plan import SyncPlan, build_sync_plan, execute_sync_plan
+from model.answers_generation import OpenAIConfig
+from utils.config_utils import DotEnvConfigGenerator, load_environment_config, load_toml_config
+from utils.drive_utils import DriveConfig
+from utils.gcs_utils import GCSConfig, get_gcs_bucket
+from utils.services import get_service_registry
+from utils.streamlit_utils import AppConfig, get_files_db
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plan or execute the sync of the source files.")
+    parser.add_argument("command", choices=["plan", "execute"])
+    parser.add_argument("plan_file", type=Path)
+    parser.add_argument("--full-listing", action="store_true", help="Compare every file in the bucket")
+    parser.add_argument("--force", action="store_true", help="Execute even if the files DBs changed since the plan")
+    args = parser.parse_args()
+
+    file_config_generator = DotEnvConfigGenerator(DEFAULT_ENV_FILE)
+    drive_config: DriveConfig = load_environment_config(DriveConfig, file_config_generator.getenv)
+    gcs_config: GCSConfig = load_environment_config(GCSConfig, file_config_generator.getenv)
+    openai_config: OpenAIConfig = load_environment_config(OpenAIConfig, file_config_generator.getenv)
+    app_config = load_toml_config(AppConfig, DEFAULT_CONFIG_FILE)
+    services = get_service_registry(drive_config, openai_config, DRIVE_TOKEN_CACHE_FILE)
+
+    files_dbs = {data_version.bucket_folder: get_files_db(services, app_config.vector_stores,
+                                                          data_version, FILES_DB_FILE, app_config.sheets)
+                 for data_version in app_config.vector_stores.data_versions}
+    bucket = get_gcs_bucket(app_config.vector_stores.bucket_name, gcs_config)
+
+    if args.command == "plan":
+        plan = build_sync_plan(bucket, files_dbs, GCS_SNAPSHOTS_PATH, args.full_listing,
+                               app_config.sync_plan.workers)
+        plan.save(args.plan_file)
+        for bucket_folder, version_plan in plan.versions.items():
+            differences = version_plan.differences
+            print(f"{bucket_folder}: {len(differences.new_files)} new, {len(differences.updated)} updated, "
+                  f"{len(differences.deleted)} deleted")
+        print(f"Sync plan {plan.fingerprint[:12]} saved to {args.plan_file}")
+        return
+
+    plan = SyncPlan.load(args.plan_file)
+    print(f"Executing sync plan {plan.fingerprint[:12]}, computed at {plan.created_at}")
+    files_registry = OpenAIFilesRegistry(FILES_REGISTRY_FILE)
+
+    def ingestion_manager(files_db: VectorStoreFilesDBI) -> IngestionManager:
+        return IngestionManager(services.openai_client("background", app_config.openai_limits), files_db,
+                                files_registry)
+
+    reports = execute_sync_plan(plan, bucket, {folder: files_dbs[folder] for folder in plan.versions},
+                                ingestion_manager, app_config.ingestion, GCS_SNAPSHOTS_PATH, args.force)
+    for bucket_folder, report in reports.items():
+        for failure in report.failures:
+            print(f"{bucket_folder}: {failure.source_id} ({failure.stage}): {failure.error}")
+    services.flush_sqlite_mirrors()
+
+
+if __name__ == '__main__':
+    main()
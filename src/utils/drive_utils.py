@@ -1,10 +1,23 @@
 import json
-from typing import Any, Literal
+import queue
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Literal
+import google_auth_httplib2
+import httplib2
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from pydantic import BaseModel
 
+from defaults import DRIVE_TOKEN_CACHE_FILE
+from utils.resilience import CircuitBreaker, CircuitOpenError, CircuitState, TokenBucket, backoff_delay
+from utils.tracing import traced
+
 
 class DriveConfig(BaseModel):
     DRIVE_CLIENT_ID: str
@@ -34,9 +47,22 @@ class CredentialsError(Exception):
     pass
 
 
+DEFAULT_REFRESH_MARGIN = 300.0  # Above google-auth 3m45s, after which the token is no longer valid
+
+
 class DriveCredentials:
-    def __init__(self, config: DriveConfig):
+    """Keeps the live credentials, shared by every service built with them.
+
+    Credentials that expire within `refresh_margin` seconds are refreshed in a
+    background thread, while the still valid token keeps being used, so only
+    expired credentials refresh on the request path. Refreshed tokens are
+    saved to `token_file`, when given, and loaded from it by the next instance."""
+
+    def __init__(self, config: DriveConfig, token_file: Path | None = None,
+                 refresh_margin: float = DEFAULT_REFRESH_MARGIN):
         self.config = config
+        self.token_file = token_file
+        self.refresh_margin = refresh_margin
         token_dict = DRIVE_TOKEN_TEMPLATE.copy()
         token_dict.update({
             "token": config.DRIVE_TOKEN,
@@ -44,42 +70,297 @@ class DriveCredentials:
             "client_id": config.DRIVE_CLIENT_ID,
             "client_secret": config.CLIENT_SECRET
         })
-        self.token_dict = token_dict
+        self.token_dict = self._load_token(token_dict)
+        self._creds: Credentials | None = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _load_token(self, token_dict: dict[str, Any]) -> dict[str, Any]:
+        """The saved token, if it belongs to the same client and refresh token."""
+        if self.token_file is None or not self.token_file.exists():
+            return token_dict
+        with open(self.token_file, "r", encoding="utf8") as f:
+            saved = json.load(f)
+        same_client = all(saved.get(k) == token_dict[k] for k in ("refresh_token", "client_id"))
+        return saved if same_client else token_dict
+
+    def _expires_soon(self, creds: Credentials) -> bool:
+        expiry = getattr(creds, "expiry", None)
+        if not isinstance(expiry, datetime):
+            return False
+        now = datetime.now(timezone.utc).replace(tzinfo=None)  # google-auth uses naive UTC
+        return expiry - timedelta(seconds=self.refresh_margin) <= now
 
     def get_drive_credentials(self) -> Credentials:
-        creds = Credentials.from_authorized_user_info(self.token_dict, SCOPES)
+        with self._lock:
+            if self._creds is None:
+                self._creds = Credentials.from_authorized_user_info(self.token_dict, SCOPES)
+            creds = self._creds
 
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                raise CredentialsError("Invalid DRIVE credentials")
+            if not creds or not creds.valid:
+                if creds and creds.expired and creds.refresh_token:
+                    self._refresh(creds)
+                else:
+                    raise CredentialsError("Invalid DRIVE credentials")
+                return creds
 
-            # Save the credentials for the next run
-            self.token_dict = json.loads(creds.to_json())
+            start_refresh = self._expires_soon(creds) and bool(creds.refresh_token) and not self._refreshing
+            if start_refresh:
+                self._refreshing = True
 
+        if start_refresh:
+            threading.Thread(target=self._background_refresh, args=(creds,), daemon=True).start()
         return creds
 
+    def _refresh(self, creds: Credentials):
+        creds.refresh(Request())
+        self._save(creds)
+
+    def _save(self, creds: Credentials):
+        """Saves the credentials for the next run."""
+        self.token_dict = json.loads(creds.to_json())
+        if self.token_file is not None:
+            with open(self.token_file, "w", encoding="utf8") as f:
+                json.dump(self.token_dict, f, indent=4)
+
+    def _background_refresh(self, creds: Credentials):
+        """Refreshes a copy outside the lock, so callers aren't blocked by the request,
+        then swaps the new token into the shared credentials."""
+        try:
+            fresh = Credentials.from_authorized_user_info(json.loads(creds.to_json()), SCOPES)
+            fresh.refresh(Request())
+            with self._lock:
+                creds.token = fresh.token
+                creds.expiry = fresh.expiry
+                self._save(fresh)
+        except Exception as e:
+            print(f"Error refreshing DRIVE credentials: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+class DriveAuthorizedHttp(google_auth_httplib2.AuthorizedHttp):
+    """AuthorizedHttp that takes the credentials from DriveCredentials before every request,
+    so tokens about to expire are refreshed in the background, and expired ones are
+    refreshed by a single thread and saved."""
+
+    def __init__(self, drive_creds: DriveCredentials, http: httplib2.Http | None = None):
+        super().__init__(drive_creds.get_drive_credentials(), http=http or httplib2.Http())
+        self.drive_creds = drive_creds
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        self.credentials = self.drive_creds.get_drive_credentials()
+        return super().request(uri, method, body, headers, **kwargs)
+
+
+class HttpPool:
+    """Pool of DriveAuthorizedHttp connections. Every request checks one out and
+    returns it when done, so the requests of any thread reuse the connections while
+    none is used by two requests at once (httplib2 connections aren't thread safe).
+    At most `size` idle connections are kept."""
+
+    def __init__(self, drive_creds: DriveCredentials, size: int = 4):
+        self.drive_creds = drive_creds
+        self._idle: queue.Queue[DriveAuthorizedHttp] = queue.Queue(maxsize=size)
+
+    def _checkout(self) -> DriveAuthorizedHttp:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return DriveAuthorizedHttp(self.drive_creds)
+
+    def _checkin(self, http: DriveAuthorizedHttp):
+        try:
+            self._idle.put_nowait(http)
+        except queue.Full:
+            http.close()
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        http = self._checkout()
+        try:
+            return http.request(uri, method, body, headers, **kwargs)
+        finally:
+            self._checkin(http)
+
 
 class SheetServiceFacade:
     def __init__(self, service):
         self.service = service
 
+    def _execute(self, spreadsheet_id: str, request, idempotent: bool = True) -> Any:
+        return request.execute()
+
+    @traced("sheets.get")
     def get(self, spreadsheet_id: str, range_: str) -> list[list[Any]]:
-        result = (
+        result = self._execute(
+            spreadsheet_id,
             self.service.values()
             .get(spreadsheetId=spreadsheet_id, range=range_)
-            .execute()
         )
         return result.get("values", [])
 
+    @traced("sheets.update")
     def update(self, spreadsheet_id: str, range_: str, body: list[list[Any]]):
-        return self.service.values().update(
+        return self._execute(spreadsheet_id, self.service.values().update(
             spreadsheetId=spreadsheet_id,
             range=range_,
             valueInputOption="USER_ENTERED",
             body={"values": body},
-        ).execute()
+        ))
+
+    @traced("sheets.batch_update")
+    def batch_update(self, spreadsheet_id: str, data: dict[str, list[list[Any]]]):
+        """Writes the values of several ranges in a single call."""
+        return self._execute(spreadsheet_id, self.service.values().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={
+                "valueInputOption": "USER_ENTERED",
+                "data": [{"range": range_, "values": values} for range_, values in data.items()],
+            },
+        ))
+
+    @traced("sheets.append")
+    def append(self, spreadsheet_id: str, range_: str, body: list[list[Any]]):
+        """Appends the rows after the last row of the table in range, in a single call.
+        Not idempotent, only retried when the request was rejected by the quota."""
+        return self._execute(spreadsheet_id, self.service.values().append(
+            spreadsheetId=spreadsheet_id,
+            range=range_,
+            valueInputOption="USER_ENTERED",
+            insertDataOption="INSERT_ROWS",
+            body={"values": body},
+        ), idempotent=False)
+
+
+class SheetsResilienceConfig(BaseModel):
+    max_retries: int = 5
+    base_delay: float = 1.0             # Seconds before the first retry, doubled with every retry
+    max_delay: float = 32.0
+    quota_delay: float = 10.0           # Minimum wait after a quota error without Retry-After
+    requests_per_minute: float = 60.0   # Per spreadsheet
+    burst: int = 10
+    failure_threshold: int = 5          # Failed attempts in a row that open the circuit, quota errors don't count
+    reset_timeout: float = 30.0         # Seconds the circuit stays open
+
+
+class SheetsMetrics(BaseModel):
+    calls: int = 0
+    attempts: int = 0
+    retries: int = 0
+    quota_errors: int = 0
+    failures: int = 0                   # Calls that raised
+    rejected: int = 0                   # Calls rejected by the open circuit
+    throttled_seconds: float = 0.0      # Waited for the rate limiter
+    backoff_seconds: float = 0.0        # Waited between retries
+    circuit_opened: int = 0
+    circuit_state: CircuitState = "closed"
+
+
+QUOTA_REASONS = {"rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded", "RATE_LIMIT_EXCEEDED"}
+TRANSIENT_STATUSES = {500, 502, 503, 504}
+
+
+def is_quota_error(error: Exception) -> bool:
+    if not isinstance(error, HttpError):
+        return False
+    if error.status_code == 429:
+        return True
+    reasons = {detail.get("reason", None) for detail in error.error_details or [] if isinstance(detail, dict)}
+    return error.status_code == 403 and len(reasons & QUOTA_REASONS) > 0
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Server errors and lost connections, the request may have been applied."""
+    if isinstance(error, HttpError):
+        return error.status_code in TRANSIENT_STATUSES
+    return isinstance(error, (OSError, httplib2.HttpLib2Error))
+
+
+def retry_after(error: Exception) -> float | None:
+    if not isinstance(error, HttpError):
+        return None
+    try:
+        return float(error.resp.get("retry-after", None))
+    except (TypeError, ValueError):
+        return None
+
+
+class ResilientSheetServiceFacade(SheetServiceFacade):
+    """SheetServiceFacade that rate limits every spreadsheet with a token bucket, retries
+    quota and transient errors with jittered exponential backoff, and stops calling the
+    API for a while when it keeps failing (circuit breaker). Non idempotent calls
+    (appends) are only retried after quota errors, which reject the request."""
+
+    def __init__(self, service, config: SheetsResilienceConfig | None = None,
+                 sleep: Callable[[float], None] = time.sleep, clock: Callable[[], float] = time.monotonic,
+                 rng: random.Random | None = None):
+        super().__init__(service)
+        self.config = config or SheetsResilienceConfig()
+        self.sleep = sleep
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.breaker = CircuitBreaker(self.config.failure_threshold, self.config.reset_timeout, clock)
+        self._limiters: dict[str, TokenBucket] = {}
+        self._metrics = SheetsMetrics()
+        self._lock = threading.Lock()
+
+    def metrics(self) -> SheetsMetrics:
+        with self._lock:
+            return self._metrics.model_copy(update={"circuit_opened": self.breaker.opened,
+                                                    "circuit_state": self.breaker.state})
+
+    def _count(self, **increments: float):
+        with self._lock:
+            for name, increment in increments.items():
+                setattr(self._metrics, name, getattr(self._metrics, name) + increment)
+
+    def _limiter(self, spreadsheet_id: str) -> TokenBucket:
+        with self._lock:
+            if spreadsheet_id not in self._limiters:
+                self._limiters[spreadsheet_id] = TokenBucket(
+                    self.config.requests_per_minute / 60, self.config.burst, self.sleep, self.clock)
+            return self._limiters[spreadsheet_id]
+
+    def _execute(self, spreadsheet_id: str, request, idempotent: bool = True) -> Any:
+        config = self.config
+        self._count(calls=1)
+        attempt = 0
+        while True:
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                self._count(rejected=1, failures=1)
+                raise
+            self._count(attempts=1, throttled_seconds=self._limiter(spreadsheet_id).acquire())
+
+            try:
+                result = request.execute()
+            except Exception as e:
+                quota_error = is_quota_error(e)
+                retryable = quota_error or (idempotent and is_transient_error(e))
+                if is_transient_error(e):
+                    self.breaker.record_failure()
+                else:
+                    # The API answered, e.g. a bad range or the quota, the service is up
+                    self.breaker.record_success()
+                if quota_error:
+                    self._count(quota_errors=1)
+                if not retryable or attempt >= config.max_retries:
+                    self._count(failures=1)
+                    raise
+
+                delay = backoff_delay(attempt, config.base_delay, config.max_delay, self.rng)
+                if quota_error:
+                    delay = max(delay, retry_after(e) or config.quota_delay)
+                print(f"Sheets call failed ({e}), retrying in {delay:.1f} s")
+                self._count(retries=1, backoff_seconds=delay)
+                self.sleep(delay)
+                attempt += 1
+                continue
+
+            self.breaker.record_success()
+            return result
 
 
 class DriveFile(BaseModel):
@@ -105,30 +386,44 @@ class FilesServiceFacade:
     
 
 class ServiceGenerator:
-    def __init__(self, drive_creds: DriveCredentials):
+    """Builds the Google API services.
+    `thread_safe` services check out an http connection from a pool for every
+    request, so they can be shared by threads (httplib2 connections can't), e.g.
+    by the threads Streamlit starts for every rerun."""
+
+    def __init__(self, drive_creds: DriveCredentials, thread_safe: bool = False, http_pool_size: int = 4):
         self.drive_creds = drive_creds
+        self.thread_safe = thread_safe
+        self.http_pool_size = http_pool_size
 
     def get_service(self, service_name: str, version: Literal["v4", "v3"]):
-        creds = self.drive_creds.get_drive_credentials()
-        return build(service_name, version, credentials=creds)
+        # Every request goes through the DriveCredentials, which refresh and save the token
+        if not self.thread_safe:
+            return build(service_name, version, http=DriveAuthorizedHttp(self.drive_creds))
+        return build(service_name, version, http=HttpPool(self.drive_creds, self.http_pool_size))
     
-    def get_sheet_service(self) -> SheetServiceFacade:
-        return SheetServiceFacade(self.get_service("sheets", "v4").spreadsheets())
+    def get_sheet_service(self, resilience: SheetsResilienceConfig | None = None) -> SheetServiceFacade:
+        """With `resilience`, calls are rate limited and retried."""
+        service = self.get_service("sheets", "v4").spreadsheets()
+        if resilience is None:
+            return SheetServiceFacade(service)
+        return ResilientSheetServiceFacade(service, resilience)
     
     def get_files_service(self) -> FilesServiceFacade:
         return FilesServiceFacade(self.get_service("drive", "v3").files())
 
 
-def get_service_generator(config: DriveConfig) -> ServiceGenerator:
-    creds = DriveCredentials(config)
+def get_service_generator(config: DriveConfig, token_file: Path | None = DRIVE_TOKEN_CACHE_FILE) -> ServiceGenerator:
+    """The refreshed token is saved to `token_file`, so the next generator doesn't refresh it again."""
+    creds = DriveCredentials(config, token_file)
     return ServiceGenerator(creds)
 
-def get_sheet_service(config: DriveConfig) -> SheetServiceFacade:
-    service_generator = get_service_generator(config)
+def get_sheet_service(config: DriveConfig, token_file: Path | None = DRIVE_TOKEN_CACHE_FILE) -> SheetServiceFacade:
+    service_generator = get_service_generator(config, token_file)
     return service_generator.get_sheet_service()
 
-def get_files_service(config: DriveConfig) -> FilesServiceFacade:
-    service_generator = get_service_generator(config)
+def get_files_service(config: DriveConfig, token_file: Path | None = DRIVE_TOKEN_CACHE_FILE) -> FilesServiceFacade:
+    service_generator = get_service_generator(config, token_file)
     return service_generator.get_files_service()
 
 
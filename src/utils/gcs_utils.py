@@ -1,4 +1,8 @@
-from typing import Protocol
+import tempfile
+from datetime import datetime
+from io import BytesIO
+from pathlib import Path
+from typing import IO, Iterator, Protocol
 from pydantic import BaseModel
 from google.cloud import storage
 from google.oauth2 import service_account
@@ -50,6 +54,56 @@ class SourcesManagerI(Protocol):
         ...
         
 
+# Only the blob fields GCSFile uses are listed
+LISTING_FIELDS = "items(id,name,contentType,updated,generation,md5Hash,crc32c,size),nextPageToken"
+
+
+class SnapshotEntry(BaseModel):
+    generation: int | None
+    updated: datetime
+    source_id: str
+
+
+class ListingSnapshot(BaseModel):
+    """The blobs of a folder at the last sync, by name."""
+    blobs: dict[str, SnapshotEntry] = {}
+
+    @classmethod
+    def load(cls, file: Path) -> 'ListingSnapshot':
+        if not file.exists():
+            return cls()
+        return cls.model_validate_json(file.read_text(encoding="utf8"))
+
+    def save(self, file: Path):
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = file.with_suffix(".tmp")
+        tmp_file.write_text(self.model_dump_json(), encoding="utf8")
+        tmp_file.replace(file)
+
+    def without(self, source_ids: set[str]) -> 'ListingSnapshot':
+        """A copy without the blobs of `source_ids`, e.g. the ones that failed to sync,
+        so they are listed as changed again."""
+        return ListingSnapshot(
+            blobs={name: e for name, e in self.blobs.items() if e.source_id not in source_ids})
+
+    def with_blobs(self, blobs: dict[str, SnapshotEntry]) -> 'ListingSnapshot':
+        """A copy with `blobs` added, e.g. deleted blobs whose deletion failed, so they are
+        listed as deleted again."""
+        return ListingSnapshot(blobs={**self.blobs, **blobs})
+
+
+class ListingChanges(BaseModel):
+    """The blobs that changed since a snapshot, and the snapshot to save once they are synced."""
+    changed: list[GCSFile]
+    deleted: list[SnapshotEntry]
+    unchanged: int
+    snapshot: ListingSnapshot
+
+
+def snapshot_entry(file: GCSFile) -> SnapshotEntry:
+    return SnapshotEntry(generation=file.generation, updated=file.updated, source_id=file.source_id)
+
+
 class GCSBucketFacade:
 
     def __init__(self, bucket: storage.Bucket):
@@ -61,9 +115,56 @@ class GCSBucketFacade:
                         if blob.content_type in extensions]
         return bucket_blobs
 
+    def iter_folder_blobs(self, folder: str) -> Iterator[storage.Blob]:
+        """Lists the blobs a page at a time, with only the fields GCSFile uses."""
+        for page in self.bucket.list_blobs(prefix=folder, fields=LISTING_FIELDS).pages:
+            yield from page
+
+    def list_changes(self, folder: str, extensions: list[str], snapshot: ListingSnapshot) -> ListingChanges:
+        """The blobs whose generation differs from the snapshot, new ones included,
+        and the ones no longer in the bucket. Unchanged blobs are only compared,
+        GCSFile objects are built for the changed ones."""
+        blobs: dict[str, SnapshotEntry] = {}
+        changed: list[GCSFile] = []
+        for blob in self.iter_folder_blobs(folder):
+            if blob.content_type not in extensions:
+                continue
+            entry = snapshot.blobs.get(blob.name, None)
+            if entry is not None and entry.generation is not None and entry.generation == blob.generation:
+                blobs[blob.name] = entry
+                continue
+            file = GCSFile.from_blob(blob)
+            changed.append(file)
+            blobs[blob.name] = snapshot_entry(file)
+
+        deleted = [entry for name, entry in snapshot.blobs.items() if name not in blobs]
+        return ListingChanges(
+            changed=changed,
+            deleted=deleted,
+            unchanged=len(blobs) - len(changed),
+            snapshot=ListingSnapshot(blobs=blobs))
+
     def download_as_bytes(self, file: GCSFile) -> bytes:
         blob = self.bucket.blob(file.name)
         return blob.download_as_bytes()
+
+    def download_to_file(self, file: GCSFile, max_memory: int) -> IO[bytes]:
+        """Streams the blob into a file object positioned at the start.
+        Files up to `max_memory` bytes are kept in memory, bigger ones (or of unknown
+        size) go to a temporary file on disk. The caller must close it."""
+        if file.size is not None and file.size <= max_memory:
+            fp: IO[bytes] = BytesIO()
+        else:
+            fp = tempfile.TemporaryFile()
+
+        try:
+            blob = self.bucket.blob(file.name)
+            blob.download_to_file(fp)
+            fp.seek(0)
+        except Exception:
+            fp.close()
+            raise
+        return fp
     
     
 def get_gcs_bucket(bucket_name: str, config: GCSConfig) -> GCSBucketFacade:
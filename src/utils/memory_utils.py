@@ -0,0 +1,26 @@
+import tracemalloc
+
+
+class MemoryHighWaterMark:
+    """Context manager that measures the peak memory allocated by Python while it is active.
+    Tracing is started (and stopped on exit) only if it was not already running."""
+
+    def __init__(self):
+        self.peak_bytes = 0
+        self._started = False
+
+    @property
+    def peak_mb(self) -> float:
+        return self.peak_bytes / (1024 * 1024)
+
+    def __enter__(self) -> 'MemoryHighWaterMark':
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started = True
+        tracemalloc.reset_peak()
+        return self
+
+    def __exit__(self, *_):
+        _, self.peak_bytes = tracemalloc.get_traced_memory()
+        if self._started:
+            tracemalloc.stop()
@@ -0,0 +1,188 @@
+import heapq
+import re
+import threading
+import time
+from itertools import count
+from typing import Callable, Iterator, Literal
+
+import httpx
+from pydantic import BaseModel
+
+from utils.resilience import TokenBucket
+
+
+RequestPriority = Literal["interactive", "background"]
+PRIORITY_RANKS: dict[RequestPriority, int] = {"interactive": 0, "background": 1}
+# Set by the clients of a priority, removed before the request is sent
+PRIORITY_HEADER = "x-client-priority"
+RUN_POLL_PATH = re.compile(r"/threads/[^/]+/runs/[^/]+$")
+
+
+class OpenAILimitsConfig(BaseModel):
+    enabled: bool = True
+    requests_per_minute: float = 500.0
+    tokens_per_minute: float = 200_000.0
+    burst_seconds: float = 10.0         # The budgets can be spent this many seconds ahead
+    max_concurrency: int = 16           # Requests in flight, streamed answers until they end
+    interactive_reserved: int = 4       # Of `max_concurrency`, never used by background requests
+    run_tokens: int = 4000              # Estimated tokens of a run, with the file search results
+    rate_limited_pause: float = 5.0     # Seconds every request waits after a 429 without Retry-After
+    poll_share: float = 0.2             # Of `requests_per_minute`, a separate budget for run polls
+
+
+class LimiterStats(BaseModel):
+    requests: dict[str, int] = {}           # By priority
+    waited_seconds: dict[str, float] = {}   # By priority
+    rate_limited: int = 0                   # 429 answers
+    active: int = 0
+    waiting: int = 0
+
+
+def estimate_tokens(request: httpx.Request, run_tokens: int) -> int:
+    """A rough count of the tokens a request uses, ~4 bytes of JSON per token plus a run's context.
+    Uploads don't count, they use no model tokens."""
+    if not request.headers.get("content-type", "").startswith("application/json"):
+        return 0
+    tokens = len(request.content) // 4
+    if request.method == "POST" and request.url.path.endswith("/runs"):
+        tokens += run_tokens
+    return tokens
+
+
+def is_run_poll(request: httpx.Request) -> bool:
+    """Retrieves the status of a run. Answers poll several times a second while they wait,
+    so polls have their own budget, and can't use up the one of the other requests."""
+    return request.method == "GET" and RUN_POLL_PATH.search(request.url.path) is not None
+
+
+class PriorityLimiter:
+    """Request and token budgets and a concurrency cap shared by every OpenAI client of
+    the process. Waiting requests go in priority order, so answers aren't starved by
+    ingestion, and background requests leave `interactive_reserved` slots free.
+    After a 429 every request waits until the server's Retry-After.
+    Run polls get `poll_share` of the requests budget for themselves, the other
+    requests the rest. Polls wait for theirs before queueing, so they don't hold the queue."""
+
+    def __init__(self, config: OpenAILimitsConfig, clock: Callable[[], float] = time.monotonic):
+        self.config = config
+        self.clock = clock
+        requests_rate = config.requests_per_minute / 60 * (1 - config.poll_share)
+        polls_rate = config.requests_per_minute / 60 * config.poll_share
+        self._requests = TokenBucket(requests_rate, max(1.0, requests_rate * config.burst_seconds), clock=clock)
+        self._polls = TokenBucket(polls_rate, max(1.0, polls_rate * config.burst_seconds), clock=clock)
+        self._tokens = TokenBucket(config.tokens_per_minute / 60,
+                                   max(1.0, config.tokens_per_minute / 60 * config.burst_seconds), clock=clock)
+        self._waiting: list[tuple[int, int]] = []
+        self._tickets = count()
+        self._active = 0
+        self._paused_until = 0.0
+        self._stats = LimiterStats()
+        self._cond = threading.Condition()
+
+    def acquire(self, priority: RequestPriority, tokens: int = 0, poll: bool = False) -> float:
+        """Waits for the turn of the request, returns the seconds waited. Call `release` when it ends."""
+        started_at = self.clock()
+        if poll:
+            self._polls.acquire()
+        ticket = (PRIORITY_RANKS[priority], next(self._tickets))
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while (wait := self._wait_time(ticket, priority, tokens, poll)) > 0:
+                    self._cond.wait(None if wait == float("inf") else wait)
+                if not poll:
+                    self._requests.take()
+                self._tokens.take(tokens)
+                self._active += 1
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+            waited = self.clock() - started_at
+            self._stats.requests[priority] = self._stats.requests.get(priority, 0) + 1
+            self._stats.waited_seconds[priority] = self._stats.waited_seconds.get(priority, 0.0) + waited
+        return waited
+
+    def _wait_time(self, ticket: tuple[int, int], priority: RequestPriority, tokens: int, poll: bool) -> float:
+        """0 when the request can go, inf to wait for another request to start or end."""
+        if self._waiting[0] != ticket:
+            return float("inf")
+        max_active = self.config.max_concurrency
+        if priority == "background":
+            max_active = max(1, max_active - self.config.interactive_reserved)
+        if self._active >= max_active:
+            return float("inf")
+        requests_wait = 0.0 if poll else self._requests.wait_time()
+        return max(self._paused_until - self.clock(), requests_wait, self._tokens.wait_time(tokens), 0.0)
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def pause(self, seconds: float):
+        """Holds every request for `seconds`, e.g. after the server rate limited one."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, self.clock() + seconds)
+            self._stats.rate_limited += 1
+
+    def stats(self) -> LimiterStats:
+        with self._cond:
+            return self._stats.model_copy(deep=True, update={"active": self._active, "waiting": len(self._waiting)})
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    """Response body that frees the limiter slot when closed, so streamed answers keep it until they end."""
+
+    def __init__(self, stream: httpx.SyncByteStream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+        self._released = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            if not self._released:
+                self._released = True
+                self._release()
+
+
+class LimitedTransport(httpx.BaseTransport):
+    """httpx transport that sends every request through the limiter, with the priority
+    of its PRIORITY_HEADER (interactive if missing). Run polls use the polls budget."""
+
+    def __init__(self, limiter: PriorityLimiter, transport: httpx.BaseTransport | None = None):
+        self.limiter = limiter
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        priority = request.headers.pop(PRIORITY_HEADER, "interactive")
+        if priority not in PRIORITY_RANKS:
+            priority = "interactive"
+        self.limiter.acquire(priority, estimate_tokens(request, self.limiter.config.run_tokens),
+                             poll=is_run_poll(request))
+        try:
+            response = self.transport.handle_request(request)
+        except BaseException:
+            self.limiter.release()
+            raise
+
+        if response.status_code == 429:
+            retry_after = response.headers.get("retry-after", None)
+            try:
+                self.limiter.pause(float(retry_after))
+            except (TypeError, ValueError):
+                self.limiter.pause(self.limiter.config.rate_limited_pause)
+
+        assert isinstance(response.stream, httpx.SyncByteStream)
+        return httpx.Response(status_code=response.status_code, headers=response.headers,
+                              stream=_ReleasingStream(response.stream, self.limiter.release),
+                              extensions=response.extensions)
+
+    def close(self):
+        self.transport.close()
@@ -0,0 +1,117 @@
+import random
+import threading
+import time
+from typing import Callable, Literal
+
+
+CircuitState = Literal["closed", "open", "half_open"]
+
+
+class CircuitOpenError(Exception):
+    """The service failed too many times in a row, calls are rejected until the breaker resets."""
+    pass
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float, rng: random.Random | None = None) -> float:
+    """Exponential backoff with equal jitter: half the delay is fixed, half random,
+    so clients that failed together don't retry together."""
+    delay = min(max_delay, base_delay * 2 ** attempt)
+    return delay / 2 + (rng or random).uniform(0, delay / 2)
+
+
+class TokenBucket:
+    """Allows `rate` calls per second on average, in bursts of up to `capacity` calls.
+    `acquire` reserves a token and waits for it outside the lock, so waiting callers
+    are served in the order they arrived."""
+
+    def __init__(self, rate: float, capacity: float, sleep: Callable[[float], None] = time.sleep,
+                 clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.sleep = sleep
+        self.clock = clock
+        self._tokens = capacity
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def acquire(self) -> float:
+        """Waits for a token, returns the seconds waited."""
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def wait_time(self, amount: float = 1.0) -> float:
+        """Seconds until `amount` tokens are available, without taking them.
+        Amounts over the capacity only wait for a full bucket."""
+        with self._lock:
+            self._refill()
+            return max(0.0, (min(amount, self.capacity) - self._tokens) / self.rate)
+
+    def take(self, amount: float = 1.0):
+        """Takes the tokens now, the bucket can go into debt."""
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` failures in a row and rejects calls for
+    `reset_timeout` seconds. Then lets one trial call through (half open): the
+    circuit closes if it succeeds and opens again if it fails."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.opened = 0     # Times the circuit opened
+        self._state: CircuitState = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> CircuitState:
+        with self._lock:
+            if self._state == "open" and self.clock() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return self._state
+
+    def before_call(self):
+        """Raises CircuitOpenError if the call isn't allowed."""
+        with self._lock:
+            if self._state == "open":
+                if self.clock() - self._opened_at < self.reset_timeout:
+                    raise CircuitOpenError(f"Circuit open for {self.reset_timeout} s after "
+                                           f"{self.failure_threshold} failures")
+                self._state = "half_open"
+            if self._state == "half_open":
+                if self._trial_running:
+                    raise CircuitOpenError("Circuit half open, waiting for the trial call")
+                self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self._state = "closed"
+            self._failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._state == "half_open" or self._failures >= self.failure_threshold:
+                if self._state != "open":
+                    self.opened += 1
+                self._state = "open"
+                self._opened_at = self.clock()
@@ -0,0 +1,23 @@
+import time
+from typing import Callable, TypeVar
+
+
+T = TypeVar('T')
+
+
+def retry_call(fn: Callable[[], T], 
+               max_retries: int = 3, 
+               delay: float = 1.0, 
+               backoff: float = 2.0) -> T:
+    """Calls `fn` until it succeeds, retrying at most `max_retries` times.
+    Waits `delay` seconds before the first retry, multiplied by `backoff` after each one.
+    The last exception is raised if every attempt fails."""
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception:
+            if attempt >= max_retries:
+                raise
+            time.sleep(delay * backoff ** attempt)
+            attempt += 1
@@ -0,0 +1,204 @@
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, TypeVar
+
+import httpx
+from openai import OpenAI
+
+from ingestion.db_manager import VectorStoreFilesDB, VectorStoreFilesDBI
+from ingestion.sqlite_db import SheetChangedError, SheetMirror, SQLiteVectorStoreFilesDB, open_sqlite_files_db
+from ingestion.sync_plan import SyncPlanCache
+from model.answers_cache import DEFAULT_LRU_SIZE, AnswersCache, build_answers_cache
+from model.answers_generation import OpenAIConfig, QuestionsAnswers
+from model.conversations import DEFAULT_IDLE_TIMEOUT, ThreadsPool
+from model.feedback.feedback import FeedbackLogsConfig, QueuedLogWriter, build_feedback_log_writer
+from model.files_manager import IdsMappingCache
+from model.run_polling import RunPollingConfig
+from model.semantic_cache import DEFAULT_SEMANTIC_THRESHOLD, EmbedderI, SemanticAnswersCache
+from utils.drive_utils import (DriveConfig, DriveCredentials, FilesServiceFacade, ServiceGenerator, SheetServiceFacade,
+                               SheetsResilienceConfig)
+from utils.openai_limiter import (PRIORITY_HEADER, LimitedTransport, OpenAILimitsConfig, PriorityLimiter,
+                                  RequestPriority)
+from utils.tracing import LatencyExporter, LatencyStats
+
+
+T = TypeVar("T")
+
+
+class ServiceRegistry:
+    """Clients shared by every session of the process, built on first use.
+
+    The OpenAI client keeps one connection pool for every session and the
+    assistant is retrieved once. Its requests go through the process limiter,
+    with the priority of the client they were made with. The Google services are built once, thread
+    safe, and refresh their token when it expires.
+    The caches, stats and writers shared by the sessions are kept here too, the arguments
+    of their getters are only used the first time, by key.
+    `openai_transport` sends the OpenAI requests, e.g. to a fake server, httpx's by default."""
+
+    def __init__(self, drive_config: DriveConfig, openai_config: OpenAIConfig,
+                 drive_token_file: Path | None = None, openai_transport: httpx.BaseTransport | None = None):
+        self.drive_config = drive_config
+        self.openai_config = openai_config
+        self.openai_transport = openai_transport
+        self.drive_credentials = DriveCredentials(drive_config, drive_token_file)
+        self.service_generator = ServiceGenerator(self.drive_credentials, thread_safe=True)
+        self._lock = threading.Lock()
+        self._openai_client: OpenAI | None = None
+        self._questions_answers: dict[str, QuestionsAnswers] = {}
+        self._sheet_service: SheetServiceFacade | None = None
+        self._files_service: FilesServiceFacade | None = None
+        # Not dropped by `reset`, they don't hold the credentials
+        self._shared_lock = threading.Lock()
+        self._shared: dict[tuple, Any] = {}
+        self._sqlite_mirrors: list[SheetMirror] = []
+
+    def openai_client(self, priority: RequestPriority = "interactive",
+                      limits: OpenAILimitsConfig | None = None) -> OpenAI:
+        """A client whose requests have `priority`, e.g. background for ingestion.
+        Rate limited with `limits` or the defaults, they're only used the first time."""
+        with self._lock:
+            if self._openai_client is None:
+                limits = limits or OpenAILimitsConfig()
+                transport = self.openai_transport
+                if limits.enabled:
+                    transport = LimitedTransport(self.openai_limiter(limits), transport)
+                http_client = httpx.Client(transport=transport) if transport is not None else None
+                self._openai_client = OpenAI(api_key=self.openai_config.OPENAI_API_KEY,
+                                             organization=self.openai_config.OPENAI_ORG_ID,
+                                             http_client=http_client)
+            client = self._openai_client
+        if priority == "interactive":
+            return client
+        return client.with_options(default_headers={PRIORITY_HEADER: priority})
+
+    def questions_answers(self, assistant_id: str, polling: RunPollingConfig | None = None,
+                          limits: OpenAILimitsConfig | None = None) -> QuestionsAnswers:
+        """`polling` is only used the first time, by assistant."""
+        client = self.openai_client(limits=limits)
+        with self._lock:
+            if assistant_id not in self._questions_answers:
+                self._questions_answers[assistant_id] = QuestionsAnswers(client, assistant_id, polling)
+            return self._questions_answers[assistant_id]
+
+    def sheet_service(self, resilience: SheetsResilienceConfig | None = None) -> SheetServiceFacade:
+        """Rate limited and retried, with `resilience` or the defaults. It's only used the first time."""
+        with self._lock:
+            if self._sheet_service is None:
+                self._sheet_service = self.service_generator.get_sheet_service(resilience or SheetsResilienceConfig())
+            return self._sheet_service
+
+    def files_service(self) -> FilesServiceFacade:
+        with self._lock:
+            if self._files_service is None:
+                self._files_service = self.service_generator.get_files_service()
+            return self._files_service
+
+    def _get_shared(self, key: tuple, create: Callable[[], T]) -> T:
+        with self._shared_lock:
+            if key not in self._shared:
+                self._shared[key] = create()
+            return self._shared[key]
+
+    def openai_limiter(self, limits: OpenAILimitsConfig | None = None) -> PriorityLimiter:
+        """The limiter of every OpenAI client of the process."""
+        return self._get_shared(("openai_limiter",), lambda: PriorityLimiter(limits or OpenAILimitsConfig()))
+
+    def answers_cache(self, db_file: Path | str, lru_size: int = DEFAULT_LRU_SIZE) -> AnswersCache:
+        return self._get_shared(("answers_cache", str(db_file)), lambda: build_answers_cache(db_file, lru_size))
+
+    def semantic_answers_cache(self, embedder: EmbedderI,
+                               threshold: float = DEFAULT_SEMANTIC_THRESHOLD) -> SemanticAnswersCache:
+        """The cache of the threshold, it embeds the questions with the first `embedder`."""
+        return self._get_shared(("semantic_answers_cache", threshold),
+                                lambda: SemanticAnswersCache(embedder, threshold))
+
+    def ids_mapping_cache(self, files_db: VectorStoreFilesDBI) -> IdsMappingCache:
+        return self._get_shared(("ids_mapping_cache", files_db.vector_store_id, files_db.sheet_name),
+                                lambda: IdsMappingCache(files_db))
+
+    def threads_pool(self, limits: OpenAILimitsConfig | None = None,
+                     idle_timeout: float = DEFAULT_IDLE_TIMEOUT) -> ThreadsPool:
+        """The threads of abandoned sessions still expire. Threads are opened in the background."""
+        # Taken out of the shared lock, building the client takes the limiter under its own lock
+        client = self.openai_client("background", limits)
+        return self._get_shared(("threads_pool",), lambda: ThreadsPool(client, idle_timeout))
+
+    def feedback_log_writer(self, config: FeedbackLogsConfig, logs_file: Path,
+                            resilience: SheetsResilienceConfig | None = None) -> QueuedLogWriter:
+        """The queued writer of the configured sink, see `build_feedback_log_writer`."""
+        sheet_service = self.sheet_service(resilience)
+        return self._get_shared(("feedback_log_writer", config.sink),
+                                lambda: build_feedback_log_writer(sheet_service, config, logs_file))
+
+    def sync_plan_cache(self, ttl: float = 600.0) -> SyncPlanCache:
+        return self._get_shared(("sync_plan_cache",), lambda: SyncPlanCache(ttl))
+
+    def latency_stats(self, export_interval: float | None = None) -> LatencyStats:
+        """The first call starts exporting the stats every `export_interval` seconds, if given."""
+        def create() -> LatencyStats:
+            stats = LatencyStats()
+            if export_interval is not None:
+                LatencyExporter(stats, export_interval).start()
+            return stats
+        return self._get_shared(("latency_stats",), create)
+
+    def sqlite_files_db(self, db_file: Path | str, sheet_db: VectorStoreFilesDB,
+                        mirror_interval: float | None = 60.0) -> SQLiteVectorStoreFilesDB:
+        """The SQLite files DB of the sheet's data version, see `open_sqlite_files_db`."""
+        def create() -> SQLiteVectorStoreFilesDB:
+            files_db, mirror = open_sqlite_files_db(db_file, sheet_db, mirror_interval)
+            if mirror is not None:
+                self._sqlite_mirrors.append(mirror)
+            return files_db
+        return self._get_shared(("sqlite_files_db", str(db_file), sheet_db.sheet_name), create)
+
+    def flush_sqlite_mirrors(self):
+        """Mirrors the pending changes of every files DB now, e.g. before the process exits."""
+        with self._shared_lock:
+            mirrors = list(self._sqlite_mirrors)
+        for mirror in mirrors:
+            try:
+                mirror.mirror()
+            except SheetChangedError as e:
+                print(f"Files DB not mirrored: {e}")
+
+    def reset(self):
+        """Drops the built clients, e.g. after the credentials were revoked."""
+        with self._lock:
+            self._openai_client = None
+            self._questions_answers.clear()
+            self._sheet_service = None
+            self._files_service = None
+
+
+_service_registry: ServiceRegistry | None = None
+_service_registry_lock = threading.Lock()
+
+
+def get_service_registry(drive_config: DriveConfig, openai_config: OpenAIConfig,
+                         drive_token_file: Path | None = None) -> ServiceRegistry:
+    """The registry of the process, the arguments are only used the first time."""
+    global _service_registry
+    with _service_registry_lock:
+        if _service_registry is None:
+            _service_registry = ServiceRegistry(drive_config, openai_config, drive_token_file)
+        return _service_registry
+
+
+class StartupTimer:
+    """Time from the start of a session's first run until the page is interactive."""
+
+    def __init__(self, page: str):
+        self.page = page
+        self.started_at = time.perf_counter()
+        self.reported = False
+
+    def report(self) -> float | None:
+        if self.reported:
+            return None
+        self.reported = True
+        elapsed = time.perf_counter() - self.started_at
+        print(f"{self.page}: cold session interactive in {elapsed:.2f} s")
+        return elapsed
@@ -1,6 +1,21 @@
+from pathlib import Path
+from typing import Literal
+
 from pydantic import BaseModel
 
+from ingestion.db_manager import VectorStoreFilesDB, VectorStoreFilesDBI
+from ingestion.manager import PipelineConfig
+from ingestion.sync_plan import SyncPlanConfig
+
+from model.answers_cache import AnswersModelI, CachedQuestionsAnswers
 from model.feedback.feedback import FeedbackLogsConfig
+from model.files_manager import SheetFilesDB
+from model.run_polling import RunPollingConfig
+from model.semantic_cache import AnswersCacheConfig, OpenAIEmbedder, SemanticCachedQuestionsAnswers
+from utils.drive_utils import SheetsResilienceConfig
+from utils.openai_limiter import OpenAILimitsConfig
+from utils.services import ServiceRegistry
+from utils.tracing import Trace, TracingConfig
 
 
 class DataVersion(BaseModel):
@@ -14,6 +29,8 @@ class VectorStoreConfig(BaseModel):
     spreadsheet_id: str
     bucket_name: str
     data_versions: list[DataVersion]
+    files_db: Literal["sheets", "sqlite"] = "sheets"
+    mirror_interval: float | None = 60.0    # Seconds between copies of the sqlite files DB to the sheets
 
 
 class AssistantConfig(BaseModel):
@@ -24,3 +41,52 @@ class AppConfig(BaseModel):
     vector_stores: VectorStoreConfig
     assistant: AssistantConfig
     feedback_logs: FeedbackLogsConfig
+    answers_cache: AnswersCacheConfig = AnswersCacheConfig()
+    ingestion: PipelineConfig = PipelineConfig()
+    sync_plan: SyncPlanConfig = SyncPlanConfig()
+    tracing: TracingConfig = TracingConfig()
+    run_polling: RunPollingConfig = RunPollingConfig()
+    sheets: SheetsResilienceConfig = SheetsResilienceConfig()
+    openai_limits: OpenAILimitsConfig = OpenAILimitsConfig()
+
+
+def cached_answers_model(model: AnswersModelI, app_config: AppConfig, files_managers: list[SheetFilesDB],
+                         cache_file: Path, services: ServiceRegistry) -> CachedQuestionsAnswers:
+    """The answer model behind the process answers caches, exact match first and then
+    by similarity of the OpenAI embeddings. Both are invalidated when the files of a vector store change."""
+    ids_mappings = {fm.files_db.vector_store_id: fm.ids_mapping for fm in files_managers}
+
+    def files_fingerprint(vector_store_id: str) -> str:
+        return ids_mappings[vector_store_id].fingerprint()
+
+    cache_config = app_config.answers_cache
+    if cache_config.semantic:
+        model = SemanticCachedQuestionsAnswers(
+            model, services.semantic_answers_cache(
+                OpenAIEmbedder(services.openai_client(limits=app_config.openai_limits), cache_config.embedding_model),
+                cache_config.semantic_threshold),
+            app_config.assistant.id, files_fingerprint)
+    return CachedQuestionsAnswers(
+        model, services.answers_cache(cache_file, cache_config.lru_size),
+        app_config.assistant.id, files_fingerprint)
+
+
+def get_files_db(services: ServiceRegistry, vector_store_config: VectorStoreConfig, data_version: DataVersion,
+                 db_file: Path, resilience: SheetsResilienceConfig | None = None) -> VectorStoreFilesDBI:
+    """The files DB of the data version, on the configured backend. The sheets are
+    called with `resilience`, see `ServiceRegistry.sheet_service`."""
+    sheet_db = VectorStoreFilesDB(
+        services.sheet_service(resilience),
+        vector_store_config.spreadsheet_id,
+        data_version.sheet_name,
+        data_version.vector_store_id)
+    if vector_store_config.files_db == "sheets":
+        return sheet_db
+    return services.sqlite_files_db(db_file, sheet_db, vector_store_config.mirror_interval)
+
+
+def answer_trace(services: ServiceRegistry, tracing_config: TracingConfig) -> Trace | None:
+    """A trace for the next answer, None when tracing is disabled."""
+    if not tracing_config.enabled:
+        return None
+    return Trace("answer", services.latency_stats(tracing_config.export_interval))
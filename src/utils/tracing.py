@@ -0,0 +1,168 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Iterator, ParamSpec, TypeVar
+
+import numpy as np
+from pydantic import BaseModel
+
+
+class TracingConfig(BaseModel):
+    enabled: bool = False
+    log_timings: bool = False                   # Writes the timings of an answer to its feedback log
+    export_interval: float | None = 300.0       # Seconds between percentile reports, None to not report
+
+
+class Span(BaseModel):
+    name: str
+    start: float        # Seconds since the start of the trace
+    duration: float     # Seconds
+
+
+class Trace:
+    """The spans of one request, e.g. answering a question. Spans are only recorded
+    inside `with trace:`, everywhere else `span` costs a context variable lookup.
+
+    On exit the time of each stage, summed over its spans, is added to `stats`."""
+
+    def __init__(self, name: str = "request", stats: 'LatencyStats | None' = None):
+        self.name = name
+        self.stats = stats
+        self.spans: list[Span] = []
+        self._started_at = 0.0
+        self._token = None
+
+    def __enter__(self) -> 'Trace':
+        self._started_at = time.perf_counter()
+        self._token = _current_trace.set(self)
+        return self
+
+    def __exit__(self, *_):
+        _current_trace.reset(self._token)
+        self.add(self.name, self._started_at, time.perf_counter())
+        if self.stats is not None:
+            self.stats.add_many(self.timings())
+
+    def add(self, name: str, started_at: float, ended_at: float):
+        self.spans.append(Span(name=name, start=started_at - self._started_at, duration=ended_at - started_at))
+
+    def timings(self) -> dict[str, float]:
+        """Seconds per stage, e.g. the N file link lookups of an answer add up to one stage."""
+        timings: dict[str, float] = {}
+        for s in self.spans:
+            timings[s.name] = timings.get(s.name, 0.0) + s.duration
+        return timings
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+
+
+def current_trace() -> Trace | None:
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Times the block as a stage of the current trace, if any."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, started_at, time.perf_counter())
+
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+
+def traced(name: str) -> Callable[[Callable[P, R]], Callable[P, R]]:
+    """Decorator version of `span`."""
+    def decorator(fn: Callable[P, R]) -> Callable[P, R]:
+        @wraps(fn)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class StagePercentiles(BaseModel):
+    count: int
+    p50: float
+    p95: float
+    p99: float
+
+
+class LatencyStats:
+    """The last `max_samples` times of every stage, to report their percentiles."""
+
+    def __init__(self, max_samples: int = 1000):
+        self.max_samples = max_samples
+        self._samples: dict[str, deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def add_many(self, timings: dict[str, float]):
+        with self._lock:
+            for stage, seconds in timings.items():
+                self._samples.setdefault(stage, deque(maxlen=self.max_samples)).append(seconds)
+
+    def percentiles(self) -> dict[str, StagePercentiles]:
+        with self._lock:
+            samples = {stage: np.array(values) for stage, values in self._samples.items()}
+        percentiles = {}
+        for stage, values in sorted(samples.items()):
+            p50, p95, p99 = np.percentile(values, [50, 95, 99]).tolist()
+            percentiles[stage] = StagePercentiles(count=len(values), p50=p50, p95=p95, p99=p99)
+        return percentiles
+
+    def report(self) -> str:
+        return "\n".join(f"{stage}: n={p.count} p50={p.p50 * 1000:.0f} ms p95={p.p95 * 1000:.0f} ms "
+                         f"p99={p.p99 * 1000:.0f} ms" for stage, p in self.percentiles().items())
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+
+class LatencyExporter:
+    """Emits the percentiles of every stage each `interval` seconds, when there are new samples."""
+
+    def __init__(self, stats: LatencyStats, interval: float = 300.0, emit: Callable[[str], None] = print):
+        self.stats = stats
+        self.interval = interval
+        self.emit = emit
+        self._last_report = ""
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def export(self) -> bool:
+        """Emits the report now if it changed since the last one, returns whether it did."""
+        report = self.stats.report()
+        if not report or report == self._last_report:
+            return False
+        self._last_report = report
+        self.emit(f"Answer latency percentiles:\n{report}")
+        return True
+
+    def start(self) -> 'LatencyExporter':
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.export()
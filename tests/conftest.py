@@ -0,0 +1,60 @@
+import sys
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable
+
+import pytest
+
+
+# The application modules import each other relative to `src` (that is the
+# working directory of the Streamlit app), so it has to be importable here too.
+SRC_PATH = Path(__file__).resolve().parent.parent / "src"
+if str(SRC_PATH) not in sys.path:
+    sys.path.insert(0, str(SRC_PATH))
+
+# Same classes as the application modules, which import them without the src prefix
+from ingestion.db_manager import VectorStoreFileInfo
+from model.files.gcs import GCSFile
+
+
+UPDATED = datetime.fromisoformat("2024-12-21 00:00:00+00:00")
+SYNCED = datetime.fromisoformat("2024-12-20 00:00:00+00:00")
+
+
+@pytest.fixture
+def gcs_file() -> Callable[..., GCSFile]:
+    """Builds the bucket file `<folder>/<name>.pdf`, updated at UPDATED. `fields` override the others."""
+    def build(name: str, folder: str = "V_16", **fields: Any) -> GCSFile:
+        return GCSFile(**{
+            "id": f"bucket/{folder}/{name}.pdf/123",
+            "name": f"{folder}/{name}.pdf",
+            "content_type": "application/pdf",
+            "updated": UPDATED,
+            **fields})
+    return build
+
+
+@pytest.fixture
+def vs_file() -> Callable[..., VectorStoreFileInfo]:
+    """Builds the files DB row of the bucket file `name`, synced before it was updated
+    (at SYNCED). `fields` override the others."""
+    def build(name: str, folder: str = "V_16", **fields: Any) -> VectorStoreFileInfo:
+        return VectorStoreFileInfo(**{
+            "id": f"file_{name}",
+            "source_file_id": name,
+            "source_type": "gcs",
+            "folder_id": f"bucket/{folder}",
+            "last_modified": SYNCED,
+            "status": "ok",
+            "source_id": f"bucket/{folder}/{name}",
+            **fields})
+    return build
+
+
+@pytest.fixture
+def file_info(vs_file) -> Callable[..., VectorStoreFileInfo]:
+    """Builds the files DB row `file_<idx>` of the document `doc_<idx>`, with its checksum and generation."""
+    def build(idx: int, status: str = "ok") -> VectorStoreFileInfo:
+        return vs_file(f"doc_{idx}", id=f"file_{idx}", status=status, last_modified=UPDATED,
+                       content_hash=f"md5:{idx}", generation=idx)
+    return build
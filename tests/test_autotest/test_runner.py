@@ -0,0 +1,93 @@
+import threading
+import time
+
+import httpx
+from openai import RateLimitError
+
+from src.autotest.db_manager import Question
+from src.autotest.runner import AutotestExample, AutotestRunner, RateLimiter
+
+
+QUESTIONS = [Question(id=i, question=f"question {i}", gold_document_id=f"doc_{i}") for i in range(6)]
+
+
+def example(question) -> AutotestExample:
+    return AutotestExample(
+        question_id=question.id,
+        question=question.question,
+        gold_document_id=question.gold_document_id,
+        assistant_id="asst_1",
+        answer=f"answer {question.id}",
+        answer_sources_ids=[question.gold_document_id])
+
+
+def rate_limit_error() -> RateLimitError:
+    request = httpx.Request("POST", "https://api.openai.com/v1/threads")
+    response = httpx.Response(429, headers={"retry-after": "0.01"}, request=request)
+    return RateLimitError("Rate limit", response=response, body=None)
+
+
+def test_runner_answers_concurrently(tmp_path):
+    active, max_active = 0, 0
+    lock = threading.Lock()
+
+    def answer(question):
+        nonlocal active, max_active
+        with lock:
+            active += 1
+            max_active = max(max_active, active)
+        time.sleep(0.05)
+        with lock:
+            active -= 1
+        return example(question)
+
+    runner = AutotestRunner(answer, tmp_path / "answers.jsonl", workers=3)
+    answers = runner.run(QUESTIONS)
+
+    assert sorted(a.question_id for a in answers) == list(range(6))
+    assert max_active == 3
+
+
+def test_runner_resumes_from_checkpoint(tmp_path):
+    answered = []
+
+    def failing_answer(question):
+        if question.id % 2 == 1:
+            raise ValueError("crash")
+        answered.append(question.id)
+        return example(question)
+
+    checkpoint = tmp_path / "answers.jsonl"
+    answers = AutotestRunner(failing_answer, checkpoint, workers=2).run(QUESTIONS)
+    assert sorted(a.question_id for a in answers) == [0, 2, 4]
+
+    def answer(question):
+        answered.append(question.id)
+        return example(question)
+
+    answers = AutotestRunner(answer, checkpoint, workers=2).run(QUESTIONS)
+    assert sorted(a.question_id for a in answers) == list(range(6))
+    assert sorted(answered) == [0, 1, 2, 3, 4, 5]
+
+
+def test_runner_retries_rate_limits(tmp_path):
+    calls = []
+
+    def answer(question):
+        calls.append(question.id)
+        if calls.count(question.id) == 1:
+            raise rate_limit_error()
+        return example(question)
+
+    answers = AutotestRunner(answer, tmp_path / "answers.jsonl", workers=2).run(QUESTIONS[:2])
+
+    assert sorted(a.question_id for a in answers) == [0, 1]
+    assert len(calls) == 4
+
+
+def test_rate_limiter_spaces_requests():
+    limiter = RateLimiter(requests_per_minute=60 * 20)  # One request every 50 ms
+    start = time.monotonic()
+    for _ in range(3):
+        limiter.wait()
+    assert time.monotonic() - start >= 0.1
@@ -0,0 +1,31 @@
+from benchmarks.compare import compare_runs, regressions
+from benchmarks.run import BenchmarkConfig, run_benchmarks
+
+
+def test_run_benchmarks_small():
+    config = BenchmarkConfig(sizes=[8], sessions=[2], repeat=1)
+
+    benchmark_run = run_benchmarks(config)
+
+    assert {r.benchmark for r in benchmark_run.results} == {
+        "answer_rendering_cold", "answer_rendering_warm", "sync_diffing", "ingestion_throughput", "feedback_writes",
+        "session_startup_per_session", "session_startup_shared"}
+    assert benchmark_run.result("session_startup_per_session", 2).calls == {"openai.GET assistants": 2}
+    assert benchmark_run.result("session_startup_shared", 2).calls == {"openai.GET assistants": 1}
+    assert benchmark_run.result("answer_rendering_cold", 8).calls == {"sheets.get": 1}
+    assert benchmark_run.result("answer_rendering_warm", 8).calls == {}
+    assert benchmark_run.result("ingestion_throughput", 8).calls["openai.POST files"] == 8
+
+
+def test_compare_runs_regressions():
+    baseline = run_benchmarks(BenchmarkConfig(sizes=[4], repeat=1), ["answer_rendering_warm", "feedback_writes"])
+    baseline.results[0].best_seconds = baseline.results[1].best_seconds = 1.0
+    current = baseline.model_copy(deep=True)
+    current.results[0].best_seconds = 1.1
+    current.results[1].best_seconds = 2.0
+
+    comparisons = compare_runs(baseline, current)
+
+    assert len(comparisons) == 2
+    assert [c.benchmark for c in regressions(comparisons, 0.2)] == ["feedback_writes"]
+    assert regressions(comparisons, 1.0) == []
@@ -0,0 +1,107 @@
+import pytest
+
+from src.model.answers_cache import (AnswersCache, CachedQuestionsAnswers, LayeredAnswersCacheStorage,
+                                     LRUAnswersCacheStorage, SQLiteAnswersCacheStorage, normalize_question)
+from benchmarks.fake_assistant import FakeAssistantServer
+# Same answer classes as the cache module, which imports them without the src prefix
+from model.answers_generation import QuestionsAnswers
+from model.run_polling import RunFailedError
+
+
+def cached_model(server: FakeAssistantServer, cache: AnswersCache, fingerprints: dict[str, str]):
+    return CachedQuestionsAnswers(QuestionsAnswers(server.client(), "asst_1"), cache, "asst_1",
+                                  lambda vector_store_id: fingerprints[vector_store_id])
+
+
+def runs_created(server: FakeAssistantServer) -> int:
+    return sum(method == "POST" and path.endswith("/runs") for method, path in server.requests)
+
+
+def test_normalize_question():
+    assert normalize_question("  ¿Dónde configuro   los TALONARIOS? ") == "donde configuro los talonarios"
+
+
+def test_cached_answers():
+    server = FakeAssistantServer()
+    cache = AnswersCache(LRUAnswersCacheStorage())
+    qa = cached_model(server, cache, {"vs_1": "a", "vs_2": "a"})
+
+    first = qa.answer("Donde configuro talonarios?", "vs_1")
+    second = qa.answer("¿dónde configuro talonarios", "vs_1")
+    qa.answer("Donde configuro talonarios?", "vs_2")
+
+    assert second == first
+    assert runs_created(server) == 2
+    assert (cache.stats.hits, cache.stats.misses) == (1, 2)
+    assert cache.stats.hit_rate == 1 / 3
+
+
+def test_changed_files_invalidate_answers():
+    server = FakeAssistantServer()
+    cache = AnswersCache(LRUAnswersCacheStorage())
+    fingerprints = {"vs_1": "a"}
+    qa = cached_model(server, cache, fingerprints)
+
+    qa.answer("question", "vs_1")
+    fingerprints["vs_1"] = "b"
+    qa.answer("question", "vs_1")
+    qa.answer("question", "vs_1")
+
+    assert runs_created(server) == 2
+    assert (cache.stats.hits, cache.stats.misses, cache.stats.invalidated) == (1, 2, 1)
+
+
+def test_cached_answer_stream():
+    server = FakeAssistantServer()
+    cache = AnswersCache(LRUAnswersCacheStorage())
+    qa = cached_model(server, cache, {"vs_1": "a"})
+
+    streamed = list(qa.answer_stream("question", "vs_1"))
+    replayed = list(qa.answer_stream("question", "vs_1"))
+
+    assert runs_created(server) == 1
+    assert "".join(d.text for d in replayed) == "".join(d.text for d in streamed)
+    assert [r.file_id for d in replayed for r in d.references] == ["file_1"]
+    assert replayed[0].thread_id == streamed[0].thread_id
+
+
+def test_lru_storage_evicts_least_recently_used():
+    storage = LRUAnswersCacheStorage(max_size=2)
+    cache = AnswersCache(storage)
+    server = FakeAssistantServer()
+    qa = cached_model(server, cache, {"vs_1": "a"})
+
+    qa.answer("q1", "vs_1")
+    qa.answer("q2", "vs_1")
+    qa.answer("q1", "vs_1")
+    qa.answer("q3", "vs_1")
+
+    assert cache.get("q1", "vs_1", "asst_1", "a") is not None
+    assert cache.get("q2", "vs_1", "asst_1", "a") is None
+
+
+def test_sqlite_storage_survives_restarts(tmp_path):
+    server = FakeAssistantServer()
+    db_file = tmp_path / "answers_cache.db"
+    qa = cached_model(server, AnswersCache(SQLiteAnswersCacheStorage(db_file)), {"vs_1": "a"})
+    answer = qa.answer("question", "vs_1")
+
+    memory = LRUAnswersCacheStorage()
+    cache = AnswersCache(LayeredAnswersCacheStorage([memory, SQLiteAnswersCacheStorage(db_file)]))
+
+    assert cache.get("question", "vs_1", "asst_1", "a") == answer
+    assert len(memory._entries) == 1
+
+
+def test_failed_answer_stream_is_not_cached():
+    server = FakeAssistantServer(stream_end="cut")
+    cache = AnswersCache(LRUAnswersCacheStorage())
+    qa = cached_model(server, cache, {"vs_1": "a"})
+
+    with pytest.raises(RunFailedError):
+        list(qa.answer_stream("question", "vs_1"))
+    server.stream_end = "completed"
+    list(qa.answer_stream("question", "vs_1"))
+
+    assert runs_created(server) == 2
+    assert cache.stats.hits == 0
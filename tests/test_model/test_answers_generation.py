@@ -0,0 +1,179 @@
+import asyncio
+
+import pytest
+
+from src.model.answers_generation import AnswerDelta, AsyncQuestionsAnswers, LLMAnswer, MarkdownAnswer, MarkdownAnswerBuilder, QuestionsAnswers, QuestionsAnswersMock
+from benchmarks.fake_assistant import FakeAnswer, FakeAssistantServer
+from src.model.files_manager import FileLink, InMemoryFilesManager
+# Same classes as the answers generation module, which imports them without the src prefix
+from model.run_polling import RunFailedError, RunPollingConfig, RunTimeoutError
+
+
+def test_questions_answers_with_fake_server():
+    server = FakeAssistantServer()
+    qa = QuestionsAnswers(server.client(), "asst_1")
+
+    answer = qa.answer("Donde configuro talonarios?", "vs_1")
+
+    assert answer.answer == "Respuesta a: Donde configuro talonarios?【4:0†source】"
+    assert [(r.text, r.file_id) for r in answer.references] == [("【4:0†source】", "file_1")]
+    assert answer.thread_id in server.threads
+    assert server.runs[answer.run_id]["status"] == "completed"
+
+
+def test_async_questions_answers():
+    server = FakeAssistantServer()
+
+    async def answer() -> LLMAnswer:
+        qa = await AsyncQuestionsAnswers.create(server.async_client(), "asst_1")
+        return await qa.answer("Donde configuro talonarios?", "vs_1")
+
+    answer = asyncio.run(answer())
+    assert answer.answer == "Respuesta a: Donde configuro talonarios?【4:0†source】"
+    assert answer.references[0].file_id == "file_1"
+
+
+def test_async_questions_answers_concurrent():
+    server = FakeAssistantServer(latency=0.05)
+    qa = AsyncQuestionsAnswers(server.async_client(), "asst_1")
+    questions = [(f"question {i}", f"vs_{i % 2}") for i in range(10)]
+
+    async def answer_many():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        answers = await qa.answer_many(questions)
+        return answers, loop.time() - start
+
+    answers, elapsed = asyncio.run(answer_many())
+
+    assert [a.answer.split("【")[0] for a in answers] == [f"Respuesta a: question {i}" for i in range(10)]  # type: ignore
+    # 5 requests of 50 ms per answer, sequentially it would take 2.5 s
+    assert elapsed < 1
+
+
+def test_async_questions_answers_timeout_cancels_run():
+    server = FakeAssistantServer(polls_to_complete=1000)
+    qa = AsyncQuestionsAnswers(server.async_client(), "asst_1", timeout=0.2)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(qa.answer("question", "vs_1"))
+
+    [run] = server.runs.values()
+    assert run["status"] == "cancelled"
+
+
+def test_async_questions_answers_cancel():
+    server = FakeAssistantServer(polls_to_complete=1000)
+    qa = AsyncQuestionsAnswers(server.async_client(), "asst_1")
+
+    async def cancel_answer():
+        task = asyncio.create_task(qa.answer("question", "vs_1"))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_answer())
+    [run] = server.runs.values()
+    assert run["status"] == "cancelled"
+
+
+FILE_LINKS = {
+    "file_1": FileLink(name="doc_1", url="https://docs.google.com/document/d/doc_1"),
+    "file_2": FileLink(name="doc_2", url="https://docs.google.com/document/d/doc_2"),
+}
+
+
+def two_references_answer(question: str) -> FakeAnswer:
+    return FakeAnswer(
+        text="Ver la configuracion【4:0†source】 y los talonarios【4:1†source】【4:2†source】.",
+        references=[{"text": "【4:0†source】", "file_id": "file_1"},  # type: ignore
+                    {"text": "【4:1†source】", "file_id": "file_2"},
+                    {"text": "【4:2†source】", "file_id": "file_1"}])
+
+
+def test_markdown_answer_from_llm_answer():
+    llm_answer = QuestionsAnswers(FakeAssistantServer(two_references_answer).client(), "asst_1") \
+        .answer("question", "vs_1")
+
+    answer = MarkdownAnswer.from_llm_answer(llm_answer, InMemoryFilesManager(FILE_LINKS))
+
+    assert answer.text == ("Ver la configuracion [ Referencia #1 ] y los talonarios"
+                           " [ Referencia #2 ] [ Referencia #3 ].")
+    assert answer.references == [" 1. [doc_1](https://docs.google.com/document/d/doc_1)\n\n",
+                                 " 2. [doc_2](https://docs.google.com/document/d/doc_2)\n\n"]
+    assert answer.thread_id == llm_answer.thread_id
+    assert answer.run_id == llm_answer.run_id
+
+
+def test_answer_stream_matches_answer():
+    server = FakeAssistantServer(two_references_answer)
+    qa = QuestionsAnswers(server.client(), "asst_1")
+    files_manager = InMemoryFilesManager(FILE_LINKS)
+
+    builder = MarkdownAnswerBuilder(files_manager)
+    partial_texts = []
+    deltas = list(qa.answer_stream("question", "vs_1"))
+    for delta in deltas:
+        builder.add(delta)
+        partial_texts.append(builder.text)
+    streamed = builder.build()
+
+    expected = MarkdownAnswer.from_llm_answer(qa.answer("question", "vs_1"), files_manager)
+    assert len(deltas) > 3
+    assert streamed.text == expected.text
+    assert streamed.references == expected.references
+    assert streamed.thread_id in server.threads
+    assert server.runs[streamed.run_id]["status"] == "completed"
+    # Every partial text is a prefix of the final one
+    assert all(expected.text.startswith(text) for text in partial_texts)
+
+
+@pytest.mark.parametrize("polling", [RunPollingConfig(queued_timeout=0), RunPollingConfig(deadline=0)])
+def test_answer_stream_cancels_late_runs(polling):
+    server = FakeAssistantServer()
+    statuses = []
+    qa = QuestionsAnswers(server.client(), "asst_1", polling, lambda run, _: statuses.append(run.status))
+
+    with pytest.raises(RunTimeoutError) as e:
+        list(qa.answer_stream("question", "vs_1"))
+
+    assert statuses == ["queued"]
+    assert server.runs[e.value.run.id]["status"] == "cancelled"
+
+
+def test_answer_stream_calls_the_status_hooks():
+    server = FakeAssistantServer()
+    statuses = []
+    qa = QuestionsAnswers(server.client(), "asst_1",
+                          on_status=lambda run, previous: statuses.append((previous, run.status)))
+
+    list(qa.answer_stream("question", "vs_1"))
+
+    assert statuses == [(None, "queued"), ("queued", "in_progress"), ("in_progress", "completed")]
+
+
+@pytest.mark.parametrize("stream_end", ["error", "requires_action", "cut"])
+def test_answer_stream_raises_unless_the_run_completes(stream_end):
+    server = FakeAssistantServer(stream_end=stream_end)
+    qa = QuestionsAnswers(server.client(), "asst_1")
+
+    with pytest.raises(RunFailedError):
+        list(qa.answer_stream("question", "vs_1"))
+
+    assert all(run["status"] != "requires_action" for run in server.runs.values())
+
+
+def test_builder_hides_partial_citations():
+    builder = MarkdownAnswerBuilder(InMemoryFilesManager(FILE_LINKS))
+    builder.add(AnswerDelta(text="Respuesta【4:0"))
+    assert builder.text == "Respuesta"
+
+
+def test_mock_answer_stream():
+    builder = MarkdownAnswerBuilder(InMemoryFilesManager({
+        "mock_file_1": FileLink(name="Google", url="https://www.google.com"),
+        "mock_file_2": FileLink(name="X", url="https://www.x.com")}))
+    for delta in QuestionsAnswersMock().answer_stream("question", "vs_1"):
+        builder.add(delta)
+    assert builder.build().text == "This is a mock answer\n\n [ Referencia #1 ]\n\n [ Referencia #2 ]"
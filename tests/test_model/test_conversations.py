@@ -0,0 +1,81 @@
+import time
+
+from src.model.conversations import ConversationQuestionsAnswers, ThreadsPool
+from benchmarks.fake_assistant import FakeAssistantServer
+# Same classes as the conversations module, which imports them without the src prefix
+from model.answers_cache import AnswersCache, CachedQuestionsAnswers, LRUAnswersCacheStorage
+from model.answers_generation import QuestionsAnswers, ThreadMessage
+
+
+def conversation_model(server: FakeAssistantServer, idle_timeout: float = 60) -> ConversationQuestionsAnswers:
+    client = server.client()
+    return ConversationQuestionsAnswers(QuestionsAnswers(client, "asst_1"), ThreadsPool(client, idle_timeout))
+
+
+def test_conversation_reuses_its_thread():
+    server = FakeAssistantServer()
+    qa = conversation_model(server)
+
+    first = qa.answer("Donde configuro talonarios?", "vs_1", "session_1")
+    second = qa.answer("Y los puntos de venta?", "vs_1", "session_1")
+    other = qa.answer("Donde configuro talonarios?", "vs_1", "session_2")
+
+    assert first.thread_id == second.thread_id
+    assert other.thread_id != first.thread_id
+    assert [m["role"] for m in server.threads[first.thread_id]] == ["user", "assistant", "user", "assistant"]
+    assert sum(request == ("POST", "/threads") for request in server.requests) == 2
+
+
+def test_first_turn_behind_the_cache_keeps_its_thread():
+    server = FakeAssistantServer()
+    qa = conversation_model(server)
+    cache = AnswersCache(LRUAnswersCacheStorage())
+
+    def first_turn(conversation_id: str) -> CachedQuestionsAnswers:
+        return CachedQuestionsAnswers(qa.conversation(conversation_id), cache, "asst_1", lambda _: "files")
+
+    first = list(first_turn("session_1").answer_stream("Donde configuro talonarios?", "vs_1"))
+    cached = list(first_turn("session_2").answer_stream("Donde configuro talonarios?", "vs_1"))
+    second = list(qa.answer_stream("Y los puntos de venta?", "vs_1", "session_1"))
+
+    assert qa.threads.get(("session_1", "vs_1")) == first[0].thread_id == second[0].thread_id
+    assert qa.threads.get(("session_2", "vs_1")) is None
+    assert cached[0].thread_id == first[0].thread_id
+    assert sum(request == ("POST", "/threads") for request in server.requests) == 1
+
+
+def test_new_thread_starts_with_the_history():
+    server = FakeAssistantServer()
+    qa = conversation_model(server)
+    history = [ThreadMessage(role="user", content="Hola"), ThreadMessage(role="assistant", content="Hola!")]
+
+    answer = qa.answer("Donde configuro talonarios?", "vs_1", "session_1", history)
+
+    contents = [m["content"][0]["text"]["value"] for m in server.threads[answer.thread_id]]
+    assert contents[:3] == ["Hola", "Hola!", "Donde configuro talonarios?"]
+
+
+def test_idle_threads_expire():
+    server = FakeAssistantServer()
+    qa = conversation_model(server, idle_timeout=0.05)
+
+    first = qa.answer("question", "vs_1", "session_1")
+    time.sleep(0.1)
+    assert qa.threads.expire_idle() == [first.thread_id]
+    assert first.thread_id not in server.threads
+
+    second = qa.answer("question", "vs_1", "session_1")
+    assert second.thread_id != first.thread_id
+
+
+def test_close_conversation_deletes_its_threads():
+    server = FakeAssistantServer()
+    qa = conversation_model(server)
+    v16 = qa.answer("question", "vs_1", "session_1")
+    v17 = qa.answer("question", "vs_2", "session_1")
+    other = qa.answer("question", "vs_1", "session_2")
+
+    qa.threads.close("session_1")
+
+    assert v16.thread_id not in server.threads and v17.thread_id not in server.threads
+    assert other.thread_id in server.threads
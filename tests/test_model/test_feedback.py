@@ -0,0 +1,170 @@
+import threading
+import time
+from unittest.mock import Mock
+
+import pytest
+
+from src.model.feedback.feedback import (COLUMNS_MAPPING, FeedbackLogsConfig, JSONLLogWriter, QueuedLogWriter,
+                                         SheetLogWriter, SQLiteLogWriter)
+from src.model.feedback.feedback import TestLog as FeedbackLog  # Not collected as a test class
+
+
+def make_log(i: int) -> FeedbackLog:
+    return FeedbackLog(user="user", version="v16", question=f"question {i}", answer="answer", was_solved="Yes",
+                   shared_sources="Yes", sources=["https://docs.google.com/document/d/1"], was_detailed="No",
+                   note=None, thread_id="thread_1", run_id="run_1")
+
+
+class ListSink:
+    def __init__(self, failures: int = 0):
+        self.batches: list[list[FeedbackLog]] = []
+        self.failures = failures
+
+    def write_many(self, test_logs: list[FeedbackLog]):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("Sheets unavailable")
+        self.batches.append(list(test_logs))
+
+    @property
+    def logs(self) -> list[FeedbackLog]:
+        return [log for batch in self.batches for log in batch]
+
+
+def test_sheet_log_writer_appends_in_one_call():
+    service = Mock()
+    service.get.return_value = [["ID", "Usuario", "Pregunta", "Fuente"]]
+    service.append.return_value = {"updates": {"updatedRange": "Logs!A5:D6"}}
+    writer = SheetLogWriter(service, FeedbackLogsConfig(spreadsheet_id="spreadsheet_id", sheet_name="Logs"))
+
+    writer.write_many([make_log(1), make_log(2)])
+    writer.write(make_log(3))
+
+    service.get.assert_called_once()  # Headers are read once
+    assert service.append.call_count == 2
+    spreadsheet_id, range_, rows = service.append.call_args_list[0].args
+    assert range_ == "Logs!A:L"
+    assert rows[0] == ["", "user", "question 1", "https://docs.google.com/document/d/1"]
+    # The ids are written as values, from the rows the append reports
+    service.update.assert_any_call("spreadsheet_id", "Logs!A5:A6", [[4], [5]])
+
+
+def test_sheet_log_writer_keeps_rows_without_ids():
+    service = Mock()
+    service.get.return_value = [["ID", "Usuario"]]
+    service.append.return_value = {"updates": {"updatedRange": "Logs!A5:B5"}}
+    service.update.side_effect = ConnectionError("Sheets unavailable")
+    writer = SheetLogWriter(service, FeedbackLogsConfig(spreadsheet_id="spreadsheet_id", sheet_name="Logs"))
+
+    writer.write(make_log(1))
+    service.append.return_value = {}
+    writer.write(make_log(2))
+
+    assert service.append.call_count == 2
+    service.update.assert_called_once()
+
+
+def test_sheet_log_writer_timings_column():
+    service = Mock()
+    service.get.return_value = [list(COLUMNS_MAPPING)]
+    service.append.return_value = {"updates": {"updatedRange": "Logs!A2:M3"}}
+    writer = SheetLogWriter(service, FeedbackLogsConfig(spreadsheet_id="spreadsheet_id", sheet_name="Logs"))
+
+    writer.write_many([make_log(1).model_copy(update={"timings": {"openai.run": 2.5}}), make_log(2)])
+
+    _, range_, rows = service.append.call_args.args
+    assert range_ == "Logs!A:M"
+    assert [row[-1] for row in rows] == ['{"openai.run": 2.5}', ""]
+
+@pytest.mark.parametrize("make_writer", [
+    lambda tmp_path: JSONLLogWriter(tmp_path / "logs.jsonl"),
+    lambda tmp_path: SQLiteLogWriter(tmp_path / "logs.db"),
+])
+def test_local_sinks(make_writer, tmp_path):
+    writer = make_writer(tmp_path)
+    writer.write_many([make_log(1), make_log(2)])
+    writer.write(make_log(3))
+
+    assert [log.question for log in writer.get_all()] == ["question 1", "question 2", "question 3"]
+
+
+def test_queued_writer_batches():
+    sink = ListSink()
+    writer = QueuedLogWriter(sink, max_batch=3, max_delay=1)
+
+    for i in range(3):
+        writer.write(make_log(i))
+    deadline = time.monotonic() + 2
+    while len(sink.logs) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    writer.close()
+
+    assert sink.batches == [[make_log(0), make_log(1), make_log(2)]]
+
+
+def test_queued_writer_returns_without_waiting_for_the_sink():
+    release = threading.Event()
+    sink = ListSink()
+    sink.write_many = lambda logs: release.wait(2)
+    writer = QueuedLogWriter(sink, max_batch=1, max_delay=0)
+
+    start = time.monotonic()
+    writer.write(make_log(1))
+    writer.write(make_log(2))
+    assert time.monotonic() - start < 0.5
+
+    release.set()
+    writer.close()
+
+
+def test_queued_writer_retries_failed_batches():
+    sink = ListSink(failures=1)
+    writer = QueuedLogWriter(sink, max_batch=10, max_delay=0.01)
+
+    writer.write(make_log(1))
+    deadline = time.monotonic() + 2
+    while len(sink.logs) < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    writer.close()
+
+    assert sink.logs == [make_log(1)]
+
+
+def test_queued_writer_diverts_poison_batches_to_fallback():
+    sink = ListSink()
+    poison = make_log(0)
+
+    def write_many(logs):
+        if poison in logs:
+            raise ValueError("Invalid log")
+        sink.batches.append(list(logs))
+
+    sink.write_many = write_many
+    fallback = ListSink()
+    writer = QueuedLogWriter(sink, max_batch=1, max_delay=0.01, fallback=fallback, max_attempts=2)
+
+    writer.write(poison)
+    writer.write(make_log(1))
+    deadline = time.monotonic() + 2
+    while (len(fallback.logs) < 1 or len(sink.logs) < 1) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    writer.close()
+
+    # The failed batch doesn't hold back the next one, and is diverted after its second attempt
+    assert sink.logs == [make_log(1)]
+    assert fallback.logs == [poison]
+    assert writer.pending == 0
+
+
+def test_close_flushes_pending_logs_to_fallback():
+    sink = ListSink(failures=100)
+    fallback = ListSink()
+    writer = QueuedLogWriter(sink, max_batch=10, max_delay=60, fallback=fallback)
+
+    writer.write(make_log(1))
+    writer.write(make_log(2))
+    writer.close()
+
+    assert sink.logs == []
+    assert fallback.logs == [make_log(1), make_log(2)]
+    assert writer.pending == 0
@@ -0,0 +1,113 @@
+import threading
+import time
+from unittest.mock import Mock
+
+from src.model.files_manager import FileLink, IdsMappingCache, SheetFilesDB
+
+
+def mock_files_db(sheet_name: str = "sheet"):
+    files_db = Mock()
+    files_db.vector_store_id = "vs_1"
+    files_db.sheet_name = sheet_name
+    files_db.get_ids_mapping.return_value = {"file_1": "doc_1"}
+    return files_db
+
+
+def test_ids_mapping_cache_loads_once():
+    files_db = mock_files_db()
+    cache = IdsMappingCache(files_db, ttl=60)
+
+    assert cache.get() == {"file_1": "doc_1"}
+    assert cache.get() == {"file_1": "doc_1"}
+    files_db.get_ids_mapping.assert_called_once()
+
+
+def test_ids_mapping_cache_invalidate():
+    files_db = mock_files_db()
+    cache = IdsMappingCache(files_db, ttl=60)
+    cache.get()
+
+    files_db.get_ids_mapping.return_value = {"file_2": "doc_2"}
+    cache.invalidate()
+
+    assert cache.get() == {"file_2": "doc_2"}
+    assert files_db.get_ids_mapping.call_count == 2
+
+
+def test_ids_mapping_cache_background_refresh():
+    files_db = mock_files_db()
+    cache = IdsMappingCache(files_db, ttl=0)
+    cache.get()
+
+    files_db.get_ids_mapping.return_value = {"file_2": "doc_2"}
+    # The stale mapping is served while the refresh runs in the background
+    assert cache.get() == {"file_1": "doc_1"}
+
+    for _ in range(100):
+        if cache._mapping == {"file_2": "doc_2"}:
+            break
+        time.sleep(0.01)
+    assert cache._mapping == {"file_2": "doc_2"}
+
+
+def test_ids_mapping_cache_refresh_racing_invalidate():
+    files_db = mock_files_db()
+    cache = IdsMappingCache(files_db, ttl=60)
+    reading = threading.Event()
+    release = threading.Event()
+
+    def slow_pre_sync_read() -> dict[str, str]:
+        files_db.get_ids_mapping.side_effect = None
+        reading.set()
+        release.wait(2)
+        return {"file_1": "doc_1"}
+
+    files_db.get_ids_mapping.side_effect = slow_pre_sync_read
+    refresh = threading.Thread(target=cache.refresh)
+    refresh.start()
+    assert reading.wait(2)
+
+    # The sync finishes while the pre-sync mapping is being read
+    files_db.get_ids_mapping.return_value = {"file_2": "doc_2"}
+    cache.invalidate()
+    release.set()
+    refresh.join()
+
+    pre_sync = IdsMappingCache(mock_files_db(), ttl=60)
+    assert cache.get() == {"file_2": "doc_2"}
+    assert cache.fingerprint() != pre_sync.fingerprint()
+    assert files_db.get_ids_mapping.call_count == 2
+
+
+def test_ids_mapping_cache_loads_once_for_concurrent_callers():
+    files_db = mock_files_db()
+    cache = IdsMappingCache(files_db, ttl=60)
+    release = threading.Event()
+
+    def slow_read() -> dict[str, str]:
+        release.wait(2)
+        return {"file_1": "doc_1"}
+
+    files_db.get_ids_mapping.side_effect = slow_read
+    results: list[dict[str, str]] = []
+    callers = [threading.Thread(target=lambda: results.append(cache.get())) for _ in range(5)]
+    for caller in callers:
+        caller.start()
+    time.sleep(0.05)
+    release.set()
+    for caller in callers:
+        caller.join()
+
+    assert results == [{"file_1": "doc_1"}] * 5
+    files_db.get_ids_mapping.assert_called_once()
+
+
+def test_sheet_files_db_get_file_link():
+    files_db = mock_files_db("links")
+    files_manager = SheetFilesDB(files_db)
+    files_manager.ids_mapping.invalidate()
+
+    assert files_manager.get_file_link("file_1") == FileLink(
+        name="doc_1", url="https://docs.google.com/document/d/doc_1")
+    assert files_manager.get_file_link("missing") == FileLink(name="File not found", url="")
+    files_db.get_ids_mapping.assert_called_once()
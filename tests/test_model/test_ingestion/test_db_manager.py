@@ -0,0 +1,115 @@
+from unittest.mock import Mock
+
+import pytest
+
+from benchmarks.fakes import FakeSheetService
+from src.ingestion.db_manager import FilesWriteBuffer, VectorStoreFilesDB, file_info_row
+
+
+@pytest.fixture
+def files_db():
+    return VectorStoreFilesDB(Mock(), "spreadsheet_id", "V_16", "vs_1")
+
+
+def test_write_many_single_append(files_db, file_info):
+    files_db.write_many([file_info(1), file_info(2)])
+
+    files_db.service.append.assert_called_once()
+    kwargs = files_db.service.append.call_args.kwargs
+    assert kwargs["range_"] == "V_16!A:I"
+    assert [row[0] for row in kwargs["body"]] == ["file_1", "file_2"]
+    files_db.service.get.assert_not_called()
+
+
+def test_write_buffer_flushes_on_size_and_exit(files_db, file_info):
+    with files_db.write_buffer(max_rows=2, max_delay=60) as buffer:
+        for i in range(3):
+            buffer.write(file_info(i))
+        assert files_db.service.append.call_count == 1
+
+    assert files_db.service.append.call_count == 2
+    assert buffer.pending == []
+
+
+def test_write_buffer_flushes_on_time(files_db, file_info):
+    buffer = FilesWriteBuffer(files_db, max_rows=10, max_delay=0.01)
+    buffer.write(file_info(1))
+    assert buffer._timer is not None
+    buffer._timer.join()
+
+    files_db.service.append.assert_called_once()
+    assert buffer.pending == []
+
+
+def test_write_buffer_keeps_rows_on_error(files_db, file_info):
+    files_db.service.append.side_effect = IOError("quota")
+    buffer = FilesWriteBuffer(files_db, max_rows=10, max_delay=60)
+    buffer.write(file_info(1))
+
+    with pytest.raises(IOError):
+        buffer.flush()
+    assert buffer.pending == [file_info(1)]
+
+
+def test_write_buffer_size_flush_does_not_raise(files_db, file_info):
+    files_db.service.append.side_effect = IOError("quota")
+    buffer = FilesWriteBuffer(files_db, max_rows=2, max_delay=60)
+
+    buffer.write(file_info(1))
+    buffer.write(file_info(2))
+
+    files_db.service.append.assert_called_once()
+    assert buffer.pending == [file_info(1), file_info(2)]
+
+
+@pytest.fixture
+def sheet_rows(file_info) -> list[list[str]]:
+    rows = [[str(v) for v in file_info(i).model_dump().values()] for i in range(3)]
+    rows[1][5] = "deleted"
+    return rows
+
+
+def test_update_statuses_single_read_and_write(files_db, sheet_rows, file_info):
+    files_db.service.get.return_value = sheet_rows
+
+    files_db.update_statuses([(file_info(0), "deleted"), (file_info(2), "updated")])
+
+    files_db.service.get.assert_called_once_with(spreadsheet_id="spreadsheet_id", range_="V_16!A2:G")
+    files_db.service.batch_update.assert_called_once_with(
+        spreadsheet_id="spreadsheet_id",
+        data={"V_16!F2": [["deleted"]], "V_16!F4": [["updated"]]})
+
+
+def test_update_statuses_skips_rows_not_ok(files_db, sheet_rows, file_info):
+    files_db.service.get.return_value = sheet_rows
+
+    skipped = files_db.update_statuses([(file_info(1), "deleted"), (file_info(0), "deleted"),
+                                        (file_info(0), "updated")])
+
+    assert skipped == [file_info(1), file_info(0)]
+    files_db.service.batch_update.assert_called_once_with(
+        spreadsheet_id="spreadsheet_id", data={"V_16!F2": [["deleted"]]})
+    with pytest.raises(AssertionError):
+        files_db.update_status(file_info(1), "deleted")
+
+
+def test_update_status(files_db, sheet_rows, file_info):
+    files_db.service.get.return_value = sheet_rows
+
+    files_db.update_status(file_info(2), "deleted")
+    files_db.service.batch_update.assert_called_once_with(
+        spreadsheet_id="spreadsheet_id",
+        data={"V_16!F4": [["deleted"]]})
+
+
+def test_update_statuses_keeps_other_rows_of_the_source(file_info):
+    keep = file_info(1)
+    duplicate = file_info(1).model_copy(update={"id": "file_duplicate"})
+    sheets = FakeSheetService()
+    sheets.sheets["V_16"] = [["id"], file_info_row(keep), file_info_row(duplicate)]
+    files_db = VectorStoreFilesDB(sheets, "spreadsheet_id", "V_16", "vs_1")
+
+    assert files_db.update_statuses([(duplicate, "deleted")]) == []
+
+    assert [(f.id, f.status) for f in files_db.get_all_rows()] == [("file_1", "ok"), ("file_duplicate", "deleted")]
+    assert files_db.get_ids_mapping() == {"file_1": "doc_1"}
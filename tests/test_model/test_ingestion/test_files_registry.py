@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from unittest.mock import Mock
+
+import pytest
+
+from src.ingestion.files_registry import OpenAIFilesRegistry, content_hash
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return OpenAIFilesRegistry(tmp_path / "registry.db")
+
+
+def test_content_hash():
+    assert content_hash(b"file") == content_hash(b"file")
+    assert content_hash(b"file") != content_hash(b"other")
+
+
+def test_get_or_upload_uploads_once(registry):
+    upload = Mock(return_value="file_1")
+
+    assert registry.get_or_upload("hash", upload) == "file_1"
+    assert registry.get_or_upload("hash", upload) == "file_1"
+    upload.assert_called_once()
+    assert registry.get_file_id("hash") == "file_1"
+    assert registry.get_file_id("other") is None
+
+
+def test_get_or_upload_concurrent(registry):
+    upload = Mock(return_value="file_1")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        file_ids = list(executor.map(lambda _: registry.get_or_upload("hash", upload), range(16)))
+
+    assert file_ids == ["file_1"] * 16
+    upload.assert_called_once()
+
+
+def test_references(registry):
+    registry.add_reference("file_1", "vs_16", "V_16/doc")
+    registry.add_reference("file_1", "vs_16", "V_16/doc")
+    registry.add_reference("file_1", "vs_16", "V_16/copy")
+    registry.add_reference("file_1", "vs_17", "V_17/doc")
+
+    assert registry.remove_reference("file_1", "vs_16", "V_16/doc") == (1, 2)
+    assert registry.remove_reference("file_1", "vs_16", "V_16/copy") == (0, 1)
+    assert registry.remove_reference("file_1", "vs_17", "V_17/doc") == (0, 0)
+
+
+def test_persistence(tmp_path):
+    OpenAIFilesRegistry(tmp_path / "registry.db").get_or_upload("hash", lambda: "file_1")
+    assert OpenAIFilesRegistry(tmp_path / "registry.db").get_file_id("hash") == "file_1"
+
+
+def test_content_hash_file_object():
+    content = BytesIO(b"file")
+    content.read(2)
+
+    assert content_hash(content) == content_hash(b"file")
+    assert content.tell() == 0
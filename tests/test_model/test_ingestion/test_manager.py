@@ -0,0 +1,294 @@
+from io import BytesIO
+from unittest.mock import Mock
+
+from src.ingestion.db_manager import FilesWriteBuffer, VectorStoreFileInfo
+from src.ingestion.files_registry import OpenAIFilesRegistry, content_hash
+from src.ingestion.manager import (IngestionManager, PipelineConfig, SourcesDifferences, compute_differences,
+                                  compute_incremental_differences)
+from src.ingestion.sqlite_db import SQLiteVectorStoreFilesDB
+from src.model.files.gcs import GCSFile
+from src.utils.gcs_utils import ListingChanges, ListingSnapshot
+
+
+def ingestion_mocks():
+    openai_client = Mock()
+    openai_client.files.create.side_effect = lambda file, purpose: Mock(id=f"file_{file[0]}")
+    vs_files_db = Mock()
+    vs_files_db.vector_store_id = "vs_1"
+    vs_files_db.update_statuses.return_value = []
+    vs_files_db.write_buffer.side_effect = lambda rows, delay: FilesWriteBuffer(vs_files_db, rows, delay)
+    bucket = Mock()
+    bucket.download_to_file.side_effect = lambda file, max_memory: BytesIO(file.name.encode())
+    return openai_client, vs_files_db, bucket
+
+
+FAST_CONFIG = PipelineConfig(download_workers=2, upload_workers=2, attach_workers=2,
+                             queue_size=1, max_retries=1, retry_delay=0)
+
+
+def test_sync_ingests_removes_and_updates(gcs_file, vs_file):
+    openai_client, vs_files_db, bucket = ingestion_mocks()
+    manager = IngestionManager(openai_client, vs_files_db)
+
+    differences = SourcesDifferences()
+    differences.new_files = [gcs_file(f"new_{i}") for i in range(5)]
+    differences.deleted = [vs_file("deleted")]
+    differences.updated = [(gcs_file("updated"), vs_file("updated"))]
+
+    report = manager.sync(differences, bucket, FAST_CONFIG)
+
+    assert report.failures == []
+    assert report.peak_memory_mb > 0
+    assert sorted(report.ingested) == sorted(
+        [f"bucket/V_16/new_{i}" for i in range(5)] + ["bucket/V_16/updated"])
+    assert sorted(report.removed) == ["bucket/V_16/deleted", "bucket/V_16/updated"]
+    assert openai_client.files.create.call_count == 6
+    assert openai_client.beta.vector_stores.files.create.call_count == 6
+    assert sum(len(c.args[0]) for c in vs_files_db.write_many.call_args_list) == 6
+    vs_files_db.update_statuses.assert_called_once()
+    assert sorted((f.id, status) for f, status in vs_files_db.update_statuses.call_args.args[0]) == [
+        ("file_deleted", "deleted"), ("file_updated", "updated")]
+
+
+def test_sync_collects_failures(gcs_file):
+    openai_client, vs_files_db, bucket = ingestion_mocks()
+
+    def download_to_file(file: GCSFile, max_memory: int) -> BytesIO:
+        if "broken" in file.name:
+            raise IOError("boom")
+        return BytesIO(b"bytes")
+
+    bucket.download_to_file.side_effect = download_to_file
+    manager = IngestionManager(openai_client, vs_files_db)
+
+    differences = SourcesDifferences()
+    differences.new_files = [gcs_file("ok"), gcs_file("broken")]
+
+    report = manager.sync(differences, bucket, FAST_CONFIG)
+
+    assert report.ingested == ["bucket/V_16/ok"]
+    assert len(report.failures) == 1
+    assert report.failures[0].source_id == "bucket/V_16/broken"
+    assert report.failures[0].stage == "download"
+    # One attempt plus one retry
+    assert sum("broken" in c.args[0].name for c in bucket.download_to_file.call_args_list) == 2
+
+
+def test_sync_batch_mode(gcs_file):
+    openai_client, vs_files_db, bucket = ingestion_mocks()
+    openai_client.beta.vector_stores.file_batches.create.side_effect = \
+        lambda vector_store_id, file_ids: Mock(id=f"batch_{len(file_ids)}_{file_ids[0]}")
+    openai_client.beta.vector_stores.file_batches.retrieve.side_effect = [
+        Mock(status="in_progress"), Mock(status="completed"), Mock(status="completed")]
+    openai_client.beta.vector_stores.file_batches.list_files.side_effect = \
+        lambda batch_id, vector_store_id, limit: [
+            Mock(id=f"file_new_{i}.pdf", status="completed") for i in range(3)]
+    manager = IngestionManager(openai_client, vs_files_db)
+
+    differences = SourcesDifferences()
+    differences.new_files = [gcs_file(f"new_{i}") for i in range(3)]
+    config = FAST_CONFIG.model_copy(update={"attach_batch_size": 2})
+    report = manager.sync(differences, bucket, config)
+
+    assert report.failures == []
+    assert openai_client.beta.vector_stores.file_batches.create.call_count == 2
+    openai_client.beta.vector_stores.files.create.assert_not_called()
+    vs_files_db.write_many.assert_called_once()
+    assert len(vs_files_db.write_many.call_args.args[0]) == 3
+    assert report.indexing == {f"bucket/V_16/new_{i}": "completed" for i in range(3)}
+    assert report.is_ready()
+
+
+def test_sync_batch_mode_does_not_register_failed_indexing(gcs_file):
+    openai_client, vs_files_db, bucket = ingestion_mocks()
+    openai_client.beta.vector_stores.file_batches.create.return_value = Mock(id="batch_1")
+    openai_client.beta.vector_stores.file_batches.retrieve.return_value = Mock(status="completed")
+    openai_client.beta.vector_stores.file_batches.list_files.return_value = [
+        Mock(id="file_new_0.pdf", status="completed"), Mock(id="file_new_1.pdf", status="failed")]
+    manager = IngestionManager(openai_client, vs_files_db)
+
+    differences = SourcesDifferences()
+    differences.new_files = [gcs_file(f"new_{i}") for i in range(2)]
+    report = manager.sync(differences, bucket, FAST_CONFIG.model_copy(update={"attach_batch_size": 2}))
+
+    assert report.ingested == ["bucket/V_16/new_0"]
+    assert [(f.source_id, f.stage) for f in report.failures] == [("bucket/V_16/new_1", "index")]
+    assert [f.source_id for f in vs_files_db.write_many.call_args.args[0]] == ["bucket/V_16/new_0"]
+    openai_client.files.delete.assert_called_once_with("file_new_1.pdf")
+    assert not report.is_ready()
+
+
+def test_sync_keeps_rows_that_could_not_be_written(gcs_file):
+    openai_client, vs_files_db, bucket = ingestion_mocks()
+    vs_files_db.write_many.side_effect = IOError("quota")
+    manager = IngestionManager(openai_client, vs_files_db)
+
+    differences = SourcesDifferences()
+    differences.new_files = [gcs_file("new")]
+    report = manager.sync(differences, bucket, FAST_CONFIG)
+
+    # Attached, the rows are kept to be written later
+    assert report.ingested == ["bucket/V_16/new"]
+    assert [f.source_id for f in report.pending] == ["bucket/V_16/new"]
+    assert report.failures == []
+
+
+def test_sync_reports_rows_that_could_not_be_updated(gcs_file, vs_file):
+    openai_client, vs_files_db, bucket = ingestion_mocks()
+    vs_files_db.update_statuses.return_value = [vs_file("updated")]
+    manager = IngestionManager(openai_client, vs_files_db)
+
+    differences = SourcesDifferences()
+    differences.deleted = [vs_file("deleted")]
+    differences.updated = [(gcs_file("updated"), vs_file("updated"))]
+    report = manager.sync(differences, bucket, FAST_CONFIG)
+
+    vs_files_db.update_statuses.assert_called_once()
+    assert report.removed == ["bucket/V_16/deleted"]
+    assert [(f.source_id, f.stage) for f in report.failures] == [("bucket/V_16/updated", "status")]
+    assert report.ingested == []
+
+
+def test_sync_failed_flush_does_not_stop_attach_or_duplicate_rows(gcs_file):
+    openai_client, vs_files_db, bucket = ingestion_mocks()
+    written: list[VectorStoreFileInfo] = []
+    failures: list[IOError] = []
+
+    def write_many(rows: list[VectorStoreFileInfo]):
+        # The first size triggered flush fails, the rows must be written once by a later one
+        if failures:
+            raise failures.pop()
+        written.extend(rows)
+
+    vs_files_db.write_many.side_effect = write_many
+    manager = IngestionManager(openai_client, vs_files_db)
+
+    differences = SourcesDifferences()
+    differences.new_files = [gcs_file(f"new_{i}") for i in range(4)]
+    for attach_batch_size in (1, 2):
+        written.clear()
+        failures.append(IOError("quota"))
+        config = FAST_CONFIG.model_copy(update={"attach_batch_size": attach_batch_size, "write_buffer_rows": 2})
+        report = manager.sync(differences, bucket, config)
+
+        assert report.failures == []
+        assert sorted(f.source_id for f in written) == sorted(f"bucket/V_16/new_{i}" for i in range(4))
+
+
+def test_compute_differences(gcs_file, vs_file):
+    unchanged = gcs_file("unchanged")
+    touched = gcs_file("touched").model_copy(update={"md5_hash": "same", "generation": 2})
+    modified = gcs_file("modified").model_copy(update={"md5_hash": "new", "generation": 2})
+    legacy = gcs_file("legacy")
+    new = gcs_file("new")
+
+    vs_files = [
+        vs_file("unchanged").model_copy(update={"last_modified": unchanged.updated}),
+        vs_file("touched").model_copy(update={"content_hash": "md5:same", "generation": 1}),
+        vs_file("modified").model_copy(update={"content_hash": "md5:old", "generation": 1}),
+        vs_file("legacy"),
+        vs_file("deleted"),
+    ]
+
+    differences = compute_differences([unchanged, touched, modified, legacy, new], vs_files)
+
+    assert differences.new_files == [new]
+    assert [f.source_id for f in differences.no_changes] == ["bucket/V_16/unchanged", "bucket/V_16/touched"]
+    assert [(g.source_id, v.source_id) for g, v in differences.updated] == [
+        ("bucket/V_16/modified", "bucket/V_16/modified"), ("bucket/V_16/legacy", "bucket/V_16/legacy")]
+    assert [f.source_id for f in differences.deleted] == ["bucket/V_16/deleted"]
+
+
+def test_compute_differences_deletes_duplicates(gcs_file, vs_file):
+    duplicate = vs_file("doc").model_copy(update={"id": "file_duplicate"})
+    # Rows with the same file id are the same file, not duplicates
+    differences = compute_differences([gcs_file("doc")], [vs_file("doc"), vs_file("doc"), duplicate])
+
+    assert [(g.source_id, v.id) for g, v in differences.updated] == [("bucket/V_16/doc", vs_file("doc").id)]
+    assert differences.deleted == [duplicate]
+
+
+def test_sync_deletes_duplicated_row_and_keeps_the_first(tmp_path, gcs_file, vs_file):
+    openai_client, _, bucket = ingestion_mocks()
+    files_db = SQLiteVectorStoreFilesDB(tmp_path / "files_db.db", "V_16", "vs_1")
+    keep = vs_file("doc").model_copy(update={"id": "file_keep", "last_modified": gcs_file("doc").updated})
+    files_db.write_many([keep, keep.model_copy(update={"id": "file_dup"})])
+
+    differences = compute_differences([gcs_file("doc")], files_db.get_all())
+    report = IngestionManager(openai_client, files_db).sync(differences, bucket, FAST_CONFIG)
+
+    assert report.removed == ["bucket/V_16/doc"]
+    openai_client.files.delete.assert_called_once_with("file_dup")
+    assert [(f.id, f.status) for f in files_db.get_all_rows()] == [("file_keep", "ok"), ("file_dup", "deleted")]
+    assert files_db.get_ids_mapping() == {"file_keep": "doc"}
+
+
+def test_compute_differences_same_generation(gcs_file, vs_file):
+    source_file = gcs_file("doc").model_copy(update={"generation": 5, "md5_hash": "new"})
+    stored = vs_file("doc").model_copy(update={"generation": 5, "content_hash": "md5:old"})
+
+    differences = compute_differences([source_file], [stored])
+    assert differences.no_changes == [source_file]
+
+
+def test_compute_differences_large_bucket(gcs_file, vs_file):
+    source_files = [gcs_file(f"doc_{i}") for i in range(20000)]
+    vs_files = [vs_file(f"doc_{i}") for i in range(0, 20000, 2)]
+
+    differences = compute_differences(source_files, vs_files)
+
+    assert len(differences.new_files) == 10000
+    assert len(differences.updated) == 10000
+    assert differences.deleted == []
+
+
+def test_compute_incremental_differences(gcs_file, vs_file):
+    modified = gcs_file("modified").model_copy(update={"md5_hash": "new", "generation": 2})
+    touched = gcs_file("touched").model_copy(update={"md5_hash": "same", "generation": 2})
+    replaced = gcs_file("replaced")
+    new = gcs_file("new")
+    deleted = {"generation": 1, "updated": new.updated}
+
+    changes = ListingChanges(
+        changed=[f.model_dump() for f in [modified, touched, replaced, new]],
+        deleted=[{**deleted, "source_id": "bucket/V_16/deleted"}, {**deleted, "source_id": "bucket/V_16/replaced"},
+                 {**deleted, "source_id": "bucket/V_16/never_synced"}],
+        unchanged=1000,
+        snapshot=ListingSnapshot())
+    vs_files = [
+        vs_file("modified").model_copy(update={"content_hash": "md5:old", "generation": 1}),
+        vs_file("touched").model_copy(update={"content_hash": "md5:same", "generation": 1}),
+        vs_file("replaced"),
+        vs_file("deleted"),
+        vs_file("unchanged"),
+    ]
+
+    differences = compute_incremental_differences(changes, vs_files)
+
+    assert [f.source_id for f in differences.new_files] == ["bucket/V_16/new"]
+    assert [g.source_id for g, _ in differences.updated] == ["bucket/V_16/modified", "bucket/V_16/replaced"]
+    assert [f.source_id for f in differences.no_changes] == ["bucket/V_16/touched"]
+    assert [f.source_id for f in differences.deleted] == ["bucket/V_16/deleted"]
+
+
+def test_shared_files_are_uploaded_and_deleted_once(tmp_path, gcs_file, vs_file):
+    registry = OpenAIFilesRegistry(tmp_path / "registry.db")
+    openai_client, vs_16_db, _ = ingestion_mocks()
+    vs_17_db = Mock()
+    vs_17_db.vector_store_id = "vs_2"
+    manager_16 = IngestionManager(openai_client, vs_16_db, registry)
+    manager_17 = IngestionManager(openai_client, vs_17_db, registry)
+
+    manager_16.ingest_file(gcs_file("doc"), b"same bytes")
+    manager_17.ingest_file(gcs_file("doc"), b"same bytes")
+    openai_client.files.create.assert_called_once()
+    assert openai_client.beta.vector_stores.files.create.call_count == 2
+
+    manager_16.delete_file(vs_file("doc").model_copy(update={"id": "file_doc.pdf"}))
+    openai_client.beta.vector_stores.files.delete.assert_called_once_with(
+        vector_store_id="vs_1", file_id="file_doc.pdf")
+    openai_client.files.delete.assert_not_called()
+
+    manager_17.delete_file(vs_file("doc").model_copy(update={"id": "file_doc.pdf"}))
+    openai_client.files.delete.assert_called_once_with("file_doc.pdf")
+    assert registry.get_file_id(content_hash(b"same bytes")) is None
@@ -0,0 +1,115 @@
+from unittest.mock import Mock
+
+import pytest
+
+from benchmarks.fakes import FakeSheetService
+from src.ingestion.db_manager import VectorStoreFileInfo, VectorStoreFilesDB, file_info_row
+from src.ingestion.sqlite_db import SheetChangedError, SheetMirror, SQLiteVectorStoreFilesDB, open_sqlite_files_db
+
+
+@pytest.fixture
+def files_db(tmp_path):
+    return SQLiteVectorStoreFilesDB(tmp_path / "files_db.db", "V_16", "vs_1")
+
+
+def test_write_and_get_all(files_db, file_info):
+    files_db.write_many([file_info(1), file_info(2), file_info(3, "deleted")])
+    files_db.write(file_info(4))
+
+    files = files_db.get_all()
+    assert [f.id for f in files] == ["file_1", "file_2", "file_4"]
+    assert files[0].model_dump() == file_info(1).model_dump()
+    assert files_db.get_ids_mapping() == {"file_1": "doc_1", "file_2": "doc_2", "file_4": "doc_4"}
+    assert len(files_db.get_all_rows()) == 4
+    assert files_db.get_by_source_id("bucket/V_16/doc_2").id == "file_2"
+
+
+def test_data_versions_are_separated(files_db, tmp_path, file_info):
+    other = SQLiteVectorStoreFilesDB(tmp_path / "files_db.db", "V_17", "vs_2")
+    files_db.write(file_info(1))
+
+    assert other.get_all() == []
+    assert len(files_db.get_all()) == 1
+
+
+def test_update_statuses(files_db, file_info):
+    files_db.write_many([file_info(1), file_info(2)])
+
+    files_db.update_statuses([(file_info(1), "updated"), (file_info(2), "deleted")])
+
+    assert files_db.get_all() == []
+    assert [f.status for f in files_db.get_all_rows()] == ["updated", "deleted"]
+
+
+def test_update_statuses_skips_missing_files(files_db, file_info):
+    files_db.write(file_info(1))
+
+    skipped = files_db.update_statuses([(file_info(1), "deleted"), (file_info(2), "deleted")])
+
+    assert skipped == [file_info(2)]
+    assert [f.status for f in files_db.get_all_rows()] == ["deleted"]
+    with pytest.raises(AssertionError):
+        files_db.update_status(file_info(2), "deleted")
+
+
+def test_update_statuses_by_file_id(files_db, file_info):
+    keep = file_info(1)
+    duplicate = file_info(1).model_copy(update={"id": "file_duplicate"})
+    files_db.write_many([keep, duplicate])
+
+    skipped = files_db.update_statuses([(duplicate, "deleted"), (duplicate, "deleted")])
+
+    assert skipped == [duplicate]
+    assert [(f.id, f.status) for f in files_db.get_all_rows()] == [("file_1", "ok"), ("file_duplicate", "deleted")]
+    assert files_db.get_ids_mapping() == {"file_1": "doc_1"}
+
+
+def test_import_rows_only_into_empty_version(files_db, file_info):
+    assert files_db.import_rows([file_info(1)])
+    assert not files_db.import_rows([file_info(2)])
+    assert [f.id for f in files_db.get_all()] == ["file_1"]
+
+
+def sheet_db_with(rows: list[VectorStoreFileInfo]) -> VectorStoreFilesDB:
+    sheets = FakeSheetService()
+    sheets.sheets["V_16"] = [["id"]] + [file_info_row(f) for f in rows]
+    return VectorStoreFilesDB(sheets, "spreadsheet_id", "V_16", "vs_1")
+
+
+def test_sheet_mirror_writes_changes(files_db, file_info):
+    sheet_db = sheet_db_with([])
+    mirror = SheetMirror(files_db, sheet_db, interval=60)
+    files_db.write_many([file_info(1), file_info(2)])
+
+    assert mirror.mirror()
+    assert not mirror.mirror()
+    assert sheet_db.service.sheets["V_16"][1:] == [file_info_row(file_info(i)) for i in (1, 2)]
+
+    files_db.update_status(file_info(1), "deleted")
+    assert mirror.mirror()
+    assert sheet_db.service.calls["sheets.update"] == 2
+
+
+def test_sheet_mirror_does_not_overwrite_sheet_changes(files_db, file_info):
+    sheet_db = sheet_db_with([file_info(1)])
+    files_db.import_rows([file_info(1)])
+    mirror = SheetMirror(files_db, sheet_db, interval=60, in_sync=True)
+
+    sheet_db.write(file_info(2))    # e.g. a sync from another machine
+    files_db.write(file_info(3))
+
+    with pytest.raises(SheetChangedError):
+        mirror.mirror()
+    assert [f.id for f in sheet_db.get_all_rows()] == ["file_1", "file_2"]
+
+
+def test_stale_local_files_db_is_imported_again(tmp_path, file_info):
+    stale = SQLiteVectorStoreFilesDB(tmp_path / "files_db.db", "V_16", "vs_1")
+    stale.write(file_info(1))
+    sheet_db = sheet_db_with([file_info(1), file_info(2, "deleted"), file_info(3)])
+
+    files_db, mirror = open_sqlite_files_db(tmp_path / "files_db.db", sheet_db, mirror_interval=None)
+
+    assert [(f.id, f.status) for f in files_db.get_all_rows()] == [("file_1", "ok"), ("file_2", "deleted"),
+                                                                   ("file_3", "ok")]
+    assert mirror is None
@@ -0,0 +1,161 @@
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+
+from src.ingestion.sync_plan import (StalePlanError, SyncPlan, SyncPlanCache, build_sync_plan, execute_sync_plan,
+                                     pending_rows, snapshot_file)
+# Same classes as the sync plan module, which imports them without the src prefix
+from ingestion.db_manager import VectorStoreFileInfo
+from ingestion.manager import FileFailure, SyncReport
+from utils.gcs_utils import GCSBucketFacade, ListingSnapshot
+
+
+UPDATED = datetime.fromisoformat("2024-12-21 00:00:00+00:00")
+
+
+def listed_blob(folder: str, name: str, generation: int = 1) -> SimpleNamespace:
+    return SimpleNamespace(id=f"bucket/{folder}/{name}.pdf/{generation}", name=f"{folder}/{name}.pdf",
+                           content_type="application/pdf", updated=UPDATED, md5_hash=None, crc32c=None,
+                           generation=generation, size=10)
+
+
+def files_db(folder: str, vs_files: list[VectorStoreFileInfo]) -> Mock:
+    db = Mock(sheet_name=folder, vector_store_id=f"vs_{folder}")
+    db.get_all.return_value = vs_files
+    return db
+
+
+@pytest.fixture
+def bucket() -> GCSBucketFacade:
+    blobs = {"V_16": [listed_blob("V_16", "kept"), listed_blob("V_16", "new")],
+             "V_17": [listed_blob("V_17", "updated", generation=2)]}
+    bucket = Mock()
+    bucket.list_blobs.side_effect = lambda prefix, fields: SimpleNamespace(pages=[iter(blobs[prefix])])
+    return GCSBucketFacade(bucket)
+
+
+@pytest.fixture
+def files_dbs(vs_file) -> dict[str, Mock]:
+    return {"V_16": files_db("V_16", [vs_file("kept", "V_16", generation=1),
+                                      vs_file("deleted", "V_16", generation=1)]),
+            "V_17": files_db("V_17", [vs_file("updated", "V_17", generation=1)])}
+
+
+def test_build_sync_plan(bucket, files_dbs, tmp_path):
+    plan = build_sync_plan(bucket, files_dbs, tmp_path, workers=2)
+
+    assert list(plan.versions) == ["V_16", "V_17"]
+    v16 = plan.versions["V_16"].differences
+    assert [f.source_id for f in v16.new_files] == ["bucket/V_16/new"]
+    assert [f.source_id for f in v16.no_changes] == ["bucket/V_16/kept"]
+    assert [f.source_id for f in v16.deleted] == ["bucket/V_16/deleted"]
+    assert [g.source_id for g, _ in plan.versions["V_17"].differences.updated] == ["bucket/V_17/updated"]
+    assert plan.versions["V_16"].total_files == 2
+
+    plan.save(tmp_path / "sync_plan.json")
+    loaded = SyncPlan.load(tmp_path / "sync_plan.json")
+    assert loaded == plan
+    assert loaded.fingerprint == plan.fingerprint
+
+
+def test_execute_sync_plan_saves_snapshots(bucket, files_dbs, tmp_path):
+    plan = SyncPlan.model_validate_json(build_sync_plan(bucket, files_dbs, tmp_path).model_dump_json())
+    managers = {}
+
+    def ingestion_manager(db):
+        failures = [FileFailure(source_id="bucket/V_16/new", stage="upload", error="timeout")] \
+            if db.sheet_name == "V_16" else []
+        managers[db.sheet_name] = Mock()
+        managers[db.sheet_name].sync.return_value = SyncReport(failures=failures)
+        return managers[db.sheet_name]
+
+    reports = execute_sync_plan(plan, bucket, files_dbs, ingestion_manager, Mock(), tmp_path)
+
+    assert list(reports) == ["V_16", "V_17"]
+    assert managers["V_16"].sync.call_args.args[0] == plan.versions["V_16"].differences
+    assert ListingSnapshot.load(snapshot_file(tmp_path, "V_16")).blobs.keys() == {"V_16/kept.pdf"}
+    assert ListingSnapshot.load(snapshot_file(tmp_path, "V_17")).blobs.keys() == {"V_17/updated.pdf"}
+
+    # Only the failed file is listed as changed by the next plan
+    next_plan = build_sync_plan(bucket, files_dbs, tmp_path)
+    assert [f.name for f in next_plan.versions["V_16"].listed_files] == ["V_16/new.pdf"]
+    assert next_plan.versions["V_17"].listed_files == []
+
+
+def test_failed_deletions_are_retried(bucket, files_dbs, tmp_path):
+    def manager(failed: list[str]):
+        failures = [FileFailure(source_id=f"bucket/V_16/{name}", stage="remove", error="timeout") for name in failed]
+        return lambda db: Mock(**{"sync.return_value": SyncReport(failures=failures)})
+
+    # Without a snapshot the files DB row of a missing blob is deleted
+    plan = build_sync_plan(bucket, files_dbs, tmp_path)
+    assert [f.source_id for f in plan.versions["V_16"].differences.deleted] == ["bucket/V_16/deleted"]
+    execute_sync_plan(plan, bucket, files_dbs, manager(["deleted"]), Mock(), tmp_path)
+
+    # Then a blob of the snapshot is deleted, both deletions fail twice
+    blobs = {"V_16": [listed_blob("V_16", "new")], "V_17": [listed_blob("V_17", "updated", generation=2)]}
+    bucket.bucket.list_blobs.side_effect = lambda prefix, fields: SimpleNamespace(pages=[iter(blobs[prefix])])
+    for _ in range(2):
+        plan = build_sync_plan(bucket, files_dbs, tmp_path)
+        assert sorted(f.source_id for f in plan.versions["V_16"].differences.deleted) == \
+            ["bucket/V_16/deleted", "bucket/V_16/kept"]
+        execute_sync_plan(plan, bucket, files_dbs, manager(["deleted", "kept"]), Mock(), tmp_path)
+
+    execute_sync_plan(plan, bucket, files_dbs, manager([]), Mock(), tmp_path)
+    assert build_sync_plan(bucket, files_dbs, tmp_path).versions["V_16"].differences.deleted == []
+    assert ListingSnapshot.load(snapshot_file(tmp_path, "V_16")).blobs.keys() == {"V_16/new.pdf"}
+
+
+def test_pending_rows_are_written_before_the_next_plan(bucket, files_dbs, tmp_path, vs_file):
+    new = vs_file("new", "V_16", generation=1)
+    plan = build_sync_plan(bucket, files_dbs, tmp_path)
+    execute_sync_plan(plan, bucket, files_dbs,
+                      lambda db: Mock(**{"sync.return_value": SyncReport(ingested=["bucket/V_16/new"], pending=[new])}),
+                      Mock(), tmp_path)
+
+    # The files DB takes them this time, the file isn't ingested again
+    files_dbs["V_16"].write_many.side_effect = lambda rows: files_dbs["V_16"].get_all.return_value.extend(rows)
+    plan = build_sync_plan(bucket, files_dbs, tmp_path, full_listing=True)
+
+    files_dbs["V_16"].write_many.assert_called_with([new])
+    assert plan.versions["V_16"].differences.new_files == []
+    assert pending_rows(tmp_path, "V_16").get_all() == []
+
+
+def test_pending_rows_are_kept_if_they_cant_be_written(bucket, files_dbs, tmp_path, vs_file):
+    pending_rows(tmp_path, "V_16").add([vs_file("new", "V_16", generation=1)])
+    files_dbs["V_16"].write_many.side_effect = IOError("quota")
+
+    with pytest.raises(IOError):
+        build_sync_plan(bucket, files_dbs, tmp_path)
+    assert pending_rows(tmp_path, "V_16").get_all() == [vs_file("new", "V_16", generation=1)]
+
+
+def test_stale_plan_is_not_executed(bucket, files_dbs, tmp_path, vs_file):
+    plan = build_sync_plan(bucket, files_dbs, tmp_path)
+    files_dbs["V_17"].get_all.return_value = [vs_file("updated", "V_17", generation=2)]
+    ingestion_manager = Mock()
+    ingestion_manager.return_value.sync.return_value = SyncReport()
+
+    with pytest.raises(StalePlanError):
+        execute_sync_plan(plan, bucket, files_dbs, ingestion_manager, Mock(), tmp_path)
+    ingestion_manager.assert_not_called()
+
+    execute_sync_plan(plan, bucket, files_dbs, ingestion_manager, Mock(), tmp_path, force=True)
+    assert ingestion_manager.call_count == 2
+
+
+def test_sync_plan_cache(bucket, files_dbs, tmp_path):
+    cache = SyncPlanCache(ttl=600)
+    build = Mock(side_effect=lambda: build_sync_plan(bucket, files_dbs, tmp_path))
+
+    first = cache.get(False, build)
+    assert cache.get(False, build) is first
+    assert cache.get(False, build, refresh=True) is not first
+    assert build.call_count == 2
+
+    cache.ttl = 0
+    cache.get(False, build)
+    assert build.call_count == 3
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from src.model.answers_generation import AsyncQuestionsAnswers, QuestionsAnswers, QuestionsAnswersMock
+from benchmarks.fake_assistant import FakeAssistantServer
+from src.model.run_polling import RunPollingConfig, RunPollSchedule
+# Same classes and context variable as the answers_generation module, which imports them without the src prefix
+from model.run_polling import RunTimeoutError
+from utils.tracing import Trace
+
+
+FAST_POLLING = RunPollingConfig(fast_interval=0.001, fast_duration=1.0, min_interval=0.001, max_interval=0.01)
+
+
+def test_schedule_polls_fast_then_backs_off():
+    config = RunPollingConfig(fast_interval=0.1, fast_duration=2.0, min_interval=0.25, max_interval=1.0,
+                              backoff=2.0, server_interval=False, deadline=None)
+    schedule = RunPollSchedule(config, started_at=0.0)
+
+    assert schedule.next_interval(0.5) == 0.1
+    assert schedule.next_interval(1.9) == 0.1
+    assert [schedule.next_interval(t) for t in (2.0, 3.0, 4.0, 5.0)] == [0.25, 0.5, 1.0, 1.0]
+
+
+def test_schedule_follows_server_within_bounds_and_deadline():
+    config = RunPollingConfig(fast_duration=0.0, min_interval=0.25, max_interval=2.0, deadline=10.0)
+    schedule = RunPollSchedule(config, started_at=0.0)
+
+    assert schedule.next_interval(1.0, suggested=0.5) == 0.5
+    assert schedule.next_interval(1.0, suggested=0.01) == 0.25
+    assert schedule.next_interval(1.0, suggested=5.0) == 2.0
+    assert schedule.next_interval(9.5, suggested=1.0) == 0.5
+    assert schedule.next_interval(11.0, suggested=1.0) == 0.0
+
+
+def test_questions_answers_status_callbacks():
+    server = FakeAssistantServer(queued_polls=2, polls_to_complete=2)
+    transitions = []
+    qa = QuestionsAnswers(server.client(), "asst_1", FAST_POLLING,
+                          on_status=lambda run, previous: transitions.append((previous, run.status)))
+
+    answer = qa.answer("question", "vs_1")
+
+    assert answer.answer.startswith("Respuesta a: question")
+    assert transitions == [(None, "queued"), ("queued", "in_progress"), ("in_progress", "completed")]
+
+
+def test_questions_answers_traces_run_statuses():
+    server = FakeAssistantServer(queued_polls=1, polls_to_complete=2)
+    qa = QuestionsAnswers(server.client(), "asst_1", FAST_POLLING)
+
+    with Trace() as trace:
+        qa.answer("question", "vs_1")
+
+    assert {"openai.run.queued", "openai.run.in_progress"} <= set(trace.timings())
+
+
+def test_questions_answers_cancels_queued_run():
+    server = FakeAssistantServer(queued_polls=1000)
+    qa = QuestionsAnswers(server.client(), "asst_1", FAST_POLLING.model_copy(update={"queued_timeout": 0.05}))
+
+    with pytest.raises(RunTimeoutError) as error:
+        qa.answer("question", "vs_1")
+
+    assert error.value.run.status == "queued"
+    [run] = server.runs.values()
+    assert run["status"] == "cancelled"
+
+
+def test_questions_answers_cancels_run_after_deadline():
+    server = FakeAssistantServer(polls_to_complete=1000)
+    qa = QuestionsAnswers(server.client(), "asst_1", FAST_POLLING.model_copy(update={"deadline": 0.05}))
+
+    with pytest.raises(RunTimeoutError):
+        qa.answer("question", "vs_1")
+
+    [run] = server.runs.values()
+    assert run["status"] == "cancelled"
+
+
+def test_async_questions_answers_cancels_queued_run():
+    server = FakeAssistantServer(queued_polls=1000)
+    qa = AsyncQuestionsAnswers(server.async_client(), "asst_1",
+                               polling=FAST_POLLING.model_copy(update={"queued_timeout": 0.05}))
+
+    with pytest.raises(RunTimeoutError):
+        asyncio.run(qa.answer("question", "vs_1"))
+
+    [run] = server.runs.values()
+    assert run["status"] == "cancelled"
+
+
+def test_questions_answers_mock_delay():
+    answer = QuestionsAnswersMock(delay=0).answer("question", "vs_1")
+
+    assert answer.thread_id == "mock_thread_id"
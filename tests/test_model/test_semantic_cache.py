@@ -0,0 +1,92 @@
+from unittest.mock import Mock
+
+import numpy as np
+
+from benchmarks.fake_assistant import FakeAssistantServer
+from src.model.semantic_cache import (HashingEmbedder, OpenAIEmbedder, SemanticAnswersCache,
+                                      SemanticCachedQuestionsAnswers, similarity_histogram)
+# Same answer classes as the cache module, which imports them without the src prefix
+from model.answers_generation import QuestionsAnswers
+
+
+def semantic_model(server: FakeAssistantServer, cache: SemanticAnswersCache, fingerprints: dict[str, str]):
+    return SemanticCachedQuestionsAnswers(QuestionsAnswers(server.client(), "asst_1"), cache, "asst_1",
+                                          lambda vector_store_id: fingerprints[vector_store_id])
+
+
+def runs_created(server: FakeAssistantServer) -> int:
+    return sum(method == "POST" and path.endswith("/runs") for method, path in server.requests)
+
+
+def test_hashing_embedder():
+    vectors = HashingEmbedder().embed(["donde configuro talonarios",
+                                       "Donde puedo configurar los talonarios?",
+                                       "como emito una factura de credito"])
+
+    assert np.allclose(np.linalg.norm(vectors, axis=1), 1)
+    scores = vectors @ vectors[0]
+    assert scores[1] > scores[2]
+
+
+def test_paraphrases_are_served_from_cache():
+    server = FakeAssistantServer()
+    cache = SemanticAnswersCache(HashingEmbedder(), threshold=0.6)
+    qa = semantic_model(server, cache, {"vs_1": "a", "vs_2": "a"})
+
+    first = qa.answer("Donde configuro talonarios?", "vs_1")
+    paraphrase = qa.answer("Donde puedo configurar los talonarios?", "vs_1")
+    qa.answer("Como emito una factura de credito?", "vs_1")
+    qa.answer("Donde configuro talonarios?", "vs_2")
+
+    assert paraphrase == first
+    assert runs_created(server) == 3
+    assert (cache.stats.hits, cache.stats.misses) == (1, 3)
+    assert sum(cache.histogram.counts) == 4
+
+
+def test_changed_files_empty_the_index():
+    server = FakeAssistantServer()
+    cache = SemanticAnswersCache(HashingEmbedder(), threshold=0.6)
+    fingerprints = {"vs_1": "a"}
+    qa = semantic_model(server, cache, fingerprints)
+
+    qa.answer("Donde configuro talonarios?", "vs_1")
+    fingerprints["vs_1"] = "b"
+    qa.answer("Donde configuro talonarios?", "vs_1")
+
+    assert runs_created(server) == 2
+    assert cache.stats.invalidated == 1
+
+
+def test_semantic_answer_stream():
+    server = FakeAssistantServer()
+    cache = SemanticAnswersCache(HashingEmbedder(), threshold=0.6)
+    qa = semantic_model(server, cache, {"vs_1": "a"})
+
+    streamed = "".join(d.text for d in qa.answer_stream("Donde configuro talonarios?", "vs_1"))
+    replayed = "".join(d.text for d in qa.answer_stream("donde configuro los talonarios", "vs_1"))
+
+    assert replayed == streamed
+    assert runs_created(server) == 1
+
+
+def test_similarity_histogram():
+    histogram = similarity_histogram(HashingEmbedder(),
+                                     ["donde configuro talonarios", "como emito una factura"],
+                                     ["donde configuro talonarios", "cual es el horario de soporte"],
+                                     bins=10)
+
+    assert sum(histogram.counts) == 2
+    assert histogram.counts[-1] == 1
+    assert histogram.above(0.9) == 1
+
+
+def test_openai_embedder_orders_and_normalizes():
+    client = Mock()
+    client.embeddings.create.return_value = Mock(data=[Mock(index=1, embedding=[0.0, 2.0]),
+                                                       Mock(index=0, embedding=[3.0, 4.0])])
+
+    vectors = OpenAIEmbedder(client, "model").embed(["first", "second"])
+
+    np.testing.assert_allclose(vectors, [[0.6, 0.8], [0.0, 1.0]])
+    client.embeddings.create.assert_called_once_with(model="model", input=["first", "second"])
@@ -1,10 +1,20 @@
-
-from unittest.mock import Mock, patch
-
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from unittest.mock import ANY, Mock, patch
+
+import httplib2
 import pytest
 from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
 
-from src.utils.drive_utils import SCOPES, CredentialsError, DriveConfig, DriveCredentials, DriveFile, FilesServiceFacade, ServiceGenerator, SheetServiceFacade, get_service_generator, get_sheet_service, get_files_service, get_document_id
+from src.utils.drive_utils import SCOPES, CredentialsError, DriveAuthorizedHttp, DriveConfig, DriveCredentials, DriveFile, FilesServiceFacade, HttpPool, ServiceGenerator, SheetServiceFacade, get_service_generator, get_sheet_service, get_files_service, get_document_id
+from src.defaults import DRIVE_TOKEN_CACHE_FILE
+# Same classes as the drive_utils module, which imports them without the src prefix
+from utils.drive_utils import ResilientSheetServiceFacade, SheetsResilienceConfig
+from utils.resilience import CircuitOpenError
 
 
 @pytest.fixture
@@ -74,6 +84,30 @@ def test_sheet_service_facade_update():
         body={"values": [["1", "2"], ["3", "4"]]},
     )
 
+def test_sheet_service_facade_batch_update():
+    service = Mock()
+    sheet_service = SheetServiceFacade(service)
+    sheet_service.batch_update("spreadsheet_id", {"A1": [["1"]], "B2": [["2"]]})
+    service.values().batchUpdate.assert_called_once_with(
+        spreadsheetId="spreadsheet_id",
+        body={
+            "valueInputOption": "USER_ENTERED",
+            "data": [{"range": "A1", "values": [["1"]]}, {"range": "B2", "values": [["2"]]}],
+        },
+    )
+
+def test_sheet_service_facade_append():
+    service = Mock()
+    sheet_service = SheetServiceFacade(service)
+    sheet_service.append("spreadsheet_id", "range", [["1", "2"], ["3", "4"]])
+    service.values().append.assert_called_once_with(
+        spreadsheetId="spreadsheet_id",
+        range="range",
+        valueInputOption="USER_ENTERED",
+        insertDataOption="INSERT_ROWS",
+        body={"values": [["1", "2"], ["3", "4"]]},
+    )
+
 def test_files_service_facade_list_files():
     service = Mock()
     service.return_value.execute.return_value = {
@@ -116,7 +150,42 @@ def test_service_generator_get_service(mock_build, mock_drive_credentials):
     result = service_gen.get_service("service_name", "v4")
     assert result == service
     mock_drive_credentials.get_drive_credentials.assert_called_once()
-    mock_build.assert_called_once_with("service_name", "v4", credentials={"valid": True})
+    mock_build.assert_called_once_with("service_name", "v4", http=ANY)
+    assert mock_build.call_args.kwargs["http"].drive_creds is mock_drive_credentials
+
+
+def test_service_generator_thread_safe_service(mock_build, mock_drive_credentials):
+    service_gen = ServiceGenerator(mock_drive_credentials, thread_safe=True)
+
+    service_gen.get_service("sheets", "v4")
+    args, kwargs = mock_build.call_args
+    assert args == ("sheets", "v4")
+    assert "credentials" not in kwargs
+    assert isinstance(kwargs["http"], HttpPool)
+
+
+def test_http_pool_checks_out_a_connection_per_request(mock_drive_credentials):
+    pool = HttpPool(mock_drive_credentials, size=1)
+    used = []
+    both_in_use = threading.Barrier(2, timeout=5)
+
+    def request(self, *args, **kwargs):
+        used.append(self)
+        if len(used) <= 2:
+            both_in_use.wait()
+        return Mock(status=200), b""
+
+    with patch.object(DriveAuthorizedHttp, "request", request):
+        threads = [threading.Thread(target=pool.request, args=("https://sheets.googleapis.com",)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pool.request("https://sheets.googleapis.com")
+
+    # Concurrent requests use their own connection, and only `size` of them are kept for the next ones
+    assert used[0] is not used[1]
+    assert used[2] in used[:2]
 
 
 def test_service_generator_get_sheet_service(mock_build, mock_drive_credentials):
@@ -127,7 +196,7 @@ def test_service_generator_get_sheet_service(mock_build, mock_drive_credentials)
     result = service_gen.get_sheet_service()
     assert isinstance(result, SheetServiceFacade)
     assert mock_build.call_count == 1
-    mock_build.assert_called_once_with("sheets", "v4", credentials={"valid": True})
+    mock_build.assert_called_once_with("sheets", "v4", http=ANY)
 
     assert service.spreadsheets.call_count == 1
 
@@ -140,7 +209,7 @@ def test_service_generator_get_files_service(mock_build, mock_drive_credentials)
     result = service_gen.get_files_service()
     assert isinstance(result, FilesServiceFacade)
     assert mock_build.call_count == 1
-    mock_build.assert_called_once_with("drive", "v3", credentials={"valid": True})
+    mock_build.assert_called_once_with("drive", "v3", http=ANY)
 
     assert service.files.call_count == 1
 
@@ -151,7 +220,7 @@ def test_get_service_generator(mocker, test_config):
 
     result = get_service_generator(test_config)
 
-    mock_drive_credentials.assert_called_once_with(test_config)
+    mock_drive_credentials.assert_called_once_with(test_config, DRIVE_TOKEN_CACHE_FILE)
     assert isinstance(result, ServiceGenerator)
     assert result.drive_creds == mock_drive_credentials
 
@@ -163,7 +232,7 @@ def test_get_sheet_service(mocker, test_config):
 
     result = get_sheet_service(test_config)
 
-    mock_service_gen.assert_called_once_with(test_config)
+    mock_service_gen.assert_called_once_with(test_config, DRIVE_TOKEN_CACHE_FILE)
     mock_service_gen.get_sheet_service.assert_called_once()
     assert result == sheet_service_mock
     assert isinstance(result, SheetServiceFacade)
@@ -176,7 +245,7 @@ def test_get_files_service(mocker, test_config):
 
     result = get_files_service(test_config)
 
-    mock_service_gen.assert_called_once_with(test_config)
+    mock_service_gen.assert_called_once_with(test_config, DRIVE_TOKEN_CACHE_FILE)
     mock_service_gen.get_files_service.assert_called_once()
     assert result == files_service_mock
     assert isinstance(result, FilesServiceFacade)
@@ -196,3 +265,231 @@ def test_get_document_id(mocker, test_config):
 
     with pytest.raises(ValueError):
         get_document_id("https://docs.google.com/spreadsheet/d/1/edit")
+
+
+def expiring_credentials(test_config, tmp_path, expires_in: timedelta) -> DriveCredentials:
+    drive_creds = DriveCredentials(test_config, token_file=tmp_path / "token.json", refresh_margin=300)
+    expiry = datetime.now(timezone.utc).replace(tzinfo=None) + expires_in
+    drive_creds.token_dict["expiry"] = expiry.isoformat() + "Z"
+    return drive_creds
+
+
+def fake_refresh(creds, _):
+    creds.token = "refreshed_token"
+    creds.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=1)
+
+
+def test_credentials_are_kept(mock_credentials, test_config):
+    mock_credentials.return_value.valid = True
+    drive_creds = DriveCredentials(test_config)
+
+    assert drive_creds.get_drive_credentials() is drive_creds.get_drive_credentials()
+    mock_credentials.assert_called_once()
+
+
+def test_credentials_refresh_before_expiry(mocker, test_config, tmp_path):
+    refresh_started = threading.Event()
+    release_refresh = threading.Event()
+
+    def slow_refresh(creds, request):
+        refresh_started.set()
+        release_refresh.wait(2)
+        fake_refresh(creds, request)
+
+    refresh = mocker.patch.object(Credentials, "refresh", autospec=True, side_effect=slow_refresh)
+    drive_creds = expiring_credentials(test_config, tmp_path, timedelta(minutes=4, seconds=30))
+
+    creds = drive_creds.get_drive_credentials()
+    assert creds.token == "valid_token"  # Still valid, not refreshed on the request path
+    assert refresh_started.wait(2)
+
+    # Callers don't wait for the slow refresh, they keep the valid token
+    caller = threading.Thread(target=drive_creds.get_drive_credentials)
+    caller.start()
+    caller.join(1)
+    assert not caller.is_alive()
+    assert creds.token == "valid_token"
+    release_refresh.set()
+
+    deadline = time.monotonic() + 2
+    while drive_creds.token_dict["token"] != "refreshed_token" and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    refresh.assert_called_once()
+    assert creds.token == "refreshed_token"
+    assert json.loads((tmp_path / "token.json").read_text())["token"] == "refreshed_token"
+
+
+def test_saved_token_is_loaded(mocker, test_config, tmp_path):
+    mocker.patch.object(Credentials, "refresh", autospec=True, side_effect=fake_refresh)
+    drive_creds = expiring_credentials(test_config, tmp_path, timedelta(minutes=-1))
+    drive_creds.get_drive_credentials()
+
+    next_creds = DriveCredentials(test_config, token_file=tmp_path / "token.json")
+    assert next_creds.get_drive_credentials().token == "refreshed_token"
+
+    other_config = test_config.model_copy(update={"DRIVE_REFRESH_TOKEN": "other_refresh_token"})
+    other_creds = DriveCredentials(other_config, token_file=tmp_path / "token.json")
+    assert other_creds.token_dict["token"] == "valid_token"
+
+
+def test_service_requests_refresh_through_drive_credentials(mocker, test_config, tmp_path):
+    refresh = mocker.patch.object(Credentials, "refresh", autospec=True, side_effect=fake_refresh)
+    drive_creds = expiring_credentials(test_config, tmp_path, timedelta(minutes=-1))
+    connection = Mock(spec=httplib2.Http)
+    connection.request.return_value = (httplib2.Response({"status": "200"}), b"{}")
+    http = DriveAuthorizedHttp(drive_creds, connection)
+    refresh.assert_called_once()
+
+    # The long lived service's token expires, the next request refreshes it once and saves it
+    drive_creds.get_drive_credentials().expiry = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(minutes=1)
+    http.request("https://sheets.googleapis.com/v4/spreadsheets/1")
+    http.request("https://sheets.googleapis.com/v4/spreadsheets/1")
+
+    assert refresh.call_count == 2
+    assert connection.request.call_args.kwargs["headers"]["authorization"] == "Bearer refreshed_token"
+    assert json.loads((tmp_path / "token.json").read_text())["token"] == "refreshed_token"
+
+
+class FlakyRequest:
+    """An API request that raises the given errors before succeeding."""
+
+    def __init__(self, errors: list[Exception], result: dict):
+        self.errors = list(errors)
+        self.result = result
+        self.executions = 0
+
+    def execute(self) -> dict:
+        self.executions += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.result
+
+
+def http_error(status: int, headers: dict | None = None, reason: str | None = None) -> HttpError:
+    content = {"error": {"code": status, "message": "error", "errors": [{"reason": reason}] if reason else []}}
+    return HttpError(httplib2.Response({"status": status, **(headers or {})}), json.dumps(content).encode())
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps: list[float] = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def flaky_sheet_service(request: FlakyRequest, **config) -> tuple[ResilientSheetServiceFacade, FakeClock]:
+    service = Mock()
+    service.values().get.return_value = request
+    service.values().append.return_value = request
+    clock = FakeClock()
+    resilience = SheetsResilienceConfig(**{"requests_per_minute": 6000, **config})
+    return ResilientSheetServiceFacade(service, resilience, clock.sleep, clock, random.Random(0)), clock
+
+
+def test_resilient_sheet_service_retries_transient_errors():
+    request = FlakyRequest([http_error(503), ConnectionResetError()], {"values": [["A1"]]})
+    sheet_service, clock = flaky_sheet_service(request, base_delay=1.0)
+
+    assert sheet_service.get("spreadsheet_id", "range") == [["A1"]]
+
+    assert request.executions == 3
+    assert 0.5 <= clock.sleeps[0] <= 1.0 and 1.0 <= clock.sleeps[1] <= 2.0
+    metrics = sheet_service.metrics()
+    assert (metrics.calls, metrics.attempts, metrics.retries, metrics.failures) == (1, 3, 2, 0)
+
+
+def test_resilient_sheet_service_honors_retry_after():
+    request = FlakyRequest([http_error(429, {"retry-after": "7"})], {"values": []})
+    sheet_service, clock = flaky_sheet_service(request, base_delay=0.1)
+
+    sheet_service.get("spreadsheet_id", "range")
+
+    assert clock.sleeps == [7.0]
+    assert sheet_service.metrics().quota_errors == 1
+
+
+def test_resilient_sheet_service_quota_reason():
+    request = FlakyRequest([http_error(403, reason="rateLimitExceeded")], {"values": []})
+    sheet_service, clock = flaky_sheet_service(request, base_delay=0.1, quota_delay=10.0)
+
+    sheet_service.get("spreadsheet_id", "range")
+
+    assert clock.sleeps == [10.0]
+
+
+def test_resilient_sheet_service_does_not_retry_client_errors():
+    request = FlakyRequest([http_error(400)], {})
+    sheet_service, _ = flaky_sheet_service(request)
+
+    with pytest.raises(HttpError):
+        sheet_service.get("spreadsheet_id", "range")
+
+    assert request.executions == 1
+    assert sheet_service.metrics().circuit_state == "closed"
+
+
+def test_resilient_sheet_service_append_only_retries_quota_errors():
+    request = FlakyRequest([http_error(503)], {})
+    sheet_service, _ = flaky_sheet_service(request)
+
+    with pytest.raises(HttpError):
+        sheet_service.append("spreadsheet_id", "range", [["1"]])
+    assert request.executions == 1
+
+    request = FlakyRequest([http_error(429)], {})
+    sheet_service, _ = flaky_sheet_service(request, quota_delay=1.0)
+    sheet_service.append("spreadsheet_id", "range", [["1"]])
+    assert request.executions == 2
+
+
+def test_resilient_sheet_service_circuit_breaker():
+    request = FlakyRequest([http_error(503)] * 3, {"values": []})
+    sheet_service, clock = flaky_sheet_service(request, max_retries=1, failure_threshold=2, reset_timeout=30.0)
+
+    with pytest.raises(HttpError):
+        sheet_service.get("spreadsheet_id", "range")
+    with pytest.raises(CircuitOpenError):
+        sheet_service.get("spreadsheet_id", "range")
+    assert request.executions == 2
+
+    clock.now += 30
+    # The trial call fails and opens the circuit again, its retry is rejected
+    with pytest.raises(CircuitOpenError):
+        sheet_service.get("spreadsheet_id", "range")
+    assert request.executions == 3
+
+    metrics = sheet_service.metrics()
+    assert (metrics.rejected, metrics.circuit_opened, metrics.circuit_state) == (2, 2, "open")
+
+    clock.now += 30
+    assert sheet_service.get("spreadsheet_id", "range") == []
+    assert sheet_service.metrics().circuit_state == "closed"
+
+
+def test_resilient_sheet_service_quota_errors_do_not_open_the_circuit():
+    request = FlakyRequest([http_error(429)] * 4, {"values": []})
+    sheet_service, _ = flaky_sheet_service(request, failure_threshold=2, quota_delay=1.0)
+
+    assert sheet_service.get("spreadsheet_id", "range") == []
+
+    metrics = sheet_service.metrics()
+    assert (metrics.quota_errors, metrics.circuit_opened, metrics.circuit_state) == (4, 0, "closed")
+
+
+def test_resilient_sheet_service_rate_limits_per_spreadsheet():
+    request = FlakyRequest([], {"values": []})
+    sheet_service, clock = flaky_sheet_service(request, requests_per_minute=60, burst=2)
+
+    for _ in range(3):
+        sheet_service.get("spreadsheet_1", "range")
+    sheet_service.get("spreadsheet_2", "range")
+
+    assert clock.sleeps == [pytest.approx(1.0)]
+    assert sheet_service.metrics().throttled_seconds == pytest.approx(1.0)
@@ -0,0 +1,70 @@
+from datetime import datetime
+from io import BytesIO
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+
+from src.utils.gcs_utils import LISTING_FIELDS, GCSBucketFacade, ListingSnapshot
+
+
+@pytest.fixture
+def bucket():
+    bucket = Mock()
+    bucket.blob.return_value.download_to_file.side_effect = lambda fp: fp.write(b"content")
+    return bucket
+
+
+def test_download_to_file_in_memory(bucket, gcs_file):
+    with GCSBucketFacade(bucket).download_to_file(gcs_file("doc", size=7), max_memory=10) as fp:
+        assert isinstance(fp, BytesIO)
+        assert fp.read() == b"content"
+    bucket.blob.assert_called_once_with("V_16/doc.pdf")
+
+
+@pytest.mark.parametrize("size", [None, 100])
+def test_download_to_file_on_disk(bucket, size, gcs_file):
+    with GCSBucketFacade(bucket).download_to_file(gcs_file("doc", size=size), max_memory=10) as fp:
+        assert not isinstance(fp, BytesIO)
+        assert fp.read() == b"content"
+
+
+def listed_blob(name: str, generation: int, content_type: str = "application/pdf") -> SimpleNamespace:
+    return SimpleNamespace(id=f"bucket/{name}/{generation}", name=name, content_type=content_type,
+                           updated=datetime.fromisoformat("2024-12-21 00:00:00+00:00"),
+                           md5_hash=None, crc32c=None, generation=generation, size=10)
+
+
+def listing_bucket(*pages: list[SimpleNamespace]) -> Mock:
+    bucket = Mock()
+    bucket.list_blobs.return_value.pages = [iter(page) for page in pages]
+    return bucket
+
+
+def test_list_changes_is_paginated_and_incremental():
+    first = GCSBucketFacade(listing_bucket(
+        [listed_blob("V_16/a.pdf", 1), listed_blob("V_16/notes.txt", 1, "text/plain")],
+        [listed_blob("V_16/b.pdf", 1), listed_blob("V_16/c.pdf", 1)]))
+    changes = first.list_changes("V_16", ["application/pdf"], ListingSnapshot())
+    assert [f.name for f in changes.changed] == ["V_16/a.pdf", "V_16/b.pdf", "V_16/c.pdf"]
+    assert changes.unchanged == 0
+    assert first.bucket.list_blobs.call_args.kwargs["fields"] == LISTING_FIELDS
+
+    second = GCSBucketFacade(listing_bucket(
+        [listed_blob("V_16/a.pdf", 1), listed_blob("V_16/b.pdf", 2)], [listed_blob("V_16/d.pdf", 1)]))
+    changes = second.list_changes("V_16", ["application/pdf"], changes.snapshot)
+    assert [f.name for f in changes.changed] == ["V_16/b.pdf", "V_16/d.pdf"]
+    assert [e.source_id for e in changes.deleted] == ["bucket/V_16/c"]
+    assert changes.unchanged == 1
+    assert sorted(changes.snapshot.blobs) == ["V_16/a.pdf", "V_16/b.pdf", "V_16/d.pdf"]
+
+
+def test_snapshot_round_trip(tmp_path):
+    changes = GCSBucketFacade(listing_bucket([listed_blob("V_16/a.pdf", 1), listed_blob("V_16/b.pdf", 1)])) \
+        .list_changes("V_16", ["application/pdf"], ListingSnapshot())
+    snapshot_file = tmp_path / "snapshots" / "V_16.json"
+
+    changes.snapshot.without({"bucket/V_16/b"}).save(snapshot_file)
+
+    assert ListingSnapshot.load(snapshot_file).blobs.keys() == {"V_16/a.pdf"}
+    assert ListingSnapshot.load(tmp_path / "missing.json") == ListingSnapshot()
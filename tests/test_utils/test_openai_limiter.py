@@ -0,0 +1,139 @@
+import threading
+import time
+
+import httpx
+from openai import OpenAI
+
+from benchmarks.fake_assistant import FAKE_BASE_URL, FakeAssistantServer
+from src.utils.openai_limiter import (PRIORITY_HEADER, LimitedTransport, OpenAILimitsConfig, PriorityLimiter,
+                                      estimate_tokens, is_run_poll)
+# Same class as the answers_generation module, which imports it without the src prefix
+from model.answers_generation import QuestionsAnswers
+
+
+def limited_client(server: FakeAssistantServer, limiter: PriorityLimiter) -> OpenAI:
+    transport = LimitedTransport(limiter, httpx.MockTransport(server.handle))
+    return OpenAI(api_key="fake", base_url=FAKE_BASE_URL, max_retries=0, http_client=httpx.Client(transport=transport))
+
+
+def start_waiter(limiter: PriorityLimiter, priority, order: list[str]) -> threading.Thread:
+    def acquire():
+        limiter.acquire(priority)
+        order.append(priority)
+        limiter.release()
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    return thread
+
+
+def wait_for_waiting(limiter: PriorityLimiter, waiting: int):
+    deadline = time.monotonic() + 2
+    while limiter.stats().waiting < waiting and time.monotonic() < deadline:
+        time.sleep(0.005)
+
+
+def test_estimate_tokens():
+    run = httpx.Request("POST", f"{FAKE_BASE_URL}/threads/thread_1/runs", json={"assistant_id": "asst_1"})
+    message = httpx.Request("POST", f"{FAKE_BASE_URL}/threads/thread_1/messages", json={"content": "x" * 400})
+    upload = httpx.Request("POST", f"{FAKE_BASE_URL}/files", files={"file": ("doc.pdf", b"x" * 4000)})
+
+    assert estimate_tokens(run, 4000) == 4000 + len(run.content) // 4
+    assert estimate_tokens(message, 4000) > 100
+    assert estimate_tokens(upload, 4000) == 0
+
+
+def test_interactive_requests_go_first():
+    limiter = PriorityLimiter(OpenAILimitsConfig(max_concurrency=1, interactive_reserved=0))
+    limiter.acquire("interactive")
+    order: list[str] = []
+
+    background = start_waiter(limiter, "background", order)
+    wait_for_waiting(limiter, 1)
+    interactive = start_waiter(limiter, "interactive", order)
+    wait_for_waiting(limiter, 2)
+    limiter.release()
+    background.join()
+    interactive.join()
+
+    assert order == ["interactive", "background"]
+
+
+def test_background_requests_leave_reserved_slots():
+    limiter = PriorityLimiter(OpenAILimitsConfig(max_concurrency=2, interactive_reserved=1))
+    limiter.acquire("background")
+    order: list[str] = []
+
+    background = start_waiter(limiter, "background", order)
+    wait_for_waiting(limiter, 1)
+    limiter.acquire("interactive")
+
+    assert order == [] and limiter.stats().active == 2
+    limiter.release()
+    limiter.release()
+    background.join()
+    assert order == ["background"]
+
+
+def test_requests_budget():
+    limiter = PriorityLimiter(OpenAILimitsConfig(requests_per_minute=600, burst_seconds=0.1))
+
+    start = time.monotonic()
+    for _ in range(3):
+        limiter.acquire("interactive")
+        limiter.release()
+
+    # One request at once, then one every 0.1 s
+    assert time.monotonic() - start >= 0.18
+
+
+def test_run_polls_have_their_own_budget():
+    limiter = PriorityLimiter(OpenAILimitsConfig(requests_per_minute=600, burst_seconds=0.1, poll_share=0.5))
+    ok = httpx.MockTransport(lambda request: httpx.Response(200, json={}))
+    http_client = httpx.Client(transport=LimitedTransport(limiter, ok))
+
+    start = time.monotonic()
+    for _ in range(3):
+        http_client.get(f"{FAKE_BASE_URL}/threads/thread_1/runs/run_1")
+
+    # Polls are throttled, one at once, then one every 0.2 s
+    assert time.monotonic() - start >= 0.38
+    # and leave the budget of the other requests untouched
+    assert limiter.acquire("interactive") < 0.15
+    assert limiter.stats().requests["interactive"] == 4
+    assert is_run_poll(httpx.Request("GET", f"{FAKE_BASE_URL}/threads/thread_1/runs/run_1"))
+    assert not is_run_poll(httpx.Request("POST", f"{FAKE_BASE_URL}/threads/thread_1/runs/run_1/cancel"))
+
+
+def test_limited_client_priorities():
+    server = FakeAssistantServer()
+    limiter = PriorityLimiter(OpenAILimitsConfig())
+    client = limited_client(server, limiter)
+
+    qa = QuestionsAnswers(client, "asst_1")
+    qa.answer("question", "vs_1")
+    # Streamed answers keep their slot until the stream ends
+    list(qa.answer_stream("question", "vs_1"))
+    client.with_options(default_headers={PRIORITY_HEADER: "background"}).files.delete("file_1")
+
+    stats = limiter.stats()
+    assert stats.requests["background"] == 1
+    assert stats.requests["interactive"] == len(server.requests) - 1
+    assert stats.active == 0
+
+
+def test_rate_limited_response_pauses_requests():
+    seen_headers: list[httpx.Headers] = []
+
+    def rate_limited(request: httpx.Request) -> httpx.Response:
+        seen_headers.append(request.headers)
+        return httpx.Response(429, headers={"retry-after": "0.2"}, json={"error": {"message": "Rate limit"}})
+
+    limiter = PriorityLimiter(OpenAILimitsConfig())
+    http_client = httpx.Client(transport=LimitedTransport(limiter, httpx.MockTransport(rate_limited)))
+
+    http_client.get(f"{FAKE_BASE_URL}/models", headers={PRIORITY_HEADER: "background"})
+    waited = limiter.acquire("interactive")
+
+    assert waited >= 0.15
+    assert PRIORITY_HEADER not in seen_headers[0]
+    assert limiter.stats().rate_limited == 1
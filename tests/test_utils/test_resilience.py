@@ -0,0 +1,87 @@
+import random
+
+import pytest
+
+from src.utils.resilience import CircuitBreaker, CircuitOpenError, TokenBucket, backoff_delay
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+def test_backoff_delay_is_jittered_and_capped():
+    rng = random.Random(0)
+
+    delays = [backoff_delay(attempt, 1.0, 8.0, rng) for attempt in range(6)]
+
+    for attempt, delay in enumerate(delays):
+        expected = min(8.0, 2 ** attempt)
+        assert expected / 2 <= delay <= expected
+
+
+def test_token_bucket_allows_bursts_then_waits():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2.0, capacity=3, sleep=clock.sleep, clock=clock)
+
+    waits = [bucket.acquire() for _ in range(5)]
+
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert waits[3:] == pytest.approx([0.5, 0.5])
+    assert clock.now == pytest.approx(1.0)
+
+
+def test_token_bucket_refills():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1.0, capacity=2, sleep=clock.sleep, clock=clock)
+    bucket.acquire()
+    bucket.acquire()
+
+    clock.now += 10
+
+    assert [bucket.acquire(), bucket.acquire()] == [0.0, 0.0]
+    assert bucket.acquire() == pytest.approx(1.0)
+
+
+def test_circuit_breaker_opens_and_resets():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10.0, clock=clock)
+
+    breaker.before_call()
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    clock.now += 10
+    assert breaker.state == "half_open"
+    breaker.before_call()
+    # Only one trial call at a time
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+
+    assert breaker.state == "closed"
+    assert breaker.opened == 1
+
+
+def test_circuit_breaker_failed_trial_opens_again():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10.0, clock=clock)
+    breaker.record_failure()
+    clock.now += 10
+
+    breaker.before_call()
+    breaker.record_failure()
+
+    assert breaker.state == "open"
+    assert breaker.opened == 2
@@ -0,0 +1,86 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
+
+import httpx
+import pytest
+
+from src.model.answers_generation import OpenAIConfig
+from benchmarks.fake_assistant import FakeAssistantServer
+from src.utils.drive_utils import DriveConfig
+from src.utils.services import ServiceRegistry, StartupTimer
+# Same header as the services module, which imports it without the src prefix
+from utils.openai_limiter import PRIORITY_HEADER
+
+
+@pytest.fixture
+def registry():
+    drive_config = DriveConfig(DRIVE_CLIENT_ID="id", DRIVE_PROJECT_ID="project", CLIENT_SECRET="secret",
+                               DRIVE_TOKEN="token", DRIVE_REFRESH_TOKEN="refresh")
+    openai_config = OpenAIConfig(OPENAI_API_KEY="key", OPENAI_ORG_ID="org")
+    return ServiceRegistry(drive_config, openai_config)
+
+
+def test_sheet_service_is_built_once(registry):
+    registry.service_generator = Mock()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        services = list(executor.map(lambda _: registry.sheet_service(), range(16)))
+
+    assert all(service is services[0] for service in services)
+    registry.service_generator.get_sheet_service.assert_called_once()
+
+
+def test_assistant_is_retrieved_once(registry):
+    server = FakeAssistantServer()
+    registry.openai_transport = httpx.MockTransport(server.handle)
+
+    first = registry.questions_answers("asst_1")
+    second = registry.questions_answers("asst_1")
+
+    assert first is second
+    assert server.requests.count(("GET", "/assistants/asst_1")) == 1
+
+
+def test_reset_rebuilds_services(registry):
+    registry.service_generator = Mock()
+    registry.sheet_service()
+    registry.reset()
+    registry.sheet_service()
+
+    assert registry.service_generator.get_sheet_service.call_count == 2
+
+
+def test_shared_objects_are_built_once_by_key(registry):
+    def files_db(sheet_name: str):
+        return Mock(vector_store_id="vs_1", sheet_name=sheet_name)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        caches = list(executor.map(lambda _: registry.ids_mapping_cache(files_db("V_16")), range(16)))
+
+    assert all(cache is caches[0] for cache in caches)
+    assert registry.ids_mapping_cache(files_db("V_17")) is not caches[0]
+    assert registry.sync_plan_cache(ttl=60) is registry.sync_plan_cache(ttl=0)
+
+
+def test_reset_keeps_shared_objects(registry):
+    limiter = registry.openai_limiter()
+    registry.reset()
+
+    assert registry.openai_limiter() is limiter
+
+
+def test_threads_pool_uses_the_background_client(registry):
+    server = FakeAssistantServer()
+    registry.openai_transport = httpx.MockTransport(server.handle)
+
+    pool = registry.threads_pool()
+
+    assert registry.threads_pool() is pool
+    assert pool.client.default_headers[PRIORITY_HEADER] == "background"
+
+
+def test_startup_timer_reports_once():
+    timer = StartupTimer("Chat")
+
+    assert timer.report() >= 0
+    assert timer.report() is None
@@ -0,0 +1,73 @@
+from unittest.mock import Mock
+
+import pytest
+
+from src.model.answers_generation import MarkdownAnswer, QuestionsAnswers
+from benchmarks.fake_assistant import FakeAssistantServer
+from src.model.files_manager import SheetFilesDB
+# Same trace context as the instrumented modules, which import it without the src prefix
+from utils.tracing import LatencyExporter, LatencyStats, Trace, span
+
+
+def test_span_without_trace_is_not_recorded():
+    with span("stage"):
+        pass
+    with Trace("request") as trace:
+        with span("stage"):
+            pass
+    with span("stage"):
+        pass
+
+    assert [s.name for s in trace.spans] == ["stage", "request"]
+
+
+def test_answer_stages():
+    server = FakeAssistantServer()
+    qa = QuestionsAnswers(server.client(), "asst_1")
+    files_db = Mock(vector_store_id="vs_tracing", sheet_name="V_tracing")
+    files_db.get_ids_mapping.return_value = {"file_1": "doc_1"}
+    stats = LatencyStats()
+
+    with Trace("answer", stats) as trace:
+        answer = qa.answer("question", "vs_tracing")
+        MarkdownAnswer.from_llm_answer(answer, SheetFilesDB(files_db))
+
+    assert set(trace.timings()) == {"answer", "openai.thread_create", "openai.message_create", "openai.run",
+                                    "openai.run.in_progress", "openai.messages_list", "files.get_file_link"}
+    assert trace.timings()["answer"] >= trace.timings()["openai.run"]
+    assert stats.percentiles()["answer"].count == 1
+
+
+def test_streamed_answer_stages():
+    server = FakeAssistantServer()
+    qa = QuestionsAnswers(server.client(), "asst_1")
+
+    with Trace("answer") as trace:
+        list(qa.answer_stream("question", "vs_1"))
+
+    assert {"openai.run", "openai.first_token"} <= set(trace.timings())
+    assert trace.timings()["openai.first_token"] <= trace.timings()["openai.run"]
+
+
+def test_latency_percentiles():
+    stats = LatencyStats(max_samples=100)
+    for i in range(1, 201):
+        stats.add_many({"openai.run": i / 100, "sheets.get": 0.01})
+
+    percentiles = stats.percentiles()
+    assert percentiles["openai.run"].count == 100
+    assert percentiles["openai.run"].p50 == pytest.approx(1.505)
+    assert percentiles["openai.run"].p99 == pytest.approx(1.9901)
+    assert percentiles["sheets.get"].p95 == pytest.approx(0.01)
+
+
+def test_exporter_emits_changed_reports():
+    stats = LatencyStats()
+    emitted = []
+    exporter = LatencyExporter(stats, emit=emitted.append)
+
+    assert not exporter.export()
+    stats.add_many({"answer": 1.0})
+    assert exporter.export()
+    assert not exporter.export()
+    assert "answer: n=1 p50=1000 ms p95=1000 ms p99=1000 ms" in emitted[0]